@@ -0,0 +1,122 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "usr", "lib", "python3", "dist-packages"))
+
+from mintcommon.installer.apt_filters import PackageFilter, DEFAULT_RULES
+
+EXAMPLE_PATH = os.path.join(os.path.dirname(__file__), "..", "usr", "share", "doc", "mint-common", "examples", "apt-filters.conf")
+
+def is_listed(name, section, summary, names):
+    # The hard-coded checks the default rules replaced, as they were.
+    if name.startswith("lib") and not name.startswith(("libreoffice", "librecad", "librewolf", "libk3b7", "libimage-exiftool-perl")):
+        return False
+    if name.endswith(":i386") and name != "steam:i386":
+        return False
+    if name.endswith("-dev"):
+        return False
+    if name.endswith("-dbg"):
+        return False
+    if name.endswith("-doc"):
+        return False
+    if name.endswith("-common"):
+        return False
+    if name.endswith("-data"):
+        return False
+    if "-locale-" in name:
+        return False
+    if "-l10n-" in name:
+        return False
+    if name.endswith("-dbgsym"):
+        return False
+    if name.endswith("l10n"):
+        return False
+    if name.endswith("-perl"):
+        return False
+    if name == "snapd":
+        return False
+    if name == "pepperflashplugin-nonfree":
+        return False
+    if section.endswith("kernel"):
+        return False
+    if name.startswith(("linux-headers-", "linux-tools-")):
+        return False
+    if ":" in name and name.split(":")[0] in names:
+        return False
+    if summary is not None and "transitional" in summary.lower():
+        return False
+
+    return True
+
+NAMES = [
+    "firefox", "libreoffice-writer", "libc6", "librecad", "libk3b7", "libk3b7-extracodecs",
+    "libimage-exiftool-perl", "steam:i386", "wine:i386", "wine", "zlib1g-dev", "gdb-dbg",
+    "python3-doc", "gimp-common", "gimp-data", "firefox-locale-fr", "thunderbird-l10n-de",
+    "kde-l10n", "libreoffice-l10n", "foo-dbgsym", "libwww-perl", "perl", "snapd",
+    "pepperflashplugin-nonfree", "linux-headers-6.8.0", "linux-tools-common", "linux-image-generic",
+    "vlc:amd64", "inkscape:arm64", "common", "dev", "-dev"
+]
+
+SECTIONS = ["", "utils", "kernel", "universe/kernel", "multiverse/kernel", "restricted/kernel",
+            "oldkernel", "kernel/extra", "universe/utils", "graphics"]
+
+SUMMARIES = [None, "", "A web browser", "transitional package", "Transitional dummy package",
+             "TRANSITIONAL", "not transition-al"]
+
+class DefaultRulesTest(unittest.TestCase):
+    def test_same_as_hard_coded_checks(self):
+        package_filter = PackageFilter(DEFAULT_RULES)
+        names = set(NAMES)
+
+        for name in NAMES:
+            for section in SECTIONS:
+                for summary in SUMMARIES:
+                    excluded = package_filter.excludes_package(name, section, names) or \
+                        package_filter.excludes_summary(summary)
+
+                    self.assertEqual(not excluded, is_listed(name, section, summary, names),
+                                     "%s, section '%s', summary %r" % (name, section, summary))
+
+    def test_fingerprint_follows_rules(self):
+        rules = {kind: list(patterns) for kind, patterns in DEFAULT_RULES.items()}
+        self.assertEqual(PackageFilter(DEFAULT_RULES).fingerprint, PackageFilter(rules).fingerprint)
+
+        rules["sections"] = []
+        self.assertNotEqual(PackageFilter(DEFAULT_RULES).fingerprint, PackageFilter(rules).fingerprint)
+
+class AllowlistTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def load(self, text):
+        path = os.path.join(self.tmp_dir, "apt-filters.conf")
+        with open(path, "w") as f:
+            f.write(text)
+
+        return PackageFilter.load(path)
+
+    def test_exact_names(self):
+        package_filter = self.load("[prefixes]\nlib = libreoffice librecad*\n")
+
+        self.assertFalse(package_filter.excludes_package("libreoffice", "", set()))
+        self.assertTrue(package_filter.excludes_package("libreoffice-writer", "", set()))
+        self.assertFalse(package_filter.excludes_package("librecad", "", set()))
+        self.assertFalse(package_filter.excludes_package("librecad-plugins", "", set()))
+        self.assertTrue(package_filter.excludes_package("libc6", "", set()))
+
+    def test_only_spared_by_its_rule(self):
+        package_filter = PackageFilter(DEFAULT_RULES)
+
+        self.assertFalse(package_filter.excludes_package("libreoffice-writer", "", set()))
+        self.assertTrue(package_filter.excludes_package("libreoffice-dev", "", set()))
+        self.assertTrue(package_filter.excludes_package("libreoffice-l10n-fr", "", set()))
+
+    def test_example_has_the_defaults(self):
+        self.assertEqual(PackageFilter.load(EXAMPLE_PATH).fingerprint, PackageFilter(DEFAULT_RULES).fingerprint)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,188 @@
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from array import array
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "usr", "lib", "python3", "dist-packages"))
+
+from mintcommon.installer import cachefile
+from mintcommon.installer.cachefile import CacheFormatError
+
+RECORDS_KEY = "records"
+
+def make_payload():
+    return {
+        "schema_version": 5,
+        RECORDS_KEY: {
+            "apt:frobnicator": {"name": "frobnicator", "icon": {"48": "/usr/share/icons/frob.png"}},
+            "apt:widgetd": {"name": "widgetd", "summary": "Widgets, délicieux ✓", "icon": {}},
+            "fp:org.example.App": {"name": "org.example.App", "installed": True, "kind": 0,
+                                   "keywords": ["example", "app"], "rating": 4.5, "developer": None}
+        },
+        "section_lists": {"utils": ["apt:frobnicator", "apt:widgetd"]},
+        "flatpak_shards": {}
+    }
+
+class CacheFileTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, "pkginfo.bin")
+
+    def save(self, payload, binary=True):
+        with open(self.path, "wb" if binary else "w") as f:
+            cachefile.save(f, payload, RECORDS_KEY, binary=binary)
+
+    def write_bytes(self, data):
+        with open(self.path, "wb") as f:
+            f.write(data)
+
+    def dump(self, payload):
+        f = io.BytesIO()
+        cachefile.dump(payload, f, RECORDS_KEY)
+        return bytearray(f.getvalue())
+
+    def assert_round_trip(self, payload, binary):
+        self.save(payload, binary)
+        loaded = cachefile.load(self.path, RECORDS_KEY)
+
+        self.assertEqual(cachefile.is_binary(self.path), binary)
+        self.assertEqual(loaded["schema_version"], payload["schema_version"])
+        self.assertEqual(dict(loaded[RECORDS_KEY]), payload[RECORDS_KEY])
+        self.assertEqual(list(loaded[RECORDS_KEY].keys()), list(payload[RECORDS_KEY].keys()))
+        self.assertEqual({k: v for k, v in loaded.items() if k != RECORDS_KEY},
+                         {k: v for k, v in payload.items() if k != RECORDS_KEY})
+
+    def test_round_trip(self):
+        self.assert_round_trip(make_payload(), True)
+        self.assert_round_trip(make_payload(), False)
+
+    def test_empty_cache(self):
+        payload = {"schema_version": 5, RECORDS_KEY: {}}
+        self.assert_round_trip(payload, True)
+
+        loaded = cachefile.load(self.path, RECORDS_KEY)
+        self.assertEqual(len(loaded[RECORDS_KEY]), 0)
+        self.assertNotIn("apt:frobnicator", loaded[RECORDS_KEY])
+
+    def test_scalar_types(self):
+        # True == 1 == 1.0, but they mustn't come back as each other.
+        values = [True, 1, 1.0, False, 0, 0.0, None, "1", "", -2 ** 63, 2 ** 63 - 1, 1e300]
+        self.save({"schema_version": 5, RECORDS_KEY: {"values": values, "dict": {"a": True, "b": 1, "c": 1.0}}})
+
+        records = cachefile.load(self.path, RECORDS_KEY)[RECORDS_KEY]
+
+        loaded = records["values"]
+        self.assertEqual(loaded, values)
+        self.assertEqual([type(value) for value in loaded], [type(value) for value in values])
+        self.assertEqual([type(value) for value in records["dict"].values()], [bool, int, float])
+
+    def test_dict_keys_are_strings(self):
+        self.save({"schema_version": 5, RECORDS_KEY: {"icons": {48: "a.png", 64: "b.png"}}})
+        self.assertEqual(cachefile.load(self.path, RECORDS_KEY)[RECORDS_KEY]["icons"], {"48": "a.png", "64": "b.png"})
+
+    def test_u32_arrays(self):
+        postings = array("I", [0, 1, 0xffffffff, 1234567])
+        payload = {"schema_version": 1, RECORDS_KEY: {"token": postings, "none": array("I")}}
+
+        self.save(payload)
+        records = cachefile.load(self.path, RECORDS_KEY)[RECORDS_KEY]
+        self.assertEqual(records["token"], postings)
+        self.assertEqual(records["token"].typecode, "I")
+        self.assertEqual(len(records["none"]), 0)
+
+        # Arrays are written as plain lists in json caches.
+        self.save(payload, binary=False)
+        records = cachefile.load(self.path, RECORDS_KEY)[RECORDS_KEY]
+        self.assertEqual(records["token"], list(postings))
+
+    def test_default(self):
+        class Point():
+            def __init__(self, x, y):
+                self.x = x
+                self.y = y
+
+        with open(self.path, "wb") as f:
+            cachefile.save(f, {"schema_version": 1, RECORDS_KEY: {"p": Point(1, 2)}}, RECORDS_KEY,
+                           default=lambda o: {"x": o.x, "y": o.y})
+        self.assertEqual(cachefile.load(self.path, RECORDS_KEY)[RECORDS_KEY]["p"], {"x": 1, "y": 2})
+
+        with self.assertRaises(TypeError):
+            self.dump({"schema_version": 1, RECORDS_KEY: {"p": Point(1, 2)}})
+
+    def test_empty_file(self):
+        self.write_bytes(b"")
+        with self.assertRaises(CacheFormatError):
+            cachefile.load(self.path, RECORDS_KEY)
+
+    def test_bad_magic_is_read_as_json(self):
+        data = self.dump(make_payload())
+        data[0:8] = b"NOTMAGIC"
+        self.write_bytes(data)
+
+        with self.assertRaises(CacheFormatError):
+            cachefile.load(self.path, RECORDS_KEY)
+
+    def test_unknown_format_version(self):
+        data = self.dump(make_payload())
+        data[8] = cachefile.BINARY_FORMAT_VERSION + 1
+        self.write_bytes(data)
+
+        with self.assertRaises(CacheFormatError):
+            cachefile.load(self.path, RECORDS_KEY)
+
+    def test_invalid_json(self):
+        for data in (b"{\"schema_version\": 5, ", b"\xff\xfe{}", b"[]"):
+            self.write_bytes(data)
+            with self.assertRaises(CacheFormatError):
+                cachefile.load(self.path, RECORDS_KEY)
+
+    def test_truncated(self):
+        data = self.dump(make_payload())
+
+        for length in range(1, len(data)):
+            self.write_bytes(data[:length])
+
+            with self.assertRaises(CacheFormatError, msg="truncated to %d bytes" % length):
+                cachefile.load(self.path, RECORDS_KEY)
+
+    def test_corrupt_bytes(self):
+        # Whatever byte is damaged, loading and reading everything either works or raises
+        # CacheFormatError - never anything else.
+        data = self.dump(make_payload())
+
+        for pos in range(len(data)):
+            for value in (0x00, 0xff, data[pos] ^ 0x01):
+                corrupt = bytearray(data)
+                corrupt[pos] = value
+                self.write_bytes(corrupt)
+
+                try:
+                    payload = cachefile.load(self.path, RECORDS_KEY)
+                    for key in payload[RECORDS_KEY].keys():
+                        payload[RECORDS_KEY][key]
+                except CacheFormatError:
+                    pass
+
+    def test_corrupt_record(self):
+        payload = make_payload()
+        data = self.dump(payload)
+
+        self.write_bytes(data)
+        records = cachefile.load(self.path, RECORDS_KEY)[RECORDS_KEY]
+        offset = records._offsets["apt:widgetd"]
+
+        # An unknown tag is only found when the record is decoded.
+        data[offset] = ord("?")
+        self.write_bytes(data)
+
+        records = cachefile.load(self.path, RECORDS_KEY)[RECORDS_KEY]
+        self.assertEqual(records["apt:frobnicator"], payload[RECORDS_KEY]["apt:frobnicator"])
+        with self.assertRaises(CacheFormatError):
+            records["apt:widgetd"]
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,73 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "usr", "lib", "python3", "dist-packages"))
+
+from mintcommon.installer.catalog import PkgCatalog
+
+RECORDS = {
+    "apt:frobnicator": {"pkg_hash": "apt:frobnicator", "name": "frobnicator", "display_name": "Frobnicator",
+                        "summary": "A tool", "icon": {"48": "/usr/share/icons/frob.png"}},
+    "apt:widgetd": {"pkg_hash": "apt:widgetd", "name": "widgetd", "display_name": "Widgetd",
+                    "summary": "A tool", "icon": {}},
+    "fp:org.example.App": {"pkg_hash": "fp:org.example.App", "name": "org.example.App", "summary": "Ünïcode ✓",
+                           "installed": True, "kind": 0, "keywords": ["example", "app", ["nested"]],
+                           "screenshots": [], "developer": None, "rating": 4.5}
+}
+
+class PkgCatalogTest(unittest.TestCase):
+    def test_round_trip(self):
+        catalog = PkgCatalog.from_records(RECORDS)
+
+        self.assertEqual(len(catalog), len(RECORDS))
+        self.assertEqual(list(catalog.keys()), list(RECORDS.keys()))
+        self.assertEqual(dict(catalog), RECORDS)
+        self.assertIn("apt:widgetd", catalog)
+        self.assertNotIn("apt:missing", catalog)
+
+        with self.assertRaises(KeyError):
+            catalog["apt:missing"]
+
+    def test_empty(self):
+        catalog = PkgCatalog.from_records({})
+
+        self.assertEqual(len(catalog), 0)
+        self.assertEqual(dict(catalog), {})
+
+    def test_absent_fields(self):
+        # Fields only some records have aren't added to the others.
+        catalog = PkgCatalog.from_records(RECORDS)
+
+        self.assertNotIn("installed", catalog["apt:frobnicator"])
+        self.assertNotIn("display_name", catalog["fp:org.example.App"])
+        self.assertEqual(catalog["apt:widgetd"], RECORDS["apt:widgetd"])
+
+    def test_scalar_types(self):
+        # True == 1 == 1.0 (and hash the same), they must still be stored as different values.
+        records = {
+            "a": {"value": True, "list": [True, 1, 1.0], "dict": {"x": 1.0}},
+            "b": {"value": 1, "list": [1, 1.0, True], "dict": {"x": True}},
+            "c": {"value": 1.0, "list": [1.0, True, 1], "dict": {"x": 1}},
+            "d": {"value": False, "list": [0, 0.0, False], "dict": {"x": None}}
+        }
+        catalog = PkgCatalog.from_records(records)
+
+        for pkg_hash, record in records.items():
+            loaded = catalog[pkg_hash]
+            self.assertEqual(loaded, record)
+            self.assertIs(type(loaded["value"]), type(record["value"]))
+            self.assertEqual([type(item) for item in loaded["list"]], [type(item) for item in record["list"]])
+            self.assertIs(type(loaded["dict"]["x"]), type(record["dict"]["x"]))
+
+    def test_records_are_copies(self):
+        catalog = PkgCatalog.from_records(RECORDS)
+
+        record = catalog["apt:frobnicator"]
+        record["icon"]["64"] = "changed"
+        record["name"] = "changed"
+
+        self.assertEqual(catalog["apt:frobnicator"], RECORDS["apt:frobnicator"])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,76 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "usr", "lib", "python3", "dist-packages"))
+
+from mintcommon.installer.misc import AppstreamMarkupParser, UnsupportedMarkupError
+
+def convert(markup):
+    return AppstreamMarkupParser().convert(markup)
+
+# What html2text 2024.2.26, set up like misc.html_converter, makes of the same markup.
+class AppstreamMarkupTest(unittest.TestCase):
+    def test_paragraphs(self):
+        self.assertEqual(convert("<p>First</p><p>Second</p>"), "First\n\nSecond\n\n")
+        self.assertEqual(convert("<p>  spaced   out\n text </p>"), "spaced out text\n\n")
+        self.assertEqual(convert("<p>a &amp; b &lt;c&gt;</p>"), "a & b <c>\n\n")
+
+    def test_plain_text(self):
+        # apt descriptions aren't markup, they come out as one paragraph.
+        self.assertEqual(convert("Plain apt description\nwith newlines\n\nand more"),
+                         "Plain apt description with newlines and more\n\n")
+
+    def test_empty(self):
+        self.assertEqual(convert(""), "\n\n")
+        self.assertEqual(convert("<p></p>"), "\n\n")
+
+    def test_em_and_code(self):
+        self.assertEqual(convert("<p>Some <em>emphasis</em> and <code>code</code> here.</p>"),
+                         "Some emphasis and `code` here.\n\n")
+
+    def test_adjacent_lists(self):
+        self.assertEqual(convert("<ul><li>one</li><li>two</li></ul><ol><li>a</li><li>b</li></ol>"),
+                         "  • one\n  • two\n\n  1. a\n  2. b\n\n")
+        self.assertEqual(convert("<ol><li>x</li></ol><ol><li>y</li></ol>"), "  1. x\n\n  1. y\n\n")
+
+    def test_nested_lists(self):
+        self.assertEqual(convert("<ul><li>one<ul><li>inner</li></ul></li><li>two</li></ul>"),
+                         "  • one\n    • inner\n  • two\n\n")
+        self.assertEqual(convert("<ol><li>a<ul><li>b</li></ul></li><li>c<ol><li>d</li></ol></li></ol>"),
+                         "  1. a\n     • b\n  2. c\n    1. d\n\n")
+
+    def test_mixed(self):
+        markup = ("<p>Intro with <em>emphasis</em> and <code>code</code>.</p>"
+                  "<ul><li>one</li><li>two<ul><li>inner</li></ul></li></ul>"
+                  "<ol><li>a</li><li>b<ul><li>nested <code>x</code></li></ul></li></ol>"
+                  "<p>Outro</p>")
+
+        self.assertEqual(convert(markup),
+                         "Intro with emphasis and `code`.\n\n"
+                         "  • one\n  • two\n    • inner\n\n"
+                         "  1. a\n  2. b\n     • nested `x`\n\n"
+                         "Outro\n\n")
+
+    def test_wrapping(self):
+        def words(word, count):
+            return " ".join([word] * count)
+
+        self.assertEqual(convert("<p>%s</p>" % words("word", 30)),
+                         "%s\n%s\n\n" % (words("word", 15), words("word", 15)))
+
+        # Top level bullets wrap under their text, numbered ones don't wrap.
+        self.assertEqual(convert("<ul><li>%s</li></ul>" % words("item", 20)),
+                         "  • %s\n    %s\n\n" % (words("item", 15), words("item", 5)))
+        self.assertEqual(convert("<ol><li>%s</li></ol>" % words("item", 20)),
+                         "  1. %s\n\n" % words("item", 20))
+
+        # Nor do lines that look like a table.
+        self.assertEqual(convert("<p>a | b %s</p>" % words("cell", 20)), "a | b %s\n\n" % words("cell", 20))
+
+    def test_unsupported_markup(self):
+        with self.assertRaises(UnsupportedMarkupError):
+            convert("<p>A <a href='https://example.org'>link</a></p>")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,348 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "usr", "lib", "python3", "dist-packages"))
+
+from mintcommon.installer import cache
+from mintcommon.installer import cachefile
+from mintcommon.installer.catalog import PkgCatalog
+from mintcommon.installer.pkgInfo import AptPkgInfo
+
+APT_NAMES = ("frobnicator", "widgetd")
+
+def make_legacy_payload():
+    # A schema 3 json cache, as saved before the search index existed.
+    records = {}
+    for name in APT_NAMES:
+        pkg_hash = "apt:" + name
+        records[pkg_hash] = {"pkg_hash": pkg_hash, "name": name, "display_name": name.capitalize(),
+                             "summary": "A tool", "icon": {}}
+
+    return {
+        "schema_version": 3,
+        "pkginfo_cache": records,
+        "section_lists": {"utils": list(records.keys())},
+        "flatpak_remote_infos": {}
+    }
+
+class FakeApt():
+    """ Stands in for _apt.process_apt_cache_changes, recording whether each pass was a full one """
+    def __init__(self):
+        self.full_passes = 0
+        self.incremental_passes = 0
+
+    def __call__(self, pkgcache, old_pkg_hashes, old_state):
+        if old_pkg_hashes is not None and old_state is not None:
+            self.incremental_passes += 1
+            return pkgcache, {}, set(old_pkg_hashes), old_state
+
+        self.full_passes += 1
+
+        for name in APT_NAMES:
+            pkginfo = AptPkgInfo("apt:" + name)
+            pkginfo.name = name
+            pkginfo.display_name = name.capitalize()
+            pkginfo.summary = "A tool"
+            pkginfo.raw_description = "Description of the %s package" % name
+            pkgcache[pkginfo.pkg_hash] = pkginfo
+
+        state = {"filters": "test", "fingerprints": {}, "candidates": {}}
+        return pkgcache, {"utils": ["apt:" + name for name in APT_NAMES]}, set(), state
+
+def fake_flatpak(pkgcache, old_shards):
+    return pkgcache, {}, {}, set()
+
+def make_pkginfo(name):
+    pkginfo = AptPkgInfo("apt:" + name)
+    pkginfo.name = name
+    pkginfo.raw_description = "Description of the %s package" % name
+    return pkginfo
+
+class PkgInfoMapTest(unittest.TestCase):
+    def test_take_descriptions_skips_copied_items(self):
+        old_items = cache.PkgInfoMap()
+        old_items["apt:frobnicator"] = make_pkginfo("frobnicator")
+
+        items = cache.PkgInfoMap()
+        items.copy_from(old_items, ["apt:frobnicator"])
+        items["apt:widgetd"] = make_pkginfo("widgetd")
+
+        self.assertEqual(items.take_descriptions(), {"apt:widgetd": "Description of the widgetd package"})
+        self.assertIsNone(items["apt:widgetd"].raw_description)
+        # The copied PkgInfo is still the old map's, it keeps its description.
+        self.assertEqual(old_items["apt:frobnicator"].raw_description, "Description of the frobnicator package")
+
+    def test_compact(self):
+        items = cache.PkgInfoMap()
+        for name in APT_NAMES:
+            items["apt:" + name] = make_pkginfo(name)
+
+        records = {pkg_hash: items.get_record(pkg_hash) for pkg_hash in items}
+        items.compact()
+
+        self.assertEqual(set(items), set(records))
+        self.assertEqual({pkg_hash: items.get_record(pkg_hash) for pkg_hash in items}, records)
+        self.assertTrue(all(isinstance(items._sources[pkg_hash], PkgCatalog) for pkg_hash in items))
+
+        # They're built again from the catalog.
+        pkginfo = items["apt:frobnicator"]
+        self.assertEqual(pkginfo.name, "frobnicator")
+        self.assertIs(items["apt:frobnicator"], pkginfo)
+
+        # Nothing was set since, nothing to do.
+        catalog = items._sources["apt:frobnicator"]
+        items.compact()
+        self.assertIs(items._sources["apt:widgetd"], catalog)
+
+    def test_compact_keeps_used_catalogs(self):
+        old_items = cache.PkgInfoMap()
+        for i in range(8):
+            old_items["apt:pkg%d" % i] = make_pkginfo("pkg%d" % i)
+        old_items.compact()
+        old_catalog = old_items._sources["apt:pkg0"]
+
+        # One dead row for seven live ones, the old catalog is still worth keeping.
+        items = cache.PkgInfoMap()
+        items.copy_from(old_items, ["apt:pkg%d" % i for i in range(7)])
+        items["apt:new"] = make_pkginfo("new")
+        items.compact()
+
+        self.assertIs(items._sources["apt:pkg0"], old_catalog)
+        self.assertIsNot(items._sources["apt:new"], old_catalog)
+        self.assertEqual(len(items._sources["apt:new"]), 1)
+        self.assertEqual(items["apt:new"].name, "new")
+
+    def test_compact_drops_unused_catalog_rows(self):
+        old_items = cache.PkgInfoMap()
+        for i in range(8):
+            old_items["apt:pkg%d" % i] = make_pkginfo("pkg%d" % i)
+        old_items.compact()
+
+        # Six of the old catalog's rows aren't used any more, the two carried
+        # over items are moved to the new catalog.
+        items = cache.PkgInfoMap()
+        items.copy_from(old_items, ["apt:pkg0", "apt:pkg1"])
+        items["apt:new"] = make_pkginfo("new")
+        records = {pkg_hash: items.get_record(pkg_hash) for pkg_hash in items}
+        items.compact()
+
+        catalog = items._sources["apt:new"]
+        self.assertEqual(len(catalog), 3)
+        self.assertTrue(all(items._sources[pkg_hash] is catalog for pkg_hash in items))
+        self.assertEqual({pkg_hash: items.get_record(pkg_hash) for pkg_hash in items}, records)
+
+        # The old map still has everything.
+        self.assertEqual(len(old_items), 8)
+        self.assertEqual(old_items["apt:pkg5"].name, "pkg5")
+
+def make_flatpak_record(remote, name):
+    refid = "app/%s/x86_64/stable" % name
+    return {"pkg_hash": "fp:%s:%s" % (remote, refid), "name": name, "refid": refid, "remote": remote}
+
+def make_records(*records):
+    return {record["pkg_hash"]: record for record in records}
+
+class CacheIndexesTest(unittest.TestCase):
+    def setUp(self):
+        self.flathub_app = make_flatpak_record("flathub", "org.example.App")
+        self.other_app = make_flatpak_record("other", "org.example.App")
+        self.flathub_tool = make_flatpak_record("flathub", "org.example.Tool")
+
+        self.apt_record = {"pkg_hash": "apt:frobnicator", "name": "frobnicator"}
+        self.items = cache.PkgInfoMap(make_records(self.apt_record, self.flathub_app, self.other_app, self.flathub_tool))
+
+    def test_build(self):
+        indexes = cache.CacheIndexes.build(self.items)
+
+        self.assertEqual(indexes.by_type, {"a": ["apt:frobnicator"],
+                                           "f": [self.flathub_app["pkg_hash"], self.other_app["pkg_hash"], self.flathub_tool["pkg_hash"]]})
+        self.assertEqual(indexes.by_name, {"org.example.App": [self.flathub_app["pkg_hash"], self.other_app["pkg_hash"]],
+                                           "org.example.Tool": [self.flathub_tool["pkg_hash"]]})
+        self.assertEqual(indexes.by_refid[self.flathub_app["refid"]], [self.flathub_app["pkg_hash"], self.other_app["pkg_hash"]])
+        self.assertEqual(indexes.by_remote, {"flathub": [self.flathub_app["pkg_hash"], self.flathub_tool["pkg_hash"]],
+                                             "other": [self.other_app["pkg_hash"]]})
+
+        # Apt names aren't indexed, their pkg_hashes are made from them.
+        self.assertNotIn("frobnicator", indexes.by_name)
+
+    def test_empty(self):
+        indexes = cache.CacheIndexes.build(cache.PkgInfoMap({}))
+        self.assertEqual((indexes.by_type, indexes.by_name, indexes.by_refid, indexes.by_remote), ({}, {}, {}, {}))
+
+    def test_json_round_trip(self):
+        indexes = cache.CacheIndexes.build(self.items)
+        loaded = cache.CacheIndexes.from_json(json.loads(json.dumps(indexes.to_json())), self.items)
+
+        for table in cache.CacheIndexes.__slots__:
+            self.assertEqual(getattr(loaded, table), getattr(indexes, table))
+
+    def test_with_item_set(self):
+        indexes = cache.CacheIndexes.build(self.items)
+
+        moved_tool = dict(self.flathub_tool, name="org.example.Renamed")
+        new_items = cache.PkgInfoMap(make_records(self.apt_record, self.flathub_app, self.other_app, moved_tool))
+        updated = indexes.with_item_set(self.items, new_items, moved_tool["pkg_hash"])
+
+        self.assertNotIn("org.example.Tool", updated.by_name)
+        self.assertEqual(updated.by_name["org.example.Renamed"], [moved_tool["pkg_hash"]])
+        self.assertEqual(updated.by_remote["flathub"], [self.flathub_app["pkg_hash"], moved_tool["pkg_hash"]])
+        self.assertEqual(updated.by_type["f"].count(moved_tool["pkg_hash"]), 1)
+
+        # The indexes it was made from are left as they were.
+        self.assertEqual(indexes.by_name["org.example.Tool"], [self.flathub_tool["pkg_hash"]])
+        self.assertEqual(indexes.by_remote["flathub"], [self.flathub_app["pkg_hash"], self.flathub_tool["pkg_hash"]])
+
+    def test_with_new_item_set(self):
+        indexes = cache.CacheIndexes.build(self.items)
+        old_by_type_f = list(indexes.by_type["f"])
+
+        new_app = make_flatpak_record("other", "org.example.New")
+        new_items = cache.PkgInfoMap(make_records(self.apt_record, self.flathub_app, self.other_app, self.flathub_tool, new_app))
+        updated = indexes.with_item_set(self.items, new_items, new_app["pkg_hash"])
+
+        self.assertEqual(updated.by_remote["other"], [self.other_app["pkg_hash"], new_app["pkg_hash"]])
+        self.assertEqual(updated.by_type["f"], old_by_type_f + [new_app["pkg_hash"]])
+        self.assertEqual(indexes.by_remote["other"], [self.other_app["pkg_hash"]])
+        self.assertEqual(indexes.by_type["f"], old_by_type_f)
+
+    def test_with_item_removed(self):
+        indexes = cache.CacheIndexes.build(self.items)
+        updated = indexes.with_item_removed(self.items, self.other_app["pkg_hash"])
+
+        self.assertNotIn("other", updated.by_remote)
+        self.assertEqual(updated.by_name["org.example.App"], [self.flathub_app["pkg_hash"]])
+        self.assertEqual(indexes.by_name["org.example.App"], [self.flathub_app["pkg_hash"], self.other_app["pkg_hash"]])
+
+        updated = updated.with_item_removed(self.items, "apt:frobnicator")
+        self.assertNotIn("a", updated.by_type)
+        self.assertIn("a", indexes.by_type)
+
+class MigrationTest(unittest.TestCase):
+    def test_from_legacy_json(self):
+        payload = make_legacy_payload()
+        cache.migrate_payload(payload)
+
+        self.assertEqual(payload["schema_version"], cache.CACHE_SCHEMA_VERSION)
+        self.assertEqual(payload["flatpak_shards"], {})
+        self.assertEqual(payload["indexes"]["by_name"], {})
+
+        json_obj = cache.JsonObject.from_json(payload)
+        self.assertEqual(set(json_obj.pkginfo_cache), {"apt:" + name for name in APT_NAMES})
+        self.assertEqual(sorted(json_obj.indexes.by_type["a"]), sorted("apt:" + name for name in APT_NAMES))
+
+    def test_from_legacy_binary(self):
+        # Migrations must work with lazily decoded, read-only records too.
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        path = os.path.join(tmp_dir, "pkginfo.bin")
+
+        payload = make_legacy_payload()
+        payload["pkginfo_cache"]["fp:flathub:app/org.example.App/x86_64/stable"] = make_flatpak_record("flathub", "org.example.App")
+
+        with open(path, "wb") as f:
+            cachefile.save(f, payload, cache.CACHE_RECORDS_KEY)
+
+        loaded = cachefile.load(path, cache.CACHE_RECORDS_KEY)
+        self.assertEqual(loaded["schema_version"], 3)
+
+        cache.migrate_payload(loaded)
+        self.assertEqual(loaded["schema_version"], cache.CACHE_SCHEMA_VERSION)
+        self.assertEqual(loaded["indexes"]["by_remote"], {"flathub": ["fp:flathub:app/org.example.App/x86_64/stable"]})
+
+    def test_current_version(self):
+        payload = {"schema_version": cache.CACHE_SCHEMA_VERSION, "pkginfo_cache": {}}
+        cache.migrate_payload(payload)
+        self.assertEqual(payload, {"schema_version": cache.CACHE_SCHEMA_VERSION, "pkginfo_cache": {}})
+
+    def test_no_migration_path(self):
+        for version in (0, 2, cache.CACHE_SCHEMA_VERSION + 1):
+            with self.assertRaises(cache.CacheMigrationError):
+                cache.migrate_payload({"schema_version": version, "pkginfo_cache": {}})
+
+        # A cache that can't be migrated is regenerated.
+        self.assertIsNone(cache.JsonObject.from_json({"schema_version": 2, "pkginfo_cache": {}}))
+
+    def test_failed_migration(self):
+        # A record the migration can't index, a flatpak one without a name.
+        payload = make_legacy_payload()
+        payload["pkginfo_cache"]["fp:flathub:broken"] = {"pkg_hash": "fp:flathub:broken"}
+
+        with self.assertRaises(cache.CacheMigrationError):
+            cache.migrate_payload(payload)
+
+class MigratedCacheRefreshTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+        legacy_path = os.path.join(self.tmp_dir, "pkginfo.json")
+        with open(legacy_path, "w") as f:
+            json.dump(make_legacy_payload(), f)
+
+        for name, value in (("SYS_CACHE_PATH", os.path.join(self.tmp_dir, "pkginfo.bin")),
+                            ("USER_CACHE_PATH", os.path.join(self.tmp_dir, "user", "pkginfo.bin")),
+                            ("LEGACY_SYS_CACHE_PATH", legacy_path),
+                            ("LEGACY_USER_CACHE_PATH", os.path.join(self.tmp_dir, "user", "pkginfo.json"))):
+            patcher = mock.patch.object(cache, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+        self.apt = FakeApt()
+
+        for patcher in (mock.patch.object(cache._apt, "process_apt_cache_changes", self.apt),
+                        mock.patch.object(cache._flatpak, "process_flatpak_installation_changes", fake_flatpak)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_flatpak_refresh_then_apt_regeneration(self):
+        pkgcache = cache.PkgCache(None, have_flatpak=True)
+        self.assertEqual(pkgcache.status, pkgcache.STATUS_OK)
+
+        # The migrated cache has no search index, so the apt items can't be carried over
+        # by a flatpak refresh, they need to be described again.
+        pkgcache.force_new_cache("f")
+        self.assertEqual(self.apt.full_passes, 1)
+        self.assertEqual(self.apt.incremental_passes, 0)
+        self.assertEqual([pkginfo.name for pkginfo in pkgcache.search("frobnicator package")], ["frobnicator"])
+
+        # What was saved describes every item, so the next process can regenerate incrementally.
+        pkgcache = cache.PkgCache(None, have_flatpak=True)
+        pkgcache.force_new_cache("a")
+        self.assertEqual(self.apt.full_passes, 1)
+        self.assertEqual(self.apt.incremental_passes, 1)
+        self.assertEqual([pkginfo.name for pkginfo in pkgcache.search("widgetd package")], ["widgetd"])
+
+    def test_search_index_for_other_items_is_ignored(self):
+        # An index left next to the migrated cache, that doesn't know about its items.
+        stale_index = cache.search.SearchIndex.build(cache.PkgInfoMap(), {})
+        with open(os.path.join(self.tmp_dir, "pkginfo-search.json"), "w") as f:
+            json.dump(stale_index.to_json(), f)
+
+        pkgcache = cache.PkgCache(None, have_flatpak=True)
+        pkgcache.force_new_cache("f")
+
+        self.assertEqual(self.apt.full_passes, 1)
+        self.assertEqual([pkginfo.name for pkginfo in pkgcache.search("frobnicator package")], ["frobnicator"])
+
+    def test_partial_search_index_is_not_saved(self):
+        pkgcache = cache.PkgCache(None, have_flatpak=True)
+
+        with mock.patch.object(pkgcache, "_update_search_index",
+                               lambda items, carried: (cache.search.SearchIndex.build(items, {}), False)):
+            pkgcache.force_new_cache("f")
+
+        self.assertFalse(os.path.exists(os.path.join(self.tmp_dir, "pkginfo-search.bin")))
+
+        # Nothing is carried over without a complete index, apt is fully processed again.
+        pkgcache = cache.PkgCache(None, have_flatpak=True)
+        pkgcache.force_new_cache("a")
+        self.assertEqual(self.apt.full_passes, 2)
+        self.assertEqual(self.apt.incremental_passes, 0)
+
+if __name__ == "__main__":
+    unittest.main()
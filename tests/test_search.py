@@ -0,0 +1,142 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "usr", "lib", "python3", "dist-packages"))
+
+from mintcommon.installer import cachefile
+from mintcommon.installer import search
+from mintcommon.installer.cache import PkgInfoMap
+from mintcommon.installer.search import SearchIndex
+
+def make_record(name, display_name, summary, keywords=None):
+    return {"pkg_hash": "apt:" + name, "name": name, "display_name": display_name,
+            "summary": summary, "keywords": keywords, "icon": {}}
+
+def make_items(*records):
+    return PkgInfoMap({record["pkg_hash"]: record for record in records})
+
+FIREFOX = make_record("firefox", "Firefox", "The Firefox web browser from Mozilla")
+FIREFOX_L10N = make_record("firefox-locale-fr", "Firefox French", "French language pack")
+GIMP = make_record("gimp", "GIMP", "GNU Image Manipulation Program", "photo;paint")
+INKSCAPE = make_record("inkscape", "Inkscape", "Vector graphics editor")
+
+DESCRIPTIONS = {
+    "apt:firefox": "<p>Firefox is a <em>fast</em> browser.</p>",
+    "apt:gimp": "Edit photos and images",
+    "apt:inkscape": "An editor for scalable graphics, like the ones browsers show"
+}
+
+class TokenizeTest(unittest.TestCase):
+    def test_tokenize(self):
+        self.assertEqual(search.tokenize("The GNU Image-Manipulation <em>Program</em>, v2"),
+                         ["gnu", "image", "manipulation", "program", "v2"])
+        self.assertEqual(search.tokenize(""), [])
+
+class SearchIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.items = make_items(FIREFOX, FIREFOX_L10N, GIMP, INKSCAPE)
+        self.index = SearchIndex.build(self.items, DESCRIPTIONS)
+
+    def test_build(self):
+        self.assertEqual(self.index.documents, list(self.items.keys()))
+        self.assertEqual(SearchIndex.build(make_items(), {}).search("firefox"), [])
+
+    def test_search(self):
+        # The name weighs more than the summary.
+        self.assertEqual(self.index.search("firefox"), ["apt:firefox", "apt:firefox-locale-fr"])
+        self.assertEqual(self.index.search("graphics"), ["apt:inkscape"])
+        self.assertEqual(self.index.search("photo"), ["apt:gimp"])
+        # Only the descriptions that were given are indexed.
+        self.assertEqual(self.index.search("fast"), ["apt:firefox"])
+        self.assertEqual(self.index.search("french pack"), ["apt:firefox-locale-fr"])
+        self.assertEqual(self.index.search("french gimp"), [])
+        self.assertEqual(self.index.search("the"), [])
+        self.assertEqual(self.index.search(""), [])
+
+    def test_prefix_search(self):
+        # Only the last word is completed.
+        self.assertEqual(self.index.search("firef"), ["apt:firefox", "apt:firefox-locale-fr"])
+        self.assertEqual(self.index.search("firef french"), [])
+        self.assertEqual(self.index.search("vector gra"), ["apt:inkscape"])
+        self.assertEqual(self.index.search("zz"), [])
+
+        # A completed word counts for less than an exact one: "browser" is in
+        # firefox's summary, inkscape only has "browsers" in its description.
+        self.assertEqual(self.index.search("browser"), ["apt:firefox", "apt:inkscape"])
+        self.assertEqual(self.index.search("browser graphics"), [])
+        self.assertEqual(self.index.search("graphics browser"), ["apt:inkscape"])
+
+    def test_update(self):
+        firefox = make_record("firefox", "Firefox", "Web browser")
+        vlc = make_record("vlc", "VLC", "Multimedia player")
+        items = make_items(firefox, FIREFOX_L10N, GIMP, INKSCAPE, vlc)
+
+        # Firefox was regenerated (it's described again), vlc is new.
+        index = SearchIndex.update(self.index, items, {"apt:firefox": "Browse the web", "apt:vlc": "Plays videos"})
+
+        self.assertEqual(index.documents, ["", "apt:firefox-locale-fr", "apt:gimp", "apt:inkscape", "apt:firefox", "apt:vlc"])
+        self.assertEqual(index.search("firefox"), ["apt:firefox", "apt:firefox-locale-fr"])
+        self.assertEqual(index.search("mozilla"), [])
+        self.assertEqual(index.search("videos"), ["apt:vlc"])
+        # What wasn't regenerated keeps its description.
+        self.assertEqual(index.search("photos"), ["apt:gimp"])
+
+        # The old index is left as it was.
+        self.assertEqual(self.index.search("mozilla"), ["apt:firefox"])
+        self.assertEqual(self.index.search("videos"), [])
+
+    def test_update_drops_removed_items(self):
+        items = make_items(FIREFOX, FIREFOX_L10N, GIMP, INKSCAPE, make_record("vlc", "VLC", "Multimedia player"))
+        index = SearchIndex.update(self.index, items, {})
+
+        items = make_items(FIREFOX, GIMP, INKSCAPE, make_record("vlc", "VLC", "Multimedia player"))
+        index = SearchIndex.update(index, items, {})
+
+        self.assertEqual(index.documents, ["apt:firefox", "", "apt:gimp", "apt:inkscape", "apt:vlc"])
+        self.assertEqual(index.search("firefox"), ["apt:firefox"])
+        self.assertEqual(index.search("french"), [])
+
+    def test_update_rebuilds_when_too_many_are_dropped(self):
+        items = make_items(GIMP, INKSCAPE)
+        index = SearchIndex.update(self.index, items, {})
+
+        # The tombstones for firefox's two packages are too many, they're gone.
+        self.assertEqual(index.documents, ["apt:gimp", "apt:inkscape"])
+        self.assertEqual(index.search("firefox"), [])
+        # A rebuilt index only has the descriptions it was given.
+        self.assertEqual(index.search("photos"), [])
+        self.assertEqual(index.search("vector"), ["apt:inkscape"])
+
+    def test_round_trip(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+
+        for binary in (True, False):
+            path = os.path.join(tmp_dir, "pkginfo-search")
+
+            with open(path, "wb" if binary else "w") as f:
+                cachefile.save(f, self.index.to_json(), search.SEARCH_RECORDS_KEY, binary=binary)
+
+            index = SearchIndex.from_json(cachefile.load(path, search.SEARCH_RECORDS_KEY))
+
+            self.assertEqual(index.documents, self.index.documents)
+            self.assertEqual(index.search("firef"), ["apt:firefox", "apt:firefox-locale-fr"])
+            self.assertEqual(index.search("photos"), ["apt:gimp"])
+
+            # Loaded postings are reused, but never changed in place.
+            items = make_items(FIREFOX, FIREFOX_L10N, GIMP, INKSCAPE, make_record("gimp-plugins", "GIMP plugins", "Plugins for the image editor"))
+            updated = SearchIndex.update(index, items, {})
+            self.assertEqual(updated.search("gimp"), ["apt:gimp", "apt:gimp-plugins"])
+            self.assertEqual(index.search("gimp"), ["apt:gimp"])
+
+    def test_unknown_version(self):
+        json_data = self.index.to_json()
+        json_data["schema_version"] = search.SEARCH_INDEX_VERSION + 1
+
+        self.assertIsNone(SearchIndex.from_json(json_data))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,6 +1,11 @@
 import time
 import threading
+import os
+import gzip
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import apt
+import apt_pkg
 
 import gi
 gi.require_version('Gtk', '3.0')
@@ -12,9 +17,10 @@ from gi.repository import PackageKitGlib as packagekit
 
 from aptkit.gtk3widgets import AptProgressDialog
 
-from .pkgInfo import AptPkgInfo
+from .pkgInfo import AptPkgInfo, AptIconIndex
+from .apt_filters import PackageFilter
 from .dialogs import ChangesConfirmDialog
-from .misc import check_ml, warn, debug
+from .misc import check_ml, warn, debug, get_file_fingerprint
 from . import dialogs
 
 # List extra packages that aren't necessarily marked in their control files, but
@@ -27,15 +33,49 @@ def capitalize(string):
 
     return (string)
 
+APT_LISTS_DIR = "/var/lib/apt/lists"
+APT_PREFERENCES_PATH = "/etc/apt/preferences"
+APT_PREFERENCES_DIR = "/etc/apt/preferences.d"
+DPKG_STATUS_PATH = "/var/lib/dpkg/status"
+APT_EXTENDED_STATES_PATH = "/var/lib/apt/extended_states"
+# Currently only Ubiquity's list is known.
+INSTALLER_STATUS_LOG_PATH = "/var/log/installer/initial-status.gz"
+
+# dpkg states in which a package has an installed version
+DPKG_INSTALLED_STATES = ("installed", "half-configured", "unpacked", "half-installed",
+                         "triggers-awaited", "triggers-pending")
+
+# Threads running simulations for package pages, and how many results to keep.
+SIMULATION_WORKERS = 2
+SIMULATION_CACHE_SIZE = 64
+
 _apt_cache = None
 _apt_cache_lock = threading.Lock()
+# Set when packages were installed or removed, the cache is reopened the next time it's needed.
+_apt_cache_dirty = False
+# Bumped along with _apt_cache_dirty, see get_apt_cache_generation()
+_apt_cache_generation = 0
+
+# (dpkg status fingerprint, installed package names)
+_installed_snapshot = None
+_installed_snapshot_lock = threading.Lock()
+# The installed packages as of the last sync_cache_installed_states()
+_synced_snapshot = None
 
 def get_apt_cache(full=False):
     global _apt_cache
+    global _apt_cache_dirty
 
     if full or (not _apt_cache):
         with _apt_cache_lock:
             _apt_cache = apt.Cache()
+            _apt_cache_dirty = False
+    elif _apt_cache_dirty:
+        with _apt_cache_lock:
+            if _apt_cache_dirty:
+                # Much cheaper than a new apt.Cache, the object is kept.
+                _apt_cache.open(None)
+                _apt_cache_dirty = False
 
     return _apt_cache
 
@@ -55,79 +95,360 @@ def make_pkg_hash(apt_pkg):
 
     return add_prefix(apt_pkg.name)
 
-def process_full_apt_cache(cache):
-    apt_time = time.time()
-    apt_cache = get_apt_cache()
+def _add_to_sections(sections, section_string, pkg_hash):
+    if "/" in section_string:
+        section = section_string.split("/")[1]
+    else:
+        section = section_string
 
-    sections = {}
+    sections.setdefault(section, []).append(pkg_hash)
 
-    keys = apt_cache.keys()
+def _format_long_description(long_desc):
+    # Same as apt.package.Version.description: drop the summary line and
+    # unfold the control file's paragraph formatting.
+    desc = ""
+    lines = iter(long_desc.split("\n"))
 
-    for key in keys:
-        name = apt_cache[key].name
-        pkg = apt_cache[key]
+    # Skip the first line, it's the summary
+    next(lines, None)
 
-        if name.startswith("lib") and not name.startswith(("libreoffice", "librecad", "librewolf", "libk3b7", "libimage-exiftool-perl")):
-            continue
-        if name.endswith(":i386") and name != "steam:i386":
-            continue
-        if name.endswith("-dev"):
-            continue
-        if name.endswith("-dbg"):
-            continue
-        if name.endswith("-doc"):
-            continue
-        if name.endswith("-common"):
-            continue
-        if name.endswith("-data"):
-            continue
-        if "-locale-" in name:
-            continue
-        if "-l10n-" in name:
-            continue
-        if name.endswith("-dbgsym"):
-            continue
-        if name.endswith("l10n"):
+    for raw_line in lines:
+        if raw_line.strip() == ".":
+            # Paragraph break
+            if not desc.endswith("\n"):
+                desc += "\n\n"
             continue
-        if name.endswith("-perl"):
-            continue
-        if name == "snapd":
-            continue
-        if name == "pepperflashplugin-nonfree": # formerly marked broken, it's now a dummy and has no dependents (and only exists in Mint 20).
-            continue
-        if pkg.candidate is None:
-            continue
-        # kernel, universe/kernel, multiverse/kernel, restricted/kernel
-        if pkg.candidate.section.endswith("kernel"):
+
+        if raw_line.startswith("  "):
+            # Displayed verbatim
+            if not desc.endswith("\n"):
+                line = "\n%s\n" % raw_line[2:]
+            else:
+                line = "%s\n" % raw_line[2:]
+        elif raw_line.startswith(" "):
+            # Part of a paragraph
+            if desc.endswith("\n") or desc == "":
+                line = raw_line[1:]
+            else:
+                line = raw_line
+        else:
+            line = raw_line
+
+        desc += line
+
+    return desc
+
+def _lookup_candidate_record(records, candidate):
+    # Points records at the candidate's (translated if possible) description.
+    description = candidate.translated_description
+
+    if description is not None and description.file_list:
+        return records.lookup(description.file_list[0])
+
+    if candidate.file_list:
+        return records.lookup(candidate.file_list[0])
+
+    return False
+
+def _add_apt_pkg_to_cache(cache, sections, name, candidate, records, names, package_filter, icon_index=None):
+    # Adds the candidate's package, reading it straight from the apt_pkg cache and records.
+    section = candidate.section or ""
+
+    # Everything but the summary can be checked without reading the records.
+    if package_filter.excludes_package(name, section, names):
+        return False
+
+    try:
+        if not _lookup_candidate_record(records, candidate):
+            return False
+
+        summary = records.short_desc
+        long_desc = records.long_desc
+    except Exception as e:
+        warn("Problem parsing package (maybe it's virtual): %s: %s" % (name, e))
+        return False
+
+    if package_filter.excludes_summary(summary):
+        return False
+
+    pkg_hash = add_prefix(name)
+    _add_to_sections(sections, section, pkg_hash)
+
+    cache[pkg_hash] = AptPkgInfo.from_candidate_record(pkg_hash, name, summary,
+                                                       _format_long_description(long_desc or ""),
+                                                       icon_index)
+
+    return True
+
+def _get_apt_packages(apt_cache):
+    # Returns the set of names of all real packages, and a (name, candidate)
+    # list of those that have a candidate.
+    depcache = apt_cache._depcache
+    names = set()
+    packages = []
+
+    for pkg in apt_cache._cache.packages:
+        if not pkg.has_versions:
             continue
-        if name.startswith(("linux-headers-", "linux-tools-")):
+
+        name = pkg.get_fullname(True)
+        names.add(name)
+
+        candidate = depcache.get_candidate_ver(pkg)
+        if candidate is not None:
+            packages.append((name, candidate))
+
+    return names, packages
+
+def process_full_apt_cache(cache):
+    cache, sections, kept, state = process_apt_cache_changes(cache, None, None)
+    return cache, sections
+
+def get_apt_fingerprints():
+    """
+    Returns a path: fingerprint dict for all the files that can change the
+    packages (or their candidates) in the apt cache.
+    """
+    paths = [DPKG_STATUS_PATH, APT_PREFERENCES_PATH]
+
+    for dir_path in (APT_LISTS_DIR, APT_PREFERENCES_DIR):
+        try:
+            with os.scandir(dir_path) as it:
+                for entry in it:
+                    if entry.name != "lock" and entry.is_file():
+                        paths.append(entry.path)
+        except OSError:
+            pass
+
+    fingerprints = {}
+
+    for path in paths:
+        fingerprint = get_file_fingerprint(path)
+        if fingerprint is not None:
+            fingerprints[path] = fingerprint
+
+    return fingerprints
+
+def _is_translation_file(path):
+    # apt's Translation-* index files, where the translated descriptions come from.
+    return "_i18n_Translation-" in os.path.basename(path)
+
+def _get_description_languages():
+    # What apt picks translated descriptions by: its configuration, and the locale
+    # for "environment" (the default).
+    languages = [apt_pkg.config.find("Acquire::Languages")] + apt_pkg.config.value_list("Acquire::Languages")
+
+    return languages + [os.getenv(name, "") for name in ("LANGUAGE", "LC_ALL", "LC_MESSAGES", "LANG")]
+
+def _description_changed(candidate, changed_files):
+    description = candidate.translated_description
+
+    if description is None:
+        return False
+
+    return any(package_file.filename in changed_files for package_file, index in description.file_list)
+
+def _iter_control_paragraphs(f, fields):
+    # Yields a dict of the given fields for each paragraph of a dpkg-style
+    # control file, much faster than going through the apt cache.
+    paragraph = {}
+
+    for line in f:
+        if line == "\n":
+            if paragraph:
+                yield paragraph
+                paragraph = {}
             continue
-        if ":" in name and name.split(":")[0] in keys:
+
+        if line[0] in " \t":
             continue
-        try:
-            if "transitional" in pkg.candidate.summary.lower():
+
+        key, sep, value = line.partition(":")
+        if sep and key in fields:
+            paragraph[key] = value.strip()
+
+    if paragraph:
+        yield paragraph
+
+def get_initial_status_packages():
+    """
+    Returns the names of the packages installed by the OS installer, or None
+    if that's not known.
+    """
+    if not os.path.isfile(INSTALLER_STATUS_LOG_PATH):
+        return None
+
+    try:
+        with gzip.open(INSTALLER_STATUS_LOG_PATH, "rt", encoding="utf-8") as f:
+            return [paragraph["Package"] for paragraph in _iter_control_paragraphs(f, ("Package",))
+                        if "Package" in paragraph]
+    except Exception as e:
+        # There are a number of different exceptions here, but there's only one response
+        warn("Could not get initial installed packages list (check %s): %s" % (INSTALLER_STATUS_LOG_PATH, str(e)))
+        return None
+
+def get_manually_installed_names():
+    """
+    Returns a name: shortname dict of the installed packages that weren't installed
+    automatically, read from the dpkg status and apt's extended states. Names of
+    packages of a foreign architecture are qualified with it, like the apt cache's.
+    """
+    native_arch = apt_pkg.get_architectures()[0]
+    auto_installed = set()
+
+    try:
+        with open(APT_EXTENDED_STATES_PATH, "r", encoding="utf-8") as f:
+            for paragraph in _iter_control_paragraphs(f, ("Package", "Architecture", "Auto-Installed")):
+                if paragraph.get("Auto-Installed") == "1":
+                    auto_installed.add((paragraph.get("Package"), paragraph.get("Architecture")))
+    except OSError:
+        pass
+
+    names = {}
+
+    for name, shortname, arch in _iter_installed_packages(native_arch):
+        # apt records architecture-independent packages under the native architecture.
+        if (shortname, native_arch if arch == "all" else arch) not in auto_installed:
+            names[name] = shortname
+
+    return dict(sorted(names.items()))
+
+def _iter_installed_packages(native_arch):
+    # Yields (name, shortname, architecture) for each installed package in the dpkg
+    # status. names are qualified with the architecture if it's a foreign one, like
+    # the apt cache's.
+    with open(DPKG_STATUS_PATH, "r", encoding="utf-8") as f:
+        for paragraph in _iter_control_paragraphs(f, ("Package", "Architecture", "Status")):
+            try:
+                shortname = paragraph["Package"]
+                arch = paragraph["Architecture"]
+                state = paragraph["Status"].split()[-1]
+            except (KeyError, IndexError):
                 continue
-        except Exception as e:
-            warn("Problem parsing package (maybe it's virtual): %s: %s" % (name, e))
-            continue
-            # pass
 
-        pkg_hash = make_pkg_hash(pkg)
+            if state not in DPKG_INSTALLED_STATES:
+                continue
 
-        section_string = pkg.candidate.section
+            if arch in (native_arch, "all"):
+                yield shortname, shortname, arch
+            else:
+                yield "%s:%s" % (shortname, arch), shortname, arch
 
-        if "/" in section_string:
-            section = section_string.split("/")[1]
-        else:
-            section = section_string
+def get_installed_snapshot():
+    """
+    Returns a frozenset of the names of the installed packages. It's read from the
+    dpkg status in one go, and only read again once that has changed.
+    """
+    global _installed_snapshot
+    global _synced_snapshot
 
-        sections.setdefault(section, []).append(pkg_hash)
+    fingerprint = get_file_fingerprint(DPKG_STATUS_PATH)
 
-        cache[pkg_hash] = AptPkgInfo(pkg_hash, pkg)
+    with _installed_snapshot_lock:
+        if _installed_snapshot is not None and _installed_snapshot[0] == fingerprint:
+            return _installed_snapshot[1]
 
-    debug('Installer: Processing APT packages for cache took %0.3f ms' % ((time.time() - apt_time) * 1000.0))
+        try:
+            names = frozenset(name for name, shortname, arch in _iter_installed_packages(apt_pkg.get_architectures()[0]))
+        except OSError as e:
+            warn("Could not read the installed packages from %s: %s" % (DPKG_STATUS_PATH, e))
+            return frozenset()
+
+        debug("Installer: read %d installed apt packages" % len(names))
+
+        _installed_snapshot = (fingerprint, names)
+        if _synced_snapshot is None:
+            _synced_snapshot = names
+
+        return names
+
+def process_apt_cache_changes(cache, old_pkg_hashes, old_state):
+    """
+    Adds apt packages to cache. If old_state (as returned from a previous call) and
+    the pkg_hashes that were cached along with it are given, only packages whose
+    candidate has changed, or that come from an index file that changed since then
+    are processed (its Packages file, or the Translation file its description is read
+    from). Everything is processed again when the filter rules or apt's languages have
+    changed, or a Translation file went away.
+
+    Returns the cache, sections for the processed packages, the set of old_pkg_hashes
+    that are still valid, and the new state to save.
+    """
+    apt_time = time.time()
+    apt_cache = get_apt_cache()
 
-    return cache, sections
+    sections = {}
+    kept = set()
+
+    fingerprints = get_apt_fingerprints()
+    candidates = {}
+
+    package_filter = PackageFilter.load()
+    languages = _get_description_languages()
+
+    incremental = old_state is not None and old_pkg_hashes is not None and \
+        old_state.get("filters") == package_filter.fingerprint and \
+        old_state.get("languages") == languages
+
+    if incremental:
+        old_fingerprints = old_state["fingerprints"]
+        old_candidates = old_state["candidates"]
+
+        changed_files = set()
+        for path in set(old_fingerprints.keys()) | set(fingerprints.keys()):
+            if old_fingerprints.get(path) != fingerprints.get(path):
+                changed_files.add(path)
+
+        debug("Installer: apt index files changed since last cache: %d" % len(changed_files))
+
+        if not changed_files:
+            kept = set(old_pkg_hashes)
+            return cache, sections, kept, {"fingerprints": fingerprints, "candidates": old_candidates,
+                                           "filters": package_filter.fingerprint, "languages": languages}
+
+        translations_changed = any(_is_translation_file(path) for path in changed_files)
+
+        # The packages that were described by one can't be told apart anymore.
+        if any(_is_translation_file(path) and path not in fingerprints for path in changed_files):
+            debug("Installer: apt translation files were removed, processing all packages")
+            incremental = False
+
+    # Work with the low-level cache, building apt.Package objects for every
+    # package is several times slower.
+    names, packages = _get_apt_packages(apt_cache)
+
+    for name, candidate in packages:
+        candidates[name] = candidate.ver_str
+
+    if not incremental:
+        to_process = packages
+    else:
+        to_process = []
+
+        for name, candidate in packages:
+            if old_candidates.get(name) == candidate.ver_str and \
+              not any(package_file.filename in changed_files for package_file, index in candidate.file_list) and \
+              not (translations_changed and _description_changed(candidate, changed_files)):
+                pkg_hash = add_prefix(name)
+                if pkg_hash in old_pkg_hashes:
+                    kept.add(pkg_hash)
+                continue
+
+            to_process.append((name, candidate))
+
+    if to_process:
+        icon_index = AptIconIndex.get_current()
+        # Our own records, apt_cache's are used by the UI.
+        records = apt_pkg.PackageRecords(apt_cache._cache)
+
+        for name, candidate in to_process:
+            _add_apt_pkg_to_cache(cache, sections, name, candidate, records, names, package_filter, icon_index)
+
+    debug('Installer: Processing %d of %d APT packages for cache took %0.3f ms' % (len(to_process), len(packages), (time.time() - apt_time) * 1000.0))
+    package_filter.print_report()
+
+    return cache, sections, kept, {"fingerprints": fingerprints, "candidates": candidates,
+                                   "filters": package_filter.fingerprint, "languages": languages}
 
 def search_for_pkginfo_apt_pkg(pkginfo):
     name = pkginfo.name
@@ -140,22 +461,464 @@ def search_for_pkginfo_apt_pkg(pkginfo):
         return None
 
 def pkginfo_is_installed(pkginfo):
+    return pkginfo.name in get_installed_snapshot()
+
+def sync_cache_installed_states():
+    """
+    Updates the installed states after packages were installed or removed, and
+    returns the pkg_hashes of the packages whose installed state changed since
+    the last call (or since the installed packages were first read).
+    """
+    global _synced_snapshot
+    global _apt_cache_dirty
+    global _apt_cache_generation
+
+    old_snapshot = _synced_snapshot
+    new_snapshot = get_installed_snapshot()
+
+    with _installed_snapshot_lock:
+        _synced_snapshot = new_snapshot
+
+    # Only what's in the dpkg status can change, there's no need to rebuild the
+    # whole cache - reopen it when it's used next.
+    if _apt_cache is not None:
+        _apt_cache_dirty = True
+
+    _apt_cache_generation += 1
+
+    if old_snapshot is None:
+        return set()
+
+    changed = {add_prefix(name) for name in old_snapshot ^ new_snapshot}
+    debug("Installer: installed state of %d apt packages changed" % len(changed))
+
+    return changed
+
+def select_packages(task):
+    task.transaction = MetaTransaction(task)
+
+    debug("Installer: Calculating changes required for APT package: %s" % task.pkginfo.name)
+
+def get_apt_cache_generation():
+    """
+    Changes whenever the outcome of installing or removing a package may have
+    changed - after our own tasks, or when dpkg's status or apt's lists change.
+    """
+    return (_apt_cache_generation,
+            get_file_fingerprint(DPKG_STATUS_PATH),
+            get_file_fingerprint(APT_LISTS_DIR))
+
+def _get_package_id(name):
+    global _apt_cache_lock
+    apt_cache = get_apt_cache()
+
+    with _apt_cache_lock:
+        apt_cache.clear()
+        apt_pkg = apt_cache[name]
+
+        return packagekit.Package.id_build(apt_pkg.shortname, "", apt_pkg.architecture(), "")
+
+def _run_packagekit_task(pk_task, action, name, cancellable, progress_callback):
+    # Returns the results of installing or removing name, raises GLib.Error
+    pkg_id = _get_package_id(name)
+
+    if action == "remove":
+        return pk_task.remove_packages_sync(
+            [pkg_id],
+            True, True, # allow_deps, autoremove
+            cancellable,
+            progress_callback,
+            None  # progress data
+        )
+    elif action == "install":
+        return pk_task.install_packages_sync(
+            [pkg_id],
+            cancellable,
+            progress_callback,
+            None  # progress data
+        )
+    elif action == "update":
+        debug("todo update")
+
+    return None
+
+def _is_critical_package(pkg):
+    try:
+        if pkg.versions[0].priority == "required" or pkg.name in CRITICAL_PACKAGES:
+            return True
+
+        return False
+    except Exception:
+        return False
+
+class SimulationResult():
+    """ What a simulated transaction would do, see InstallerTask for the fields """
+    def __init__(self):
+        self.to_install = []
+        self.to_update = []
+        self.to_remove = []
+        self.download_size = 0
+        self.install_size = 0
+        self.freed_size = 0
+        self.forbidden = False
+
+    @classmethod
+    def from_package_sack(cls, sack, download_size):
+        inst = cls()
+
+        install_dbginfo = []
+        remove_dbginfo = []
+        update_dbginfo = []
+        added_size = 0
+        freed_size = 0
+
+        global _apt_cache_lock
+        apt_cache = get_apt_cache()
+
+        with _apt_cache_lock:
+            for pkg in sack.get_array():
+                info = pkg.get_info()
+
+                def calc_space(pkg, is_update=False):
+                    apt_pkg = apt_cache["%s:%s" % (pkg.get_name(), pkg.get_arch())]
+
+                    candidate = apt_pkg.candidate
+
+                    if is_update:
+                        for version in apt_pkg.versions:
+                            if version.is_installed:
+                                return candidate.installed_size - version.installed_size
+
+                    return candidate.installed_size
+
+                if info == packagekit.InfoEnum.INSTALLING:
+                    inst.to_install.append(pkg)
+                    added_size += calc_space(pkg)
+                    install_dbginfo.append("%s:%s (%s)" % (pkg.get_name(), pkg.get_arch(), pkg.get_version()))
+                elif info == packagekit.InfoEnum.UPDATING:
+                    inst.to_update.append(pkg)
+                    added_size += calc_space(pkg, is_update=True)
+                    update_dbginfo.append("%s:%s (%s)" % (pkg.get_name(), pkg.get_arch(), pkg.get_version()))
+                elif info == packagekit.InfoEnum.REMOVING:
+                    inst.to_remove.append(pkg)
+                    freed_size += calc_space(pkg)
+                    remove_dbginfo.append("%s:%s (%s)" % (pkg.get_name(), pkg.get_arch(), pkg.get_version()))
+
+            debug("For install:", install_dbginfo)
+            debug("For removal:", remove_dbginfo)
+            debug("For upgrade:", update_dbginfo)
+
+            inst.download_size = download_size
+
+            space = added_size - freed_size
+
+            if space < 0:
+                inst.freed_size = space * -1
+                inst.install_size = 0
+            else:
+                inst.freed_size = 0
+                inst.install_size = space
+
+            for pkg in inst.to_remove:
+                apt_pkg_name = apt_cache["%s:%s" % (pkg.get_name(), pkg.get_arch())]
+
+                if _is_critical_package(apt_cache[apt_pkg_name]):
+                    warn("Installer: apt - cannot remove critical package: %s" % apt_pkg_name)
+                    inst.forbidden = True
+
+        return inst
+
+    def apply(self, task):
+        # Copies, the task may be modified by the client.
+        task.to_install = list(self.to_install)
+        task.to_update = list(self.to_update)
+        task.to_remove = list(self.to_remove)
+        task.download_size = self.download_size
+        task.install_size = self.install_size
+        task.freed_size = self.freed_size
+
+        if self.forbidden:
+            task.info_ready_status = task.STATUS_FORBIDDEN
+
+class PreviewPackage():
+    """ Stands in for a PackageKit.Package in previewed results, with the parts we use """
+    def __init__(self, name, arch, version, info):
+        self._name = name
+        self._arch = arch
+        self._version = version
+        self._info = info
+
+    def get_name(self):
+        return self._name
+
+    def get_arch(self):
+        return self._arch
+
+    def get_version(self):
+        return self._version
+
+    def get_info(self):
+        return self._info
+
+    def get_id(self):
+        return packagekit.Package.id_build(self._name, self._version, self._arch, "")
+
+def _preview_package(pkg, ver, info):
+    return PreviewPackage(pkg.name, pkg.architecture, ver.ver_str if ver is not None else "", info)
+
+def _get_package_changes(result):
+    # What a SimulationResult (or the task it was applied to) would install, upgrade
+    # and remove, for comparing PackageKit's resolution with a preview's.
+    return tuple(frozenset((pkg.get_name(), pkg.get_arch()) for pkg in pkgs)
+                 for pkgs in (result.to_install, result.to_update, result.to_remove))
+
+def preview_changes(action, name):
+    """
+    Works out what installing or removing name would do using apt's own resolver
+    on the open cache, which is much quicker than a PackageKit simulation. Removals
+    take along the packages they leave unneeded, like PackageKit's autoremove.
+
+    Returns a SimulationResult, or None if the changes can't be previewed (anything
+    that doesn't resolve cleanly is left to PackageKit, it reports problems properly).
+    """
+    if action not in ("install", "remove"):
+        return None
+
     global _apt_cache_lock
     apt_cache = get_apt_cache()
 
     with _apt_cache_lock:
+        cache = apt_cache._cache
+        depcache = apt_cache._depcache
+
         try:
-            return apt_cache[pkginfo.name].installed is not None
-        except:
-            return False
+            target = cache[name]
+        except KeyError:
+            return None
 
-def sync_cache_installed_states():
-    get_apt_cache(full=True)
+        if depcache.inst_count or depcache.del_count or depcache.broken_count:
+            apt_cache.clear()
 
-def select_packages(task):
-    task.transaction = MetaTransaction(task)
+        packages = cache.packages
+        initial_garbage = set()
 
-    debug("Installer: Calculating changes required for APT package: %s" % task.pkginfo.name)
+        if action == "remove":
+            for pkg in packages:
+                if pkg.current_ver is not None and depcache.is_garbage(pkg):
+                    initial_garbage.add(pkg.id)
+
+        changed = []
+
+        try:
+            with apt_pkg.ActionGroup(depcache):
+                if action == "install":
+                    depcache.mark_install(target, True, True)
+                else:
+                    depcache.mark_delete(target, False)
+
+            if action == "remove":
+                with apt_pkg.ActionGroup(depcache):
+                    for pkg in packages:
+                        if pkg.current_ver is not None and pkg.id not in initial_garbage and \
+                          not depcache.marked_delete(pkg) and depcache.is_garbage(pkg):
+                            depcache.mark_delete(pkg, False)
+
+            if depcache.broken_count > 0:
+                debug("Installer: apt - preview of %s (%s) is broken, leaving it to PackageKit" % (name, action))
+                return None
+
+            result = SimulationResult()
+
+            for pkg in packages:
+                if depcache.marked_keep(pkg):
+                    continue
+
+                changed.append(pkg)
+
+                if depcache.marked_install(pkg):
+                    result.to_install.append(_preview_package(pkg, depcache.get_candidate_ver(pkg), packagekit.InfoEnum.INSTALLING))
+                elif depcache.marked_upgrade(pkg) or depcache.marked_downgrade(pkg):
+                    result.to_update.append(_preview_package(pkg, depcache.get_candidate_ver(pkg), packagekit.InfoEnum.UPDATING))
+                elif depcache.marked_delete(pkg):
+                    result.to_remove.append(_preview_package(pkg, pkg.current_ver, packagekit.InfoEnum.REMOVING))
+
+                    if pkg.essential or pkg.name in CRITICAL_PACKAGES or \
+                      (pkg.current_ver is not None and pkg.current_ver.priority_str == "required"):
+                        warn("Installer: apt - cannot remove critical package: %s" % pkg.name)
+                        result.forbidden = True
+
+            result.download_size = depcache.deb_size
+
+            space = depcache.usr_size
+
+            if space < 0:
+                result.freed_size = space * -1
+                result.install_size = 0
+            else:
+                result.freed_size = 0
+                result.install_size = space
+        finally:
+            # Put the cache back the way it was, only what we touched.
+            with apt_pkg.ActionGroup(depcache):
+                for pkg in changed:
+                    depcache.mark_keep(pkg)
+
+            if depcache.inst_count or depcache.del_count or depcache.broken_count:
+                apt_cache.clear()
+
+    debug("Installer: apt - previewed %s (%s): install %d, remove %d, upgrade %d" %
+              (name, action, len(result.to_install), len(result.to_remove), len(result.to_update)))
+
+    return result
+
+class _Simulation(packagekit.Task):
+    """
+    Simulates a transaction and declines it once the results are in, so it
+    doesn't wait on the user like a MetaTransaction does.
+    """
+    def __init__(self, action, name):
+        packagekit.Task.__init__(self)
+
+        self.action = action
+        self.name = name
+        self.download_size = 0
+        self.result = None
+
+    def run(self):
+        """ Returns the SimulationResult, or raises GLib.Error """
+        self.set_simulate(True)
+
+        try:
+            _run_packagekit_task(self, self.action, self.name, None, self.on_transaction_progress)
+        except GLib.Error:
+            # Declining is how we end it, anything else is a real error.
+            if self.result is None:
+                raise
+
+        if self.result is None:
+            raise GLib.Error("Simulation of %s (%s) had no results" % (self.name, self.action))
+
+        return self.result
+
+    def on_transaction_progress(self, progress, ptype, data=None):
+        if ptype == packagekit.ProgressType.DOWNLOAD_SIZE_REMAINING:
+            self.download_size = max(self.download_size, progress.get_download_size_remaining())
+
+    def do_simulate_question(self, request, results):
+        self.result = SimulationResult.from_package_sack(results.get_package_sack(), self.download_size)
+        self.user_declined(request)
+
+class AptSimulations():
+    """
+    Runs simulations for MetaTransactions on a few shared threads. Requests for a
+    simulation that's already running wait for its result rather than starting
+    another, and results are kept until the apt cache generation changes. Changes
+    are previewed locally where possible, see preview_changes().
+    """
+    def __init__(self):
+        self._executor = ThreadPoolExecutor(max_workers=SIMULATION_WORKERS, thread_name_prefix="apt-simulation")
+        # Cached results are handed over on their own thread, so they never wait
+        # behind simulations that are running.
+        self._delivery_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="apt-simulation-results")
+        self._lock = threading.Lock()
+        self._results = OrderedDict()
+        # key: [(cancellable, callback)]
+        self._pending = {}
+
+    def request(self, pkg_hash, action, name, cancellable, callback):
+        """
+        Calls callback(result, error) from another thread with the SimulationResult
+        of action on name - always, even if it's cached, as the caller may not be
+        ready for it until this returns. If every request for it was cancelled
+        before it started, the simulation is skipped and callback gets (None, None).
+        """
+        key = (get_apt_cache_generation(), pkg_hash, action)
+
+        with self._lock:
+            result = self._results.get(key)
+
+            if result is None:
+                if key in self._pending:
+                    debug("Installer: apt - joining running simulation for %s (%s)" % (pkg_hash, action))
+                    self._pending[key].append((cancellable, callback))
+                else:
+                    self._pending[key] = [(cancellable, callback)]
+                    self._executor.submit(self._run, key, action, name)
+                return
+
+            self._results.move_to_end(key)
+
+        debug("Installer: apt - using cached simulation for %s (%s)" % (pkg_hash, action))
+        self._delivery_executor.submit(self._deliver, callback, result, None)
+
+    def _deliver(self, callback, result, error):
+        # The executors would drop the exception without a word.
+        try:
+            callback(result, error)
+        except Exception as e:
+            warn("Installer: apt - simulation callback failed: %s" % e)
+
+    def _run(self, key, action, name):
+        result = None
+        error = None
+
+        with self._lock:
+            waiters = self._pending[key]
+
+            if all(cancellable.is_cancelled() for cancellable, callback in waiters):
+                # Nobody's left to show it to.
+                debug("Installer: apt - skipping cancelled simulation for %s (%s)" % (key[1], action))
+                del self._pending[key]
+            else:
+                waiters = None
+
+        if waiters is not None:
+            for cancellable, callback in waiters:
+                self._deliver(callback, None, None)
+            return
+
+        try:
+            result = preview_changes(action, name)
+
+            if result is None:
+                result = _Simulation(action, name).run()
+        except GLib.Error as e:
+            error = e
+        except Exception as e:
+            warn("Installer: apt - simulation of %s (%s) failed: %s" % (name, action, e))
+            error = GLib.Error(str(e))
+
+        with self._lock:
+            waiters = self._pending.pop(key)
+
+            if result is not None:
+                # Older generations can't be asked for anymore.
+                for old_key in [old_key for old_key in self._results if old_key[0] != key[0]]:
+                    del self._results[old_key]
+
+                self._results[key] = result
+
+                while len(self._results) > SIMULATION_CACHE_SIZE:
+                    self._results.popitem(last=False)
+
+        for cancellable, callback in waiters:
+            self._deliver(callback, result, error)
+
+    def clear(self):
+        with self._lock:
+            self._results.clear()
+
+_simulations = None
+_simulations_lock = threading.Lock()
+
+def get_simulations():
+    global _simulations
+
+    with _simulations_lock:
+        if _simulations is None:
+            _simulations = AptSimulations()
+
+        return _simulations
 
 class MetaTransaction(packagekit.Task):
     def __init__(self, task):
@@ -163,40 +926,38 @@ class MetaTransaction(packagekit.Task):
 
         self.task = task
         self.simulated_download_size = 0
+        # The changes the user agreed to, when they came from a pooled simulation.
+        self.confirmed_changes = None
 
-        thread = threading.Thread(target=self._calculate_apt_changes)
-        thread.start()
+        self.set_simulate(True)
 
-    def _calculate_apt_changes(self):
-        global _apt_cache_lock
-        apt_cache = get_apt_cache()
-        with _apt_cache_lock:
-            apt_cache.clear()
-            apt_pkg = apt_cache[self.task.pkginfo.name]
-            results = None
+        if task.client_progress_cb is not None and task.type != task.UPDATE_TASK:
+            # The client shows progress itself, so the transaction doesn't have to be the
+            # one that was simulated - the simulation can be shared and cached. Updates
+            # aren't simulated (there's nothing to ask about), they just finish.
+            get_simulations().request(task.pkginfo.pkg_hash, task.type, task.pkginfo.name,
+                                      task.cancellable, self._on_simulation_done)
+        else:
+            thread = threading.Thread(target=self._calculate_apt_changes)
+            thread.start()
 
-            pkg_id = packagekit.Package.id_build(apt_pkg.shortname, "", apt_pkg.architecture(), "")
+    def _on_simulation_done(self, result, error):
+        if error is not None:
+            self.on_transaction_error(error)
 
-        self.set_simulate(True)
+        if error is not None or self.task.cancellable.is_cancelled():
+            # Like a declined simulation, the client still gets its cleanup callback.
+            self.on_transaction_finished(None)
+            return
+
+        self._set_simulation_result(result)
+
+    def _calculate_apt_changes(self):
+        results = None
 
         try:
-            if self.task.type == "remove":
-                results = self.remove_packages_sync(
-                    [pkg_id],
-                    True, True, # allow_deps, autoremove
-                    self.task.cancellable,  # cancellable
-                    self.on_transaction_progress,
-                    None  # progress data
-                )
-            elif self.task.type == "install":
-                results = self.install_packages_sync(
-                    [pkg_id],
-                    self.task.cancellable,  # cancellable
-                    self.on_transaction_progress,
-                    None  # progress data
-                )
-            elif self.task.type == "update":
-                debug("todo update")
+            results = _run_packagekit_task(self, self.task.type, self.task.pkginfo.name,
+                                           self.task.cancellable, self.on_transaction_progress)
         except GLib.Error as e:
             self.on_transaction_error(e)
 
@@ -274,84 +1035,50 @@ class MetaTransaction(packagekit.Task):
             return;
 
         self.task.pkit_request_id = request
-        sack = results.get_package_sack()
 
-        install_dbginfo = []
-        remove_dbginfo = []
-        update_dbginfo = []
-        added_size = 0
-        freed_size = 0
+        result = SimulationResult.from_package_sack(results.get_package_sack(), self.simulated_download_size)
 
-        global _apt_cache_lock
-        apt_cache = get_apt_cache()
-
-        with _apt_cache_lock:
-            for pkg in sack.get_array():
-                info = pkg.get_info()
-
-                def calc_space(pkg, is_update=False):
-                    apt_pkg = apt_cache["%s:%s" % (pkg.get_name(), pkg.get_arch())]
-
-                    candidate = apt_pkg.candidate
-
-                    if is_update:
-                        for version in apt_pkg.versions:
-                            if version.is_installed:
-                                return candidate.installed_size - version.installed_size
-
-                    return candidate.installed_size
-
-                if info == packagekit.InfoEnum.INSTALLING:
-                    self.task.to_install.append(pkg)
-                    added_size += calc_space(pkg)
-                    install_dbginfo.append("%s:%s (%s)" % (pkg.get_name(), pkg.get_arch(), pkg.get_version()))
-                elif info == packagekit.InfoEnum.UPDATING:
-                    self.task.to_update.append(pkg)
-                    added_size += calc_space(pkg, is_update=True)
-                    update_dbginfo.append("%s:%s (%s)" % (pkg.get_name(), pkg.get_arch(), pkg.get_version()))
-                elif info == packagekit.InfoEnum.REMOVING:
-                    self.task.to_remove.append(pkg)
-                    freed_size += calc_space(pkg)
-                    remove_dbginfo.append("%s:%s (%s)" % (pkg.get_name(), pkg.get_arch(), pkg.get_version()))
+        if self.confirmed_changes is not None:
+            self._check_simulation_result(request, result)
+            return
 
-            debug("For install:", install_dbginfo)
-            debug("For removal:", remove_dbginfo)
-            debug("For upgrade:", update_dbginfo)
+        self._set_simulation_result(result)
 
-            self.task.download_size = self.simulated_download_size
+    def _check_simulation_result(self, request, result):
+        # The user only saw the shared simulation or the preview, PackageKit's own
+        # changes go ahead if they're the same, otherwise the user is asked again.
+        if _get_package_changes(result) == self.confirmed_changes:
+            self.set_simulate(False)
+            self.user_accepted(request)
+            return
 
-            space = added_size - freed_size
+        warn("Installer: apt - PackageKit's changes for %s differ from what was shown, asking again" % self.task.pkginfo.name)
 
-            if space < 0:
-                self.task.freed_size = space * -1
-                self.task.install_size = 0
-            else:
-                self.task.freed_size = 0
-                self.task.install_size = space
+        result.apply(self.task)
+        self.confirmed_changes = _get_package_changes(result)
 
-            for pkg in self.task.to_remove:
-                apt_pkg_name = apt_cache["%s:%s" % (pkg.get_name(), pkg.get_arch())]
+        GLib.idle_add(self._reconfirm_transaction, request)
 
-                if self._is_critical_package(apt_cache[apt_pkg_name]):
-                    warn("Installer: apt - cannot remove critical package: %s" % apt_pkg_name)
-                    self.task.info_ready_status = self.task.STATUS_FORBIDDEN
+    def _reconfirm_transaction(self, request):
+        if self.task.info_ready_status != self.task.STATUS_FORBIDDEN and self._confirm_transaction():
+            self.set_simulate(False)
+            self.user_accepted(request)
+        else:
+            self.task.pkit_request_id = 0
+            self.user_declined(request)
 
-            if self.task.info_ready_status not in (self.task.STATUS_FORBIDDEN, self.task.STATUS_BROKEN):
-                self.task.info_ready_status = self.task.STATUS_OK
-                self.task.confirm = self._confirm_transaction
-                self.task.cancel = self._cancel_transaction
-                self.task.execute = self._execute_transaction
+        return False
 
-            self.task.call_info_ready_callback()
+    def _set_simulation_result(self, result):
+        result.apply(self.task)
 
-    def _is_critical_package(self, pkg):
-        try:
-            if pkg.versions[0].priority == "required" or pkg.name in CRITICAL_PACKAGES:
-                return True
+        if self.task.info_ready_status not in (self.task.STATUS_FORBIDDEN, self.task.STATUS_BROKEN):
+            self.task.info_ready_status = self.task.STATUS_OK
+            self.task.confirm = self._confirm_transaction
+            self.task.cancel = self._cancel_transaction
+            self.task.execute = self._execute_transaction
 
-            return False
-        except Exception:
-            return False
+        self.task.call_info_ready_callback()
 
     def _confirm_transaction(self):
         if len(self.task.to_install) > 1 or len(self.task.to_remove) > 1 or len(self.task.to_update) > 0:
@@ -372,14 +1099,22 @@ class MetaTransaction(packagekit.Task):
             self.task.pkit_request_id = 0
 
     def _execute_transaction(self):
-        self.set_simulate(False)
-
         if self.task.cancellable.is_cancelled():
             return
 
         if self.task.client_progress_cb is not None:
             self.task.has_window = True
 
+        if self.task.pkit_request_id == 0 and self.task.has_window:
+            # Simulated elsewhere (or previewed), PackageKit simulates it again before
+            # committing, see _check_simulation_result().
+            self.confirmed_changes = _get_package_changes(self.task)
+            thread = threading.Thread(target=self._calculate_apt_changes)
+            thread.start()
+            return
+
+        self.set_simulate(False)
+
         if self.task.has_window:
             self.user_accepted(self.task.pkit_request_id)
         else:
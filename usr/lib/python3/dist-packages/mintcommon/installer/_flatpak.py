@@ -7,6 +7,9 @@ import subprocess
 import requests
 import tempfile
 import os
+import hashlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 import gi
 gi.require_version('Gtk', '3.0')
@@ -22,7 +25,7 @@ except:
 from .pkgInfo import FlatpakPkgInfo
 from . import dialogs
 from .dialogs import ChangesConfirmDialog, FlatpakProgressWindow
-from .misc import debug, warn, print_timing
+from .misc import debug, warn, print_timing, get_file_fingerprint
 from . import appstream_pool
 
 class FlatpakRemoteInfo():
@@ -63,6 +66,13 @@ class FlatpakRemoteInfo():
 
 _fp_sys = None
 
+# (installation fingerprint, {installed key: InstalledRefInfo})
+_installed_snapshot = None
+_installed_snapshot_lock = threading.Lock()
+_installation_monitor = None
+# Only used with _installed_snapshot_lock held, the snapshot is asked for from any thread.
+_snapshot_fp_sys = None
+
 def get_fp_sys():
     global _fp_sys
 
@@ -74,6 +84,24 @@ def get_fp_sys():
 ALIASES = {
 }
 
+# Remotes processed at the same time when generating the cache.
+REMOTE_WORKERS = 4
+
+# Candidate addons resolved at the same time.
+ADDON_WORKERS = 4
+METADATA_CACHE_SIZE = 256
+
+# (remote name, ref, commit): metadata keyfile contents
+_metadata_cache = OrderedDict()
+_metadata_cache_lock = threading.Lock()
+
+_addon_executor = ThreadPoolExecutor(max_workers=ADDON_WORKERS, thread_name_prefix="flatpak-addon")
+_addon_worker = threading.local()
+
+# remote name: RemoteRefCatalog
+_remote_ref_catalogs = {}
+_remote_ref_catalogs_lock = threading.Lock()
+
 pools = {}
 
 def make_pkg_hash(ref):
@@ -122,6 +150,89 @@ def _should_cache_ref(ref, arch):
 
     return True
 
+def _get_summary_dirs(fp_sys):
+    # Root (and the system helper) keeps a system installation's summaries in its repo.
+    # Anyone else fetches them into their own cache, see flatpak's
+    # flatpak_ensure_system_user_cache_dir_location().
+    dirs = [os.path.join(fp_sys.get_path().get_path(), "repo", "tmp", "cache", "summaries")]
+
+    if not fp_sys.get_is_user() and os.geteuid() != 0:
+        cache_dir = os.getenv("FLATPAK_SYSTEM_CACHE_DIR") or \
+            os.path.join(GLib.get_user_cache_dir(), "flatpak", "system-cache")
+        dirs.append(os.path.join(cache_dir, "summaries"))
+
+    return dirs
+
+def _get_summary_paths(fp_sys, remote_name):
+    paths = ()
+
+    for summaries_dir in _get_summary_dirs(fp_sys):
+        paths += (os.path.join(summaries_dir, remote_name + ".idx"),
+                  os.path.join(summaries_dir, remote_name))
+
+    return paths
+
+def _get_summary_checksum(fp_sys, remote):
+    # Changes whenever flatpak fetches a new summary for the remote.
+    remote_name = remote.get_name()
+    parts = [remote_name, str(remote.get_url())]
+
+    for path in _get_summary_paths(fp_sys, remote_name):
+        parts.append("%s:%s" % (path, get_file_fingerprint(path)))
+
+    return "\0".join(parts)
+
+class RemoteRefCatalog():
+    """ The refs a remote lists, indexed by name """
+    def __init__(self, remote_name, checksum, refs):
+        self.remote_name = remote_name
+        self.checksum = checksum
+        self.refs = refs
+        self.by_name = {}
+
+        for ref in refs:
+            self.by_name.setdefault(ref.get_name(), []).append(ref)
+
+    def lookup(self, name):
+        return self.by_name.get(name, [])
+
+def get_remote_ref_catalog(fp_sys, remote):
+    """
+    Returns a RemoteRefCatalog for remote. Listing a big remote's refs is slow, so
+    they're kept for the session, until the remote's summary changes or the flatpak
+    caches are dropped (see _drop_caches()). Raises GLib.Error.
+    """
+    remote_name = remote.get_name()
+    checksum = _get_summary_checksum(fp_sys, remote)
+
+    with _remote_ref_catalogs_lock:
+        catalog = _remote_ref_catalogs.get(remote_name)
+
+    if catalog is not None and catalog.checksum == checksum:
+        return catalog
+
+    refs = fp_sys.list_remote_refs_sync(remote_name, None)
+
+    # Listing may have fetched a new summary.
+    catalog = RemoteRefCatalog(remote_name, _get_summary_checksum(fp_sys, remote), refs)
+    debug("Installer: flatpak - listed %d refs for remote '%s'" % (len(refs), remote_name))
+
+    with _remote_ref_catalogs_lock:
+        _remote_ref_catalogs[remote_name] = catalog
+
+    return catalog
+
+def _drop_caches(fp_sys):
+    # Anything we keep about the installation goes along with flatpak's own caches.
+    global _remote_ref_catalogs
+
+    fp_sys.drop_caches(None)
+
+    with _remote_ref_catalogs_lock:
+        _remote_ref_catalogs = {}
+
+    invalidate_installed_snapshot()
+
 def _process_remote(cache, rpool, fp_sys, remote, arch):
     remote_name = remote.get_name()
 
@@ -138,7 +249,7 @@ def _process_remote(cache, rpool, fp_sys, remote, arch):
     remote_url = remote.get_url()
 
     try:
-        for ref in fp_sys.list_remote_refs_sync(remote_name, None):
+        for ref in get_remote_ref_catalog(fp_sys, remote).refs:
             if not _should_cache_ref(ref, arch):
                 continue
             _add_package_to_cache(cache, rpool, ref, remote_url, False)
@@ -174,44 +285,194 @@ def _add_package_to_cache(cache, rpool, ref, remote_url, installed):
     return pkginfo
 
 def process_full_flatpak_installation(cache):
+    cache, flatpak_remote_infos, shards, kept = process_flatpak_installation_changes(cache, None)
+    return cache, flatpak_remote_infos
+
+def _get_remote_checksum(fp_sys, remote, installed_refs):
+    # Changes whenever the remote's configuration, its appstream data or summary, or
+    # what's installed from it changes. Any of those mean its shard needs to be rebuilt.
+    checksum = hashlib.sha256()
+
+    for value in (remote.get_name(), remote.get_url(), remote.get_disabled(), remote.get_noenumerate()):
+        checksum.update(("%s\0" % value).encode())
+
+    appstream_dir = remote.get_appstream_dir()
+
+    for path in (os.path.join(appstream_dir.get_path(), "appstream.xml.gz"),
+                 os.path.join(appstream_dir.get_path(), "appstream.xml")) + _get_summary_paths(fp_sys, remote.get_name()):
+        try:
+            st = os.stat(path)
+            checksum.update(("%s:%d:%d\0" % (path, st.st_mtime_ns, st.st_size)).encode())
+        except OSError:
+            checksum.update(("%s:none\0" % path).encode())
+
+    for ref in installed_refs:
+        checksum.update(("%s:%s\0" % (ref.format_ref(), ref.get_commit())).encode())
+
+    return checksum.hexdigest()
+
+class RemoteResult():
+    """ The outcome of processing one remote, see _process_remote_shard() """
+    def __init__(self, remote_name):
+        self.remote_name = remote_name
+        self.remote_info = None
+        self.shard = None
+        self.shard_cache = {}
+        self.kept = False
+        self.error = None
+        # step: seconds
+        self.timings = {}
+
+def _get_installed_refs_by_origin(fp_sys, arch=None):
+    # Lists the installed refs once, grouped by the remote they were installed from
+    # (all remotes see every installed ref, but its origin is always right.) Only the
+    # refs that would be cached are listed if arch is given.
+    refs = {}
+
+    for ref in fp_sys.list_installed_refs(None):
+        if arch is not None and not _should_cache_ref(ref, arch):
+            continue
+
+        refs.setdefault(ref.get_origin(), []).append(ref)
+
+    return refs
+
+def _process_remote_shard(remote_name, arch, old_shard, installed_refs):
+    result = RemoteResult(remote_name)
+    start = time.time()
+
+    # Each worker gets its own installation object, they're not meant to be shared between threads.
+    fp_sys = Flatpak.Installation.new_system(None)
+
+    try:
+        remote = fp_sys.get_remote_by_name(remote_name, None)
+        result.remote_info = FlatpakRemoteInfo(remote)
+
+        # A new summary is fetched by anything that asks the remote about its refs,
+        # so if it hasn't changed, there's no need to go and fetch its appstream data.
+        if old_shard is not None and old_shard["checksum"] == _get_remote_checksum(fp_sys, remote, installed_refs):
+            debug("Installer: flatpak - remote '%s' is unchanged, keeping its cached packages" % remote_name)
+            result.shard = old_shard
+            result.kept = True
+            return result
+
+        step_time = time.time()
+        debug("Installer: flatpak - updating appstream data for remote '%s'..." % remote_name)
+        try:
+            success = fp_sys.update_appstream_sync(remote_name, arch, None)
+        except GLib.Error as e:
+            warn("Could not update appstream for %s: %s" % (remote_name, e.message))
+        result.timings["appstream"] = time.time() - step_time
+
+        # Taken again, the appstream data has likely changed.
+        checksum = _get_remote_checksum(fp_sys, remote, installed_refs)
+
+        step_time = time.time()
+        rpool = appstream_pool.Pool(remote)
+        result.timings["pool"] = time.time() - step_time
+
+        step_time = time.time()
+        _process_remote(result.shard_cache, rpool, fp_sys, remote, arch)
+
+        for ref in installed_refs:
+            _add_package_to_cache(result.shard_cache, rpool, ref, remote.get_url(), True)
+        result.timings["refs"] = time.time() - step_time
+
+        result.shard = {
+            "checksum": checksum,
+            "pkg_hashes": list(result.shard_cache.keys())
+        }
+    except Exception as e:
+        result.error = e
+        result.shard_cache = {}
+
+        # Better stale packages than none, if there are any.
+        if old_shard is not None:
+            result.shard = old_shard
+            result.kept = True
+    finally:
+        result.timings["total"] = time.time() - start
+
+    return result
+
+def _report_remote_results(results, wall_time):
+    for result in results:
+        if result.error is not None:
+            warn("Installer: flatpak - processing remote '%s' failed%s: %s" %
+                     (result.remote_name, ", keeping its cached packages" if result.kept else "", result.error))
+
+        steps = ", ".join("%s %0.3f ms" % (step, seconds * 1000.0) for step, seconds in result.timings.items())
+        debug("Installer: flatpak - remote '%s' (%s): %s" %
+                  (result.remote_name, "kept" if result.kept else "%d packages" % len(result.shard_cache), steps))
+
+    busy_time = sum(result.timings.get("total", 0) for result in results)
+    debug("Installer: flatpak - processed %d remotes in %0.3f ms (%0.3f ms one after another)" %
+              (len(results), wall_time * 1000.0, busy_time * 1000.0))
+
+def process_flatpak_installation_changes(cache, old_shards):
+    """
+    Adds flatpak packages to cache, one shard per remote. old_shards are the shards
+    returned from a previous call (remote name: checksum and pkg_hashes). Remotes whose
+    checksum is unchanged aren't processed again.
+
+    Remotes are processed in parallel (they mostly wait on the network), their packages
+    are added in the order the installation lists the remotes.
+
+    Returns the cache, remote infos, the new shards, and a list of remote names whose
+    old shard is still valid.
+    """
     fp_time = time.time()
 
     arch = Flatpak.get_default_arch()
     fp_sys = get_fp_sys()
 
     flatpak_remote_infos = {}
+    shards = {}
+    kept = []
 
     try:
-        for remote in fp_sys.list_remotes():
-            remote_name = remote.get_name()
+        remote_names = [remote.get_name() for remote in fp_sys.list_remotes()]
+    except GLib.Error as e:
+        warn("Installer: flatpak - could not get remote list", e.message)
+        return cache, flatpak_remote_infos, {}, []
 
-            debug("Installer: flatpak - updating appstream data for remote '%s'..." % remote_name)
-            try:
-                success = fp_sys.update_appstream_sync(remote_name, arch, None)
-            except GLib.Error as e:
-                warn("Could not update appstream for %s: %s" % (remote_name, e.message))
+    try:
+        installed_refs = _get_installed_refs_by_origin(fp_sys, arch)
+    except GLib.Error as e:
+        warn("adding packages:", e.message)
+        installed_refs = {}
 
-            rpool = appstream_pool.Pool(remote)
-            _process_remote(cache, rpool, fp_sys, remote, arch)
+    if remote_names:
+        with ThreadPoolExecutor(max_workers=min(len(remote_names), REMOTE_WORKERS),
+                                thread_name_prefix="flatpak-remote") as executor:
+            futures = [executor.submit(_process_remote_shard, remote_name, arch,
+                                       old_shards.get(remote_name) if old_shards is not None else None,
+                                       installed_refs.get(remote_name, []))
+                           for remote_name in remote_names]
 
-            try:
-                for ref in fp_sys.list_installed_refs(None):
-                    # All remotes will see installed refs, but the installed refs will always
-                    # report their correct origin, so only add installed refs when they match the remote.
-                    if ref.get_origin() == remote_name and _should_cache_ref(ref, arch):
-                        _add_package_to_cache(cache, rpool, ref, remote.get_url(), True)
-            except GLib.Error as e:
-                warn("adding packages:", e.message)
+            results = [future.result() for future in futures]
+    else:
+        results = []
 
-            flatpak_remote_infos[remote_name] = FlatpakRemoteInfo(remote)
+    _report_remote_results(results, time.time() - fp_time)
 
-    except GLib.Error as e:
-        warn("Installer: flatpak - could not get remote list", e.message)
-        cache = {}
+    for result in results:
+        if result.remote_info is not None:
+            flatpak_remote_infos[result.remote_name] = result.remote_info
+
+        if result.shard is None:
+            continue
+
+        shards[result.remote_name] = result.shard
+
+        if result.kept:
+            kept.append(result.remote_name)
+        else:
+            cache.update(result.shard_cache)
 
     debug('Installer: Processing Flatpaks for cache took %0.3f ms' % ((time.time() - fp_time) * 1000.0))
 
-    return cache, flatpak_remote_infos
+    return cache, flatpak_remote_infos, shards, kept
 
 def initialize_appstream(cb=None):
     thread = threading.Thread(target=_initialize_appstream_thread, args=(cb,))
@@ -245,21 +506,23 @@ def _initialize_appstream_thread(cb=None):
     if cb is not None:
         GLib.idle_add(cb)
 
-def get_remote_or_installed_ref(ref, remote_name):
-    fp_sys = get_fp_sys()
+def get_remote_or_installed_ref(ref, remote_name, fp_sys=None):
+    if fp_sys is None:
+        fp_sys = get_fp_sys()
 
-    try:
-        iref = fp_sys.get_installed_ref(ref.get_kind(),
-                                        ref.get_name(),
-                                        ref.get_arch(),
-                                        ref.get_branch(),
-                                        None)
-
-        if iref:
-            return iref
-    except GLib.Error as e:
-        if e.code != Flatpak.Error.NOT_INSTALLED:
-            warn("Installer: Couldn't look up InstalledRef: %s" % e.message)
+    if _get_ref_key(ref) in get_installed_snapshot():
+        try:
+            iref = fp_sys.get_installed_ref(ref.get_kind(),
+                                            ref.get_name(),
+                                            ref.get_arch(),
+                                            ref.get_branch(),
+                                            None)
+
+            if iref:
+                return iref
+        except GLib.Error as e:
+            if e.code != Flatpak.Error.NOT_INSTALLED:
+                warn("Installer: Couldn't look up InstalledRef: %s" % e.message)
 
     try:
         rref = fp_sys.fetch_remote_ref_sync(remote_name,
@@ -276,15 +539,18 @@ def get_remote_or_installed_ref(ref, remote_name):
 
     return None
 
-def create_pkginfo_from_as_pkg(as_pkg, remote_name, remote_url):
+def create_pkginfo_from_as_pkg(as_pkg, remote_name, remote_url, fp_sys=None):
     bundle_id = as_pkg.get_bundle_id()
 
     shallow_ref = Flatpak.Ref.parse(bundle_id)
 
-    ref = get_remote_or_installed_ref(shallow_ref, remote_name)
+    ref = get_remote_or_installed_ref(shallow_ref, remote_name, fp_sys)
     if ref is None:
         return None
 
+    return _create_pkginfo_from_ref(as_pkg, ref, remote_name, remote_url)
+
+def _create_pkginfo_from_ref(as_pkg, ref, remote_name, remote_url):
     pkg_hash = make_pkg_hash(ref)
     pkginfo = FlatpakPkgInfo(pkg_hash, remote_name, ref, remote_url)
     pkginfo.add_cached_appstream_data(as_pkg)
@@ -332,12 +598,7 @@ def _get_system_theme_matches():
             try:
                 debug("Looking for theme %s in %s" % (name, remote_name))
 
-                all_refs = fp_sys.list_remote_refs_sync(remote_name, None)
-                matching_refs = []
-
-                for listed_ref in all_refs:
-                    if listed_ref.get_name() == name:
-                        matching_refs.append(listed_ref)
+                matching_refs = get_remote_ref_catalog(fp_sys, remote).lookup(name)
 
                 if not matching_refs:
                     continue
@@ -379,32 +640,69 @@ def _get_addons_for_pkginfo(parent_pkginfo):
     # as separate entries. After the compat check picks the branch the
     # parent's slot wants, dedupe so a single pkginfo per addon id
     # surfaces.
+    #
+    # The parent's metadata is read once, the candidates are looked up and checked
+    # in parallel, each one being a round trip to the remote unless its metadata
+    # is cached already, or it's installed.
     matched_by_name = {}
     try:
         aspool = pools[parent_pkginfo.remote]
         as_pkg = aspool.lookup_appstream_package(parent_pkginfo)
 
         if as_pkg is not None:
+            start = time.time()
+            parent_meta = _get_current_metadata(parent_pkginfo.remote, parent_pkginfo.refid)
+
             addons = as_pkg.get_addons(
-                extension_prefixes=_extension_prefixes_for_pkginfo(parent_pkginfo)
+                extension_prefixes=_extension_prefixes_for_pkginfo(parent_pkginfo, parent_meta)
             )
 
-            for addon in addons:
-                info = create_pkginfo_from_as_pkg(addon, parent_pkginfo.remote, parent_pkginfo.remote_url)
-                if info and _addon_is_compatible(parent_pkginfo, info):
+            # map() keeps appstream's order, so the same branch wins as before.
+            for info in _addon_executor.map(lambda addon: _resolve_addon(parent_pkginfo, parent_meta, addon), addons):
+                if info is not None:
                     matched_by_name[info.name] = info
+
+            debug("Installer: flatpak - checked %d addon candidates for %s in %0.3f ms"
+                  % (len(addons), parent_pkginfo.name, (time.time() - start) * 1000.0))
     except Exception as e:
         warn("Could not get a list of addons: %s" % str(e))
 
     return list(matched_by_name.values())
 
-def _extension_prefixes_for_pkginfo(parent_pkginfo):
+def _get_addon_worker_fp_sys():
+    # Installation objects aren't meant to be shared between threads.
+    try:
+        return _addon_worker.fp_sys
+    except AttributeError:
+        _addon_worker.fp_sys = Flatpak.Installation.new_system(None)
+        return _addon_worker.fp_sys
+
+def _resolve_addon(parent_pkginfo, parent_meta, addon):
+    fp_sys = _get_addon_worker_fp_sys()
+
+    try:
+        ref = get_remote_or_installed_ref(Flatpak.Ref.parse(addon.get_bundle_id()), parent_pkginfo.remote, fp_sys)
+        if ref is None:
+            return None
+
+        info = _create_pkginfo_from_ref(addon, ref, parent_pkginfo.remote, parent_pkginfo.remote_url)
+        child_meta = _get_metadata(parent_pkginfo.remote, ref, fp_sys)
+
+        if _addon_is_compatible(parent_pkginfo, info, parent_meta, child_meta):
+            return info
+    except Exception as e:
+        warn("Could not check addon %s: %s" % (addon.name, str(e)))
+
+    return None
+
+def _extension_prefixes_for_pkginfo(parent_pkginfo, parent_meta=None):
     # Read the parent app's flatpak metadata for declared extension points
     # (e.g. "Extension org.freedesktop.LinuxAudio.Plugins"). Generic addons
     # like VST plugins fit these slots without naming the parent in their
     # own metadata.
     try:
-        parent_meta = _get_metadata(parent_pkginfo.remote, Flatpak.Ref.parse(parent_pkginfo.refid))
+        if parent_meta is None:
+            parent_meta = _get_current_metadata(parent_pkginfo.remote, parent_pkginfo.refid)
     except Exception as e:
         warn("Could not read parent metadata for extension points: %s" % str(e))
         return []
@@ -417,23 +715,60 @@ def _extension_prefixes_for_pkginfo(parent_pkginfo):
         prefixes.append(group[len("Extension "):])
     return prefixes
 
-def _get_metadata(remote_name, ref):
-    try:
-        # RemoteRef
-        meta = ref.get_metadata()
-    except AttributeError:
-        meta = get_fp_sys().fetch_remote_metadata_sync(remote_name, ref, None)
+def _get_current_metadata(remote_name, refid, fp_sys=None):
+    # The metadata of the installed ref, or else of the remote's current commit.
+    # pkginfos may be older than either, so their commit isn't used.
+    shallow_ref = Flatpak.Ref.parse(refid)
+    ref = get_remote_or_installed_ref(shallow_ref, remote_name, fp_sys)
+
+    return _get_metadata(remote_name, shallow_ref if ref is None else ref, fp_sys)
+
+def _get_metadata(remote_name, ref, fp_sys=None):
+    # Metadata only changes with the commit, so it's cached if ref was resolved
+    # to one (an InstalledRef or a RemoteRef), and always read for that commit.
+    commit = ref.get_commit()
+    key = (remote_name, ref.format_ref(), commit)
+    data = None
+
+    if commit is not None:
+        with _metadata_cache_lock:
+            data = _metadata_cache.get(key)
+            if data is not None:
+                _metadata_cache.move_to_end(key)
+
+    if data is None:
+        if isinstance(ref, Flatpak.InstalledRef):
+            # What's deployed, which may not be what the remote has now.
+            meta = ref.load_metadata(None)
+        elif isinstance(ref, Flatpak.RemoteRef):
+            # From the summary, if it has it.
+            meta = ref.get_metadata()
+        else:
+            meta = None
+
+        if meta is None:
+            if fp_sys is None:
+                fp_sys = get_fp_sys()
+            meta = fp_sys.fetch_remote_metadata_sync(remote_name, ref, None)
 
-    data = meta.get_data().decode()
+        data = meta.get_data().decode()
+
+        if commit is not None:
+            with _metadata_cache_lock:
+                _metadata_cache[key] = data
+                while len(_metadata_cache) > METADATA_CACHE_SIZE:
+                    _metadata_cache.popitem(last=False)
 
     keyfile = GLib.KeyFile.new()
     keyfile.load_from_data(data, len(data), GLib.KeyFileFlags.NONE)
 
     return keyfile
 
-def _addon_is_compatible(parent, addon):
-    parent_meta = _get_metadata(parent.remote, Flatpak.Ref.parse(parent.refid))
-    child_meta = _get_metadata(addon.remote, Flatpak.Ref.parse(addon.refid))
+def _addon_is_compatible(parent, addon, parent_meta=None, child_meta=None):
+    if parent_meta is None:
+        parent_meta = _get_current_metadata(parent.remote, parent.refid)
+    if child_meta is None:
+        child_meta = _get_current_metadata(addon.remote, addon.refid)
 
     # When multiple extensions of the same type can be used, the
     # addon's ID will have the prefix of its intended extension point:
@@ -628,7 +963,7 @@ class FlatpakTransaction():
                 self.task.handle_error(error)
 
     def on_transaction_finished(self):
-        get_fp_sys().drop_caches(None)
+        _drop_caches(get_fp_sys())
 
         # If an op failed, show an error, even though we 'finished successfully'
         if self.task.type == self.task.UPDATE_TASK and self.op_error:
@@ -928,56 +1263,48 @@ def get_updated_theme_refs():
     return _get_system_theme_matches()
 
 def find_pkginfo(cache, string, remote=None):
-    for key in cache.get_subset_of_type("f").keys():
-        candidate = cache[key]
-        if string.partition("/")[0] in ("runtime", "app"):
-            if string == candidate.refid:
-                if remote is None or candidate.remote == remote:
-                    return candidate
-        elif string == candidate.name:
-            if remote is None or candidate.remote == remote:
-                return candidate
+    if string.partition("/")[0] in ("runtime", "app"):
+        pkg_hashes = cache.get_pkg_hashes_for_refid(string)
+    else:
+        pkg_hashes = cache.get_pkg_hashes_for_name(string, "f")
+
+    for pkg_hash in pkg_hashes:
+        try:
+            candidate = cache[pkg_hash]
+        except KeyError:
+            # Removed since the lookup
+            continue
+
+        if remote is None or candidate.remote == remote:
+            return candidate
 
     return None
 
 def generate_uncached_pkginfos(cache):
+    global pools
     fp_sys = get_fp_sys()
 
     try:
+        installed_refs = _get_installed_refs_by_origin(fp_sys)
+
         for remote in fp_sys.list_remotes():
             remote_name = remote.get_name()
 
-            for ref in fp_sys.list_installed_refs(None):
-                # All remotes will see installed refs, but the installed refs will always
-                # report their correct origin, so only add installed refs when they match the remote.
-                if ref.get_origin() == remote_name:
-                    global pools
-                    try:
-                        pool = pools[remote_name]
-                    except:
-                        pool = None
-                    debug("Generate uncached for: %s" % ref.format_ref())
-                    _add_package_to_cache(cache, pool, ref, remote.get_url(), True)
+            for ref in installed_refs.get(remote_name, []):
+                # Most are cached already, and don't need the pool.
+                if make_pkg_hash(ref) in cache:
+                    continue
+
+                pool = pools.get(remote_name)
+
+                debug("Generate uncached for: %s" % ref.format_ref())
+                _add_package_to_cache(cache, pool, ref, remote.get_url(), True)
 
     except GLib.Error as e:
         warn("Installer: flatpak - could not check for uncached pkginfos", e.message)
 
 def _ref_is_installed(kind, name, arch, branch):
-    fp_sys = get_fp_sys()
-
-    try:
-        iref = fp_sys.get_installed_ref(kind,
-                                        name,
-                                        arch,
-                                        branch,
-                                        None)
-
-        if iref:
-            return True
-    except GLib.Error:
-        pass
-
-    return False
+    return (int(kind), name, arch, branch) in get_installed_snapshot()
 
 def ref_is_installed(ref):
     return _ref_is_installed(ref.get_kind(),
@@ -986,10 +1313,114 @@ def ref_is_installed(ref):
                              ref.get_branch())
 
 def pkginfo_is_installed(pkginfo):
-    return _ref_is_installed(pkginfo.kind,
-                             pkginfo.name,
-                             pkginfo.arch,
-                             pkginfo.branch)
+    return get_installed_key(pkginfo) in get_installed_snapshot()
+
+def get_installed_key(pkginfo):
+    return (int(pkginfo.kind), pkginfo.name, pkginfo.arch, pkginfo.branch)
+
+def _get_ref_key(ref):
+    return (int(ref.get_kind()), ref.get_name(), ref.get_arch(), ref.get_branch())
+
+class InstalledRefInfo():
+    """ The parts of a Flatpak.InstalledRef the installer asks about """
+    def __init__(self, iref):
+        self.origin = iref.get_origin()
+        self.commit = iref.get_commit()
+        self.latest_commit = iref.get_latest_commit()
+        self.version = iref.get_appdata_version()
+        self.installed_size = iref.get_installed_size()
+
+def get_installed_ref_info(pkginfo):
+    """ Returns the InstalledRefInfo for pkginfo, or None if it's not installed """
+    return get_installed_snapshot().get(get_installed_key(pkginfo))
+
+def _get_installation_fingerprint(fp_sys):
+    # flatpak touches .changed whenever it modifies the installation. The deploy
+    # directories are checked too, in case the installation was never marked.
+    path = fp_sys.get_path().get_path()
+
+    return tuple(get_file_fingerprint(os.path.join(path, name)) for name in (".changed", "app", "runtime"))
+
+def _get_snapshot_fp_sys():
+    # Must be called with _installed_snapshot_lock held.
+    global _snapshot_fp_sys
+
+    if _snapshot_fp_sys is None:
+        _snapshot_fp_sys = Flatpak.Installation.new_system(None)
+
+    return _snapshot_fp_sys
+
+def _monitor_installation(fp_sys):
+    # Must be called with _installed_snapshot_lock held. The monitor's signal is
+    # delivered by the default main context, whichever thread sets it up.
+    global _installation_monitor
+
+    if _installation_monitor is None:
+        try:
+            _installation_monitor = fp_sys.create_monitor(None)
+            _installation_monitor.connect("changed", _on_installation_changed)
+        except GLib.Error as e:
+            warn("Installer: flatpak - could not monitor the installation, checking it on every query: %s" % e.message)
+            _installation_monitor = False
+
+    return _installation_monitor is not False
+
+def _on_installation_changed(monitor, file, other_file, event_type):
+    invalidate_installed_snapshot()
+
+def _main_loop_is_running():
+    # Whether the default main context is being iterated, by this thread (we're
+    # in one of its callbacks) or another one (it can't be acquired). If not, a
+    # change the monitor saw won't have been reported.
+    context = GLib.MainContext.default()
+
+    if context.is_owner():
+        return True
+
+    if context.acquire():
+        context.release()
+        return False
+
+    return True
+
+def get_installed_snapshot():
+    """
+    Returns a dict of the installed refs, keyed as get_installed_key() makes them
+    from pkginfos, with an InstalledRefInfo for each. They're listed in one go, and
+    only listed again once the installation's monitor reports a change, or, when
+    no main loop is running to report it, once the installation looks different
+    on disk (or after invalidate_installed_snapshot()). Don't modify it.
+    """
+    global _installed_snapshot
+
+    with _installed_snapshot_lock:
+        fp_sys = _get_snapshot_fp_sys()
+        monitored = _monitor_installation(fp_sys)
+
+        if _installed_snapshot is not None and monitored and _main_loop_is_running():
+            return _installed_snapshot[1]
+
+        fingerprint = _get_installation_fingerprint(fp_sys)
+
+        if _installed_snapshot is not None and _installed_snapshot[0] == fingerprint:
+            return _installed_snapshot[1]
+
+        try:
+            refs = {_get_ref_key(ref): InstalledRefInfo(ref) for ref in fp_sys.list_installed_refs(None)}
+        except GLib.Error as e:
+            warn("Installer: flatpak - could not list installed refs", e.message)
+            return {}
+
+        debug("Installer: flatpak - listed %d installed refs" % len(refs))
+
+        _installed_snapshot = (fingerprint, refs)
+        return refs
+
+def invalidate_installed_snapshot():
+    global _installed_snapshot
+
+    with _installed_snapshot_lock:
+        _installed_snapshot = None
 
 def list_remotes():
     fp_sys = get_fp_sys()
@@ -1010,6 +1441,21 @@ def get_pkginfo_from_file(cache, file, callback):
     thread = threading.Thread(target=_pkginfo_from_file_thread, args=(cache, file, callback))
     thread.start()
 
+def _find_listed_app_ref(fp_sys, remote_name, name, branch):
+    # The remote's own ref carries its sizes and metadata, unlike one we make up.
+    try:
+        remote = fp_sys.get_remote_by_name(remote_name, None)
+
+        for ref in get_remote_ref_catalog(fp_sys, remote).lookup(name):
+            if ref.get_kind() == Flatpak.RefKind.APP and \
+              ref.get_arch() == Flatpak.get_default_arch() and \
+              ref.get_branch() == branch:
+                return ref
+    except GLib.Error as e:
+        warn("Installer: flatpak - could not list refs for remote '%s': %s" % (remote_name, e.message))
+
+    return None
+
 def _pkginfo_from_file_thread(cache, file, callback):
     fp_sys = get_fp_sys()
 
@@ -1047,17 +1493,20 @@ def _pkginfo_from_file_thread(cache, file, callback):
                 remote_name = _get_remote_name_by_url(fp_sys, url)
 
                 if name and remote_name:
-                    ref = Flatpak.RemoteRef(remote_name=remote_name,
-                                            kind=Flatpak.RefKind.APP,
-                                            arch=Flatpak.get_default_arch(),
-                                            branch=branch,
-                                            name=name)
+                    ref = _find_listed_app_ref(fp_sys, remote_name, name, branch)
+
+                    if ref is None:
+                        ref = Flatpak.RemoteRef(remote_name=remote_name,
+                                                kind=Flatpak.RefKind.APP,
+                                                arch=Flatpak.get_default_arch(),
+                                                branch=branch,
+                                                name=name)
                     warn("Installer: flatpak - using existing remote '%s' for flatpakref file install" % remote_name)
                 else: #If Flatpakref is not installed already
                     try:
                         warn("Installer: flatpak - trying to install new remote for flatpakref file")
                         ref = fp_sys.install_ref_file(gb, None)
-                        fp_sys.drop_caches(None)
+                        _drop_caches(fp_sys)
 
                         remote_name = ref.get_remote_name()
                         new_remote = True
@@ -1135,7 +1584,7 @@ def _pkginfo_from_file_thread(cache, file, callback):
                                 add_repo_proc = subprocess.Popen(cmd_v)
                                 retcode = add_repo_proc.wait()
 
-                                fp_sys.drop_caches(None)
+                                _drop_caches(fp_sys)
                         os.unlink(file.name)
             except GLib.Error as e:
                 warn("Installer: could not process .flatpakref file: %s" % e.message)
@@ -1193,14 +1642,15 @@ def _remote_from_repo_file_thread(cache, file, callback):
         GObject.idle_add(callback, file, "error")
         return
 
-    # We'll do a full cache rebuild - otherwise, after this installer session, the
-    # new apps from this remote won't show up until the next scheduled cache rebuild.
+    # Refresh the flatpak cache - otherwise, after this installer session, the new apps
+    # from this remote won't show up until the next scheduled cache rebuild. Only the new
+    # remote's shard will actually be built.
     try:
-        fp_sys.drop_caches(None)
+        _drop_caches(fp_sys)
     except GLib.Error:
         pass
 
-    cache.force_new_cache_async(callback)
+    cache.force_new_cache_async(callback, "f")
 
 def _get_repofile_repo_url(path):
     kf = GLib.KeyFile()
@@ -1248,16 +1698,12 @@ def _load_deploy_data(installed_ref):
     return deploy_data
 
 def _get_deployed_version(pkginfo):
-    iref = get_fp_sys().get_installed_ref(pkginfo.kind,
-                                          pkginfo.name,
-                                          pkginfo.arch,
-                                          pkginfo.branch,
-                                          None)
+    info = get_installed_ref_info(pkginfo)
 
-    if not iref:
+    if info is None:
         return None
 
-    return iref.get_appdata_version()
+    return info.version
 
     # data = _load_deploy_data(iref)
 
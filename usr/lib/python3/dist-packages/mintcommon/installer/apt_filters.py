@@ -0,0 +1,268 @@
+import re
+import json
+import hashlib
+import configparser
+
+from .misc import warn, debug
+
+# Optional, each section found in it replaces the corresponding default rules:
+#
+#   [prefixes]
+#   # rule = allowlist - package names the rule doesn't exclude
+#   lib = libreoffice* librecad
+#
+#   [suffixes]
+#   -dev =
+#
+# The sections are prefixes, suffixes, substrings and names (matched against
+# the package name), sections (suffixes of the package's section, so 'kernel'
+# covers 'universe/kernel' too) and summaries (lowercase substrings of the
+# summary). An empty section removes all the rules of that kind.
+#
+# Allowlist entries are exact package names, unless they end with '*': then
+# they allow every name starting with what comes before it ('libreoffice*'
+# allows libreoffice and libreoffice-writer, 'librecad' only librecad). An
+# allowed package is only spared by that rule, the other rules still apply to it.
+#
+# mint-common ships an example with the default rules in
+# /usr/share/doc/mint-common/examples/apt-filters.conf
+APT_FILTERS_PATH = "/etc/mintinstall/apt-filters.conf"
+
+RULE_KINDS = ("prefixes", "suffixes", "substrings", "names", "sections", "summaries")
+
+# Part of the fingerprint, bump it when the way rules match changes.
+RULES_VERSION = 3
+
+# Foreign-architecture packages which also exist for the native one.
+MULTIARCH_RULE = "multiarch"
+
+DEFAULT_RULES = {
+    "prefixes": [
+        ("lib", ("libreoffice*", "librecad*", "librewolf*", "libk3b7*", "libimage-exiftool-perl*")),
+        ("linux-headers-", ()),
+        ("linux-tools-", ())
+    ],
+    "suffixes": [
+        (":i386", ("steam:i386",)),
+        ("-dev", ()),
+        ("-dbg", ()),
+        ("-doc", ()),
+        ("-common", ()),
+        ("-data", ()),
+        ("-dbgsym", ()),
+        ("l10n", ()),
+        ("-perl", ())
+    ],
+    "substrings": [
+        ("-locale-", ()),
+        ("-l10n-", ())
+    ],
+    "names": [
+        ("snapd", ()),
+        # formerly marked broken, it's now a dummy and has no dependents (and only exists in Mint 20).
+        ("pepperflashplugin-nonfree", ())
+    ],
+    "sections": [
+        ("kernel", ())
+    ],
+    "summaries": [
+        ("transitional", ())
+    ]
+}
+
+class FilterRule():
+    def __init__(self, kind, pattern, allow=()):
+        self.kind = kind
+        self.pattern = pattern
+        self.allow = tuple(allow)
+        self.hits = 0
+
+        self._allowed_names = frozenset(name for name in self.allow if not name.endswith("*"))
+        self._allowed_prefixes = tuple(name[:-1] for name in self.allow if name.endswith("*"))
+
+    def __str__(self):
+        return "%s '%s'" % (self.kind, self.pattern)
+
+    def allows(self, name):
+        return name in self._allowed_names or name.startswith(self._allowed_prefixes)
+
+    def matches(self, value):
+        if self.allow and self.allows(value):
+            return False
+
+        if self.kind == "prefixes":
+            return value.startswith(self.pattern)
+        if self.kind == "suffixes" or self.kind == "sections":
+            return value.endswith(self.pattern)
+        if self.kind == "substrings" or self.kind == "summaries":
+            return self.pattern in value
+
+        return value == self.pattern
+
+def _load_rules(path):
+    rules = {kind: list(DEFAULT_RULES[kind]) for kind in RULE_KINDS}
+
+    # '=' only, ':' is used in package names.
+    parser = configparser.ConfigParser(delimiters=("=",), allow_no_value=True,
+                                       comment_prefixes=("#",), interpolation=None)
+    parser.optionxform = str
+
+    try:
+        if not parser.read(path, encoding="utf-8"):
+            return rules
+    except configparser.Error as e:
+        warn("Could not read apt filter rules from %s, using the defaults: %s" % (path, e))
+        return rules
+
+    for kind in parser.sections():
+        if kind not in RULE_KINDS:
+            warn("Unknown apt filter rule kind in %s: %s" % (path, kind))
+            continue
+
+        rules[kind] = [(pattern, tuple((allow or "").split())) for pattern, allow in parser.items(kind)]
+
+    debug("Loaded apt filter rules from %s" % path)
+    return rules
+
+def _add_to_table(tables, key, rule):
+    # Keeps the first rule for a pattern, like a chain of checks would.
+    tables.setdefault(len(key), {}).setdefault(key, rule)
+
+class PackageFilter():
+    """
+    Decides which apt packages are listed. Prefix and suffix rules are compiled
+    into lookup tables by pattern length, substrings into a single regular
+    expression, so a package costs a handful of lookups whatever the number of
+    rules. Each rule counts the packages it excluded, see get_report().
+    """
+    def __init__(self, rules):
+        self.rules = []
+        self._names = {}
+        self._section_rules = []
+        # section: matching rule or None, there are only a few distinct sections.
+        self._section_matches = {}
+        self._summary_rules = []
+
+        prefixes = {}
+        suffixes = {}
+        substrings = {}
+
+        for kind in RULE_KINDS:
+            for pattern, allow in rules.get(kind, ()):
+                rule = FilterRule(kind, pattern, allow)
+                self.rules.append(rule)
+
+                if kind == "prefixes":
+                    _add_to_table(prefixes, pattern, rule)
+                elif kind == "suffixes":
+                    _add_to_table(suffixes, pattern, rule)
+                elif kind == "substrings":
+                    substrings.setdefault(pattern, rule)
+                elif kind == "names":
+                    self._names.setdefault(pattern, rule)
+                elif kind == "sections":
+                    self._section_rules.append(rule)
+                elif pattern:
+                    rule.pattern = pattern.lower()
+                    self._summary_rules.append(rule)
+
+        self._multiarch_rule = FilterRule(MULTIARCH_RULE, ":")
+        self.rules.append(self._multiarch_rule)
+
+        # Shortest first. Empty patterns would match everything, which makes no sense.
+        self._prefix_tables = [(length, prefixes[length]) for length in sorted(prefixes) if length > 0]
+        self._suffix_tables = [(-length, suffixes[length]) for length in sorted(suffixes) if length > 0]
+
+        self._substrings = substrings
+        if substrings:
+            self._substring_search = re.compile("|".join(re.escape(pattern) for pattern in substrings if pattern)).search
+        else:
+            self._substring_search = None
+
+        self.fingerprint = hashlib.blake2b(json.dumps([RULES_VERSION] + [(rule.kind, rule.pattern, rule.allow) for rule in self.rules]).encode("utf-8"),
+                                           digest_size=8).hexdigest()
+
+    @classmethod
+    def load(cls, path=APT_FILTERS_PATH):
+        return cls(_load_rules(path))
+
+    def _match_name(self, name):
+        rule = self._names.get(name)
+        if rule is not None and not (rule.allow and rule.allows(name)):
+            return rule
+
+        for length, table in self._prefix_tables:
+            rule = table.get(name[:length])
+            if rule is not None and not (rule.allow and rule.allows(name)):
+                return rule
+
+        for length, table in self._suffix_tables:
+            rule = table.get(name[length:])
+            if rule is not None and not (rule.allow and rule.allows(name)):
+                return rule
+
+        if self._substring_search is not None and self._substring_search(name) is not None:
+            # Rare enough to find which one it was the slow way.
+            for rule in self._substrings.values():
+                if rule.matches(name):
+                    return rule
+
+        return None
+
+    def _match_section(self, section):
+        try:
+            return self._section_matches[section]
+        except KeyError:
+            pass
+
+        match = None
+        for rule in self._section_rules:
+            if rule.pattern and section.endswith(rule.pattern):
+                match = rule
+                break
+
+        self._section_matches[section] = match
+        return match
+
+    def excludes_package(self, name, section, names):
+        """
+        Whether the package should be left out because of its name or section.
+        names is the set of all package names in the apt cache.
+        """
+        rule = self._match_name(name)
+
+        if rule is None:
+            rule = self._match_section(section)
+
+        if rule is None and ":" in name and name.split(":")[0] in names:
+            rule = self._multiarch_rule
+
+        if rule is None:
+            return False
+
+        rule.hits += 1
+        return True
+
+    def excludes_summary(self, summary):
+        if summary is None:
+            return False
+
+        summary = summary.lower()
+
+        for rule in self._summary_rules:
+            if rule.pattern in summary:
+                rule.hits += 1
+                return True
+
+        return False
+
+    def get_report(self):
+        """ Returns (rule description, packages excluded) pairs, most used rules first """
+        return [(str(rule), rule.hits) for rule in sorted(self.rules, key=lambda rule: -rule.hits)]
+
+    def print_report(self):
+        total = sum(rule.hits for rule in self.rules)
+        debug("Apt filter rules excluded %d packages:" % total)
+
+        for description, hits in self.get_report():
+            debug("    %6d  %s" % (hits, description))
@@ -1,52 +1,475 @@
 import time
 import os
-from pathlib import Path
 import json
+import fcntl
+import contextlib
+from pathlib import Path
 import threading
+from collections.abc import MutableMapping, Mapping
 
 from gi.repository import GLib, GObject
 
 from . import _apt
 from . import _flatpak
+from . import cachefile
+from . import search
+from .catalog import PkgCatalog
 from ._flatpak import FlatpakRemoteInfo
 from .pkgInfo import FlatpakPkgInfo, AptPkgInfo
 from .misc import print_timing, debug, warn
 from typing import Optional
 
-SYS_CACHE_PATH = "/var/cache/mintinstall/pkginfo.json"
-USER_CACHE_PATH = os.path.join(GLib.get_user_cache_dir(), "mintinstall", "pkginfo.json")
+# Set MINTCOMMON_JSON_CACHE to read and write the (slower, but readable) json cache instead.
+JSON_CACHE = os.getenv("MINTCOMMON_JSON_CACHE", False)
+
+LEGACY_SYS_CACHE_PATH = "/var/cache/mintinstall/pkginfo.json"
+LEGACY_USER_CACHE_PATH = os.path.join(GLib.get_user_cache_dir(), "mintinstall", "pkginfo.json")
+
+if JSON_CACHE:
+    SYS_CACHE_PATH = LEGACY_SYS_CACHE_PATH
+    USER_CACHE_PATH = LEGACY_USER_CACHE_PATH
+else:
+    SYS_CACHE_PATH = "/var/cache/mintinstall/pkginfo.bin"
+    USER_CACHE_PATH = os.path.join(GLib.get_user_cache_dir(), "mintinstall", "pkginfo.bin")
 
 MAX_AGE = 7 * (60 * 60 * 24) # days
 
-CACHE_SCHEMA_VERSION = 3
+CACHE_SCHEMA_VERSION = 5
+
+LOCK_FILE_NAME = "pkginfo.lock"
+
+CACHE_RECORDS_KEY = "pkginfo_cache"
+APT_STATE_RECORDS_KEY = "candidates"
+MANUAL_STATE_RECORDS_KEY = "manual"
+
+# Set MINTCOMMON_EAGER_CACHE to build every PkgInfo as soon as the cache is loaded.
+EAGER_CACHE = os.getenv("MINTCOMMON_EAGER_CACHE", False)
+
+# Catalogs are rebuilt once the rows no item uses any more make up this much of their live rows.
+MAX_DEAD_CATALOG_ROW_RATIO = 0.25
+
+# pkg_hash prefix -> PkgInfo class
+PKGINFO_CLASSES = {
+    "a": AptPkgInfo,
+    "f": FlatpakPkgInfo
+}
 
 class CacheLoadingError(Exception):
-    """Thrown when there was an issue loading the pickled package set"""
+    """Thrown when there was an issue loading the saved package set"""
+
+class CacheMigrationError(Exception):
+    """Thrown when a saved cache can't be brought up to the current schema version"""
+
+class PkgInfoMap(MutableMapping):
+    """
+    A pkg_hash -> PkgInfo mapping that keeps the raw cache records and only
+    builds PkgInfo objects for them the first time they're accessed.
+    """
+    def __init__(self, records=None):
+        # pkg_hash: the raw record mapping to build from (None for items that were set directly).
+        self._sources = {}
+        # pkg_hash: PkgInfo, for everything built or set so far.
+        self._built = {}
+        # The items set directly on this map, rather than loaded or copied from another one.
+        self._generated = set()
+
+        if records is not None:
+            self._sources = dict.fromkeys(records.keys(), records)
+
+    @classmethod
+    def from_pkginfos(cls, pkginfos):
+        inst = cls()
+        inst._sources = dict.fromkeys(pkginfos.keys())
+        inst._built = dict(pkginfos)
+        inst._generated = set(pkginfos.keys())
+        return inst
+
+    def __getitem__(self, pkg_hash):
+        try:
+            return self._built[pkg_hash]
+        except KeyError:
+            pass
+
+        source = self._sources[pkg_hash]
+        pkginfo = PKGINFO_CLASSES[pkg_hash[0]].from_json(source[pkg_hash])
+
+        # If another thread got here first, use its instance.
+        return self._built.setdefault(pkg_hash, pkginfo)
+
+    def __setitem__(self, pkg_hash, pkginfo):
+        self._built[pkg_hash] = pkginfo
+        self._sources[pkg_hash] = None
+        self._generated.add(pkg_hash)
+
+    def __delitem__(self, pkg_hash):
+        del self._sources[pkg_hash]
+        self._built.pop(pkg_hash, None)
+        self._generated.discard(pkg_hash)
+
+    def __contains__(self, pkg_hash):
+        return pkg_hash in self._sources
+
+    def __iter__(self):
+        return iter(self._sources)
+
+    def __len__(self):
+        return len(self._sources)
+
+    def get_record(self, pkg_hash):
+        """ Returns the serializable record for pkg_hash, without building a PkgInfo for it """
+        try:
+            return self._built[pkg_hash].to_json()
+        except KeyError:
+            return self._sources[pkg_hash][pkg_hash]
+
+    def copy_from(self, other, pkg_hashes):
+        """ Adds the given items from another PkgInfoMap, leaving unbuilt ones unbuilt """
+        for pkg_hash in pkg_hashes:
+            self._sources[pkg_hash] = other._sources[pkg_hash]
+            self._generated.discard(pkg_hash)
+
+            try:
+                self._built[pkg_hash] = other._built[pkg_hash]
+            except KeyError:
+                pass
+
+    def _count_dead_catalog_rows(self):
+        # A catalog is kept whole for as long as any of its rows is used, items carried
+        # over from earlier generations keep their catalogs alive.
+        catalogs = {}
+        live_rows = 0
+
+        for source in self._sources.values():
+            if isinstance(source, PkgCatalog):
+                catalogs[id(source)] = source
+                live_rows += 1
+
+        return sum(len(catalog) for catalog in catalogs.values()) - live_rows, live_rows
+
+    def compact(self):
+        """
+        Moves the items that were set directly into a PkgCatalog, and drops their
+        PkgInfos - they're built again, from the catalog, when they're accessed.
+        If earlier catalogs hold too many rows that aren't used any more, the items
+        they're the source of are moved to the new catalog too.
+        """
+        pkg_hashes = [pkg_hash for pkg_hash, source in self._sources.items() if source is None]
+        records = {pkg_hash: self._built[pkg_hash].to_json() for pkg_hash in pkg_hashes}
+
+        dead_rows, live_rows = self._count_dead_catalog_rows()
+
+        if dead_rows > live_rows * MAX_DEAD_CATALOG_ROW_RATIO:
+            debug("Installer: Rebuilding pkgcache catalog, dropping %d unused rows" % dead_rows)
+
+            for pkg_hash, source in self._sources.items():
+                if isinstance(source, PkgCatalog):
+                    records[pkg_hash] = source[pkg_hash]
+
+        if not records:
+            return
+
+        catalog = PkgCatalog.from_records(records)
+
+        for pkg_hash in records.keys():
+            self._sources[pkg_hash] = catalog
+
+        for pkg_hash in pkg_hashes:
+            del self._built[pkg_hash]
+
+        self._generated.clear()
+
+    def copy(self):
+        inst = PkgInfoMap()
+        inst._sources = self._sources.copy()
+        inst._built = self._built.copy()
+        inst._generated = self._generated.copy()
+        return inst
+
+    def has_same_item(self, other, pkg_hash):
+        """ Returns whether pkg_hash has the same content here and in other (another PkgInfoMap) """
+        mine = self._built.get(pkg_hash)
+        theirs = other._built.get(pkg_hash)
+
+        if mine is not None or theirs is not None:
+            if mine is theirs:
+                return True
+        elif self._sources[pkg_hash] is other._sources[pkg_hash]:
+            return True
+
+        # Loaded and built records can differ in form (icon sizes are ints once
+        # built), compare them as they'd be saved.
+        return (json.dumps(self.get_record(pkg_hash), sort_keys=True) ==
+                json.dumps(other.get_record(pkg_hash), sort_keys=True))
+
+    def take_descriptions(self):
+        """
+        Returns the raw descriptions the items generated for this map were given, by
+        pkg_hash. They're dropped from the PkgInfos, which fetch them again when needed.
+        Items copied from another map are left alone, their PkgInfos are shared with it.
+        """
+        descriptions = {}
+
+        for pkg_hash in self._generated:
+            pkginfo = self._built[pkg_hash]
+
+            if pkginfo.raw_description is not None:
+                descriptions[pkg_hash] = pkginfo.raw_description
+                pkginfo.raw_description = None
+
+        return descriptions
+
+    def materialize_all(self):
+        for pkg_hash in self._sources.keys():
+            self[pkg_hash]
+
+    def to_json(self):
+        return _PkgInfoRecords(self)
+
+class _PkgInfoRecords(Mapping):
+    # What gets saved in place of a PkgInfoMap.
+    def __init__(self, pkginfo_map):
+        self._map = pkginfo_map
+
+    def __getitem__(self, pkg_hash):
+        return self._map.get_record(pkg_hash)
+
+    def __iter__(self):
+        return iter(self._map)
+
+    def __len__(self):
+        return len(self._map)
+
+    def to_json(self):
+        return dict(self)
+
+class CacheIndexes():
+    """
+    Lookup tables over a cache's items, so finding packages doesn't mean scanning
+    (and building) all of them. Apt pkg_hashes are derived from the package name,
+    so only flatpak names are indexed. A name or refid can be provided by several
+    remotes, so every table maps to a list of pkg_hashes.
+    """
+    __slots__ = (
+        "by_type",
+        "by_name",
+        "by_refid",
+        "by_remote"
+    )
+
+    # Attributes of flatpak records that get indexed -> table
+    FLATPAK_KEYS = (
+        ("name", "by_name"),
+        ("refid", "by_refid"),
+        ("remote", "by_remote")
+    )
+
+    def __init__(self, by_type=None, by_name=None, by_refid=None, by_remote=None):
+        self.by_type = {} if by_type is None else by_type
+        self.by_name = {} if by_name is None else by_name
+        self.by_refid = {} if by_refid is None else by_refid
+        self.by_remote = {} if by_remote is None else by_remote
+
+    @classmethod
+    def build(cls, items):
+        inst = cls()
+        for pkg_hash in items.keys():
+            inst._add(items, pkg_hash, False)
+        return inst
+
+    @classmethod
+    def from_json(cls, json_data, items):
+        # The type table is cheaper to rebuild from the keys than to store.
+        inst = cls(None, json_data["by_name"], json_data["by_refid"], json_data["by_remote"])
+        for pkg_hash in items.keys():
+            inst.by_type.setdefault(pkg_hash[0], []).append(pkg_hash)
+        return inst
+
+    def to_json(self):
+        return {
+            "by_name": self.by_name,
+            "by_refid": self.by_refid,
+            "by_remote": self.by_remote
+        }
+
+    def copy(self):
+        # Tables are copied, their lists are only copied once they change (see _add and _remove).
+        return CacheIndexes(self.by_type.copy(), self.by_name.copy(), self.by_refid.copy(), self.by_remote.copy())
+
+    def _add(self, items, pkg_hash, copy_lists):
+        self._add_to(self.by_type, pkg_hash[0], pkg_hash, copy_lists)
+
+        if pkg_hash.startswith("f"):
+            record = items.get_record(pkg_hash)
+            for key, table in self.FLATPAK_KEYS:
+                self._add_to(getattr(self, table), record[key], pkg_hash, copy_lists)
+
+    def _remove(self, items, pkg_hash):
+        self._remove_from(self.by_type, pkg_hash[0], pkg_hash)
+
+        if pkg_hash.startswith("f"):
+            record = items.get_record(pkg_hash)
+            for key, table in self.FLATPAK_KEYS:
+                self._remove_from(getattr(self, table), record[key], pkg_hash)
+
+    def _add_to(self, table, key, pkg_hash, copy_list):
+        pkg_hashes = table.get(key)
+        if pkg_hashes is None:
+            table[key] = [pkg_hash]
+        elif copy_list:
+            table[key] = pkg_hashes + [pkg_hash]
+        else:
+            pkg_hashes.append(pkg_hash)
+
+    def _remove_from(self, table, key, pkg_hash):
+        pkg_hashes = [other for other in table.get(key, []) if other != pkg_hash]
+        if pkg_hashes:
+            table[key] = pkg_hashes
+        else:
+            table.pop(key, None)
+
+    def with_item_set(self, old_items, new_items, pkg_hash):
+        """ Returns a copy with pkg_hash (re)indexed as it is in new_items """
+        inst = self.copy()
+        if pkg_hash in old_items:
+            inst._remove(old_items, pkg_hash)
+        inst._add(new_items, pkg_hash, True)
+        return inst
+
+    def with_item_removed(self, old_items, pkg_hash):
+        """ Returns a copy without pkg_hash, which must still be in old_items """
+        inst = self.copy()
+        inst._remove(old_items, pkg_hash)
+        return inst
+
+class PkgInfoTypeView(Mapping):
+    """
+    Read-only view of the items of a single package type, backed by a
+    snapshot's items and type index (so nothing is copied).
+    """
+    def __init__(self, items, pkg_type, pkg_hashes):
+        self._items = items
+        self._pkg_type = pkg_type
+        self._pkg_hashes = pkg_hashes
+
+    def __getitem__(self, pkg_hash):
+        if not pkg_hash.startswith(self._pkg_type):
+            raise KeyError(pkg_hash)
+        return self._items[pkg_hash]
+
+    def __contains__(self, pkg_hash):
+        return pkg_hash.startswith(self._pkg_type) and pkg_hash in self._items
+
+    def __iter__(self):
+        return iter(self._pkg_hashes)
+
+    def __len__(self):
+        return len(self._pkg_hashes)
+
+class CacheSnapshot():
+    """
+    The content of a PkgCache at one point in time. A snapshot is never modified
+    once it's published - changes to the cache swap in a new one - so it can be
+    read from any thread without locking.
+    """
+    __slots__ = (
+        "generation",
+        "items",
+        "sections",
+        "flatpak_remote_infos",
+        "flatpak_shards",
+        "indexes"
+    )
+
+    def __init__(self, generation, items, sections, flatpak_remote_infos, flatpak_shards, indexes):
+        self.generation = generation
+        self.items = items
+        self.sections = sections
+        self.flatpak_remote_infos = flatpak_remote_infos
+        self.flatpak_shards = flatpak_shards
+        self.indexes = indexes
+
+    def derive(self, items, indexes):
+        return CacheSnapshot(self.generation + 1, items, self.sections,
+                             self.flatpak_remote_infos, self.flatpak_shards, indexes)
+
+    def get_subset_of_type(self, pkg_type):
+        return PkgInfoTypeView(self.items, pkg_type, self.indexes.by_type.get(pkg_type, []))
+
+    def keys(self):
+        return self.items.keys()
+
+    def values(self):
+        return self.items.values()
+
+    def __getitem__(self, pkg_hash):
+        return self.items[pkg_hash]
+
+    def __contains__(self, pkg_hash):
+        return pkg_hash in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(self.items.values())
+
+class CacheChanges():
+    """ The pkg_hashes that differ from one snapshot to the next """
+    __slots__ = (
+        "added",
+        "removed",
+        "changed"
+    )
+
+    def __init__(self, added, removed, changed):
+        self.added = added
+        self.removed = removed
+        self.changed = changed
+
+    @classmethod
+    def between(cls, old, new):
+        old_keys = set(old.keys())
+        new_keys = set(new.keys())
+
+        changed = {pkg_hash for pkg_hash in new_keys & old_keys
+                       if not new.items.has_same_item(old.items, pkg_hash)}
+
+        return cls(new_keys - old_keys, old_keys - new_keys, changed)
+
+    def __contains__(self, pkg_hash):
+        return pkg_hash in self.added or pkg_hash in self.removed or pkg_hash in self.changed
+
+    def __len__(self):
+        return len(self.added) + len(self.removed) + len(self.changed)
 
 class JsonObject(object):
-    def __init__(self, pkginfo_cache, section_lists, flatpak_remote_infos):
+    def __init__(self, pkginfo_cache, section_lists, flatpak_remote_infos, flatpak_shards, indexes=None):
         super(JsonObject, self).__init__()
 
         self.schema_version = CACHE_SCHEMA_VERSION
         self.pkginfo_cache = pkginfo_cache
         self.section_lists = section_lists
         self.flatpak_remote_infos = flatpak_remote_infos
+        # remote name: {"checksum": str, "pkg_hashes": [...]}
+        self.flatpak_shards = flatpak_shards
+        self.indexes = CacheIndexes.build(pkginfo_cache) if indexes is None else indexes
 
     @classmethod
     def from_json(cls, json_data: dict):
-        schema_version = json_data.get("schema_version", 0)
-        if schema_version != CACHE_SCHEMA_VERSION:
-            warn("PkgCache schema version doesn't match, regenerating cache")
+        try:
+            migrate_payload(json_data)
+        except CacheMigrationError as e:
+            warn("%s, regenerating cache" % str(e))
             return None
 
-        pkgcache_dict = {}
-        for key in json_data["pkginfo_cache"].keys():
-            pkginfo_data = json_data["pkginfo_cache"][key]
+        records = json_data["pkginfo_cache"]
+        if isinstance(records, dict):
+            # Loaded from json, the (much smaller) catalog can replace the parsed records.
+            records = PkgCatalog.from_records(records)
 
-            if pkginfo_data["pkg_hash"].startswith("a"):
-                pkgcache_dict[key] = AptPkgInfo.from_json(pkginfo_data)
-            else:
-                pkgcache_dict[key] = FlatpakPkgInfo.from_json(pkginfo_data)
+        pkgcache_dict = PkgInfoMap(records)
+        if EAGER_CACHE:
+            pkgcache_dict.materialize_all()
 
         remotes_dict = {}
         for key in json_data["flatpak_remote_infos"].keys():
@@ -55,20 +478,68 @@ class JsonObject(object):
 
         return cls(pkgcache_dict,
                    json_data["section_lists"],
-                   remotes_dict)
+                   remotes_dict,
+                   json_data.get("flatpak_shards", {}),
+                   CacheIndexes.from_json(json_data["indexes"], pkgcache_dict))
 
     def to_json(self):
         return self.__dict__
 
+# schema version: function upgrading a cache payload from that version to the next.
+# Payloads are modified in place, their records may be lazily decoded (read-only)
+# mappings. If there's no path to CACHE_SCHEMA_VERSION, the cache is regenerated.
+CACHE_MIGRATIONS = {}
+
+def cache_migration(from_version):
+    def register(func):
+        CACHE_MIGRATIONS[from_version] = func
+        return func
+    return register
+
+@cache_migration(3)
+def _migrate_add_shards_and_indexes(payload):
+    # Without shards, all remotes count as changed the next time flatpaks are refreshed.
+    payload.setdefault("flatpak_shards", {})
+    payload["indexes"] = CacheIndexes.build(PkgInfoMap(payload[CACHE_RECORDS_KEY])).to_json()
+
+@cache_migration(4)
+def _migrate_add_search_index(payload):
+    # The search index is saved separately, and made the next time everything is regenerated.
+    pass
+
+def migrate_payload(payload):
+    """ Upgrades a loaded cache payload to CACHE_SCHEMA_VERSION, or raises CacheMigrationError """
+    version = payload.get("schema_version", 0)
+
+    while version != CACHE_SCHEMA_VERSION:
+        try:
+            migration = CACHE_MIGRATIONS[version]
+        except KeyError:
+            raise CacheMigrationError("Can't migrate a pkgcache from schema version %d" % version)
+
+        debug("Installer: Migrating pkgcache from schema version %d" % version)
+
+        try:
+            migration(payload)
+        except Exception as e:
+            raise CacheMigrationError("Migration from schema version %d failed: %s" % (version, str(e)))
+
+        version += 1
+
+    payload["schema_version"] = version
+
 class PkgCache(object):
     STATUS_EMPTY = 0
     STATUS_OK = 1
 
     @print_timing
-    def __init__(self, pkg_type, cache_path=None, have_flatpak=True):
+    def __init__(self, pkg_type, cache_path=None, have_flatpak=True, allow_stale=False):
         super(PkgCache, self).__init__()
 
         self.status = self.STATUS_EMPTY
+        # If allow_stale is set, a cache older than MAX_AGE is loaded anyway and this is
+        # True until it's regenerated (see revalidate_async).
+        self.stale = False
         self.cache_content = pkg_type
 
         if cache_path is not None:
@@ -78,91 +549,279 @@ class PkgCache(object):
 
         self.have_flatpak = have_flatpak and pkg_type in ("f", None)
 
-        self._items = {}
-        self._item_lock = threading.Lock()
+        # Readers just grab the current snapshot, only changes need to be serialized.
+        self._snapshot = CacheSnapshot(0, PkgInfoMap(), {}, {}, {}, CacheIndexes())
+        self._write_lock = threading.Lock()
+
+        # The path the current items were loaded from, and the apt state (index file
+        # fingerprints and candidate versions) they were generated with.
+        self._loaded_path = None
+        self._apt_state = None
+
+        # Loaded on first search. If there's no saved one, an index is made without
+        # descriptions, and that one isn't used to build the next.
+        self._search_index = None
+        self._search_index_is_partial = False
+
+        # Manually installed packages and the initial-status list, with the fingerprints
+        # of the files they were read from.
+        self._manual_state = None
 
         try:
-            cache, sections, flatpak_remote_infos = self._load_cache()
+            json_obj = self._load_cache(allow_stale)
         except CacheLoadingError:
-            cache = {}
-            sections = {}
-            flatpak_remote_infos = {}
+            json_obj = JsonObject(PkgInfoMap(), {}, {}, {})
 
-        if len(cache) > 0:
-            self.status = self.STATUS_OK
-        else:
-            self.status = self.STATUS_EMPTY
+        self._set_items(json_obj)
 
-        self._items = cache
-        self.sections = sections
-        self.flatpak_remote_infos = flatpak_remote_infos
+    def snapshot(self):
+        """
+        Returns the current CacheSnapshot. It can be iterated and read freely, it
+        won't change even if the cache is regenerated meanwhile.
+        """
+        return self._snapshot
+
+    def get_generation(self):
+        """ Returns the current snapshot's generation, which increases with every change """
+        return self._snapshot.generation
+
+    @property
+    def sections(self):
+        return self._snapshot.sections
+
+    @property
+    def flatpak_remote_infos(self):
+        return self._snapshot.flatpak_remote_infos
+
+    @property
+    def flatpak_shards(self):
+        return self._snapshot.flatpak_shards
 
     def keys(self):
-        with self._item_lock:
-            return self._items.keys()
+        return self._snapshot.keys()
 
     def values(self):
-        with self._item_lock:
-            return self._items.values()
+        # PkgInfos are built as the returned view is iterated.
+        return self._snapshot.values()
 
     def __getitem__(self, key):
-        with self._item_lock:
-            return self._items[key]
+        return self._snapshot[key]
 
     def __setitem__(self, key, value):
-        with self._item_lock:
-            self._items[key] = value
+        # Rare (pkginfos added at runtime), so just copy.
+        with self._write_lock:
+            snapshot = self._snapshot
+            items = snapshot.items.copy()
+            items[key] = value
+            self._snapshot = snapshot.derive(items, snapshot.indexes.with_item_set(snapshot.items, items, key))
 
     def __delitem__(self, key):
-        with self._item_lock:
-            del self._items[key]
+        with self._write_lock:
+            snapshot = self._snapshot
+            items = snapshot.items.copy()
+            del items[key]
+            self._snapshot = snapshot.derive(items, snapshot.indexes.with_item_removed(snapshot.items, key))
 
     def __contains__(self, pkg_hash):
-        with self._item_lock:
-            return pkg_hash in self._items
+        return pkg_hash in self._snapshot
 
     def __len__(self):
-        with self._item_lock:
-            return len(self._items)
+        return len(self._snapshot)
 
     def __iter__(self):
-        with self._item_lock:
-            for pkg_hash in self._items:
-                yield self[pkg_hash]
-            return
+        return iter(self._snapshot)
 
-    def _generate_cache(self):
-        cache = {}
+    def _generate_cache(self, content):
+        cache = PkgInfoMap()
         sections = {}
         flatpak_remote_infos = {}
+        flatpak_shards = {}
 
         # If there's no cache, always generate both package types.
-        if self.have_flatpak and (self.cache_content in ("f", None) or self.status == self.STATUS_EMPTY):
-            cache, flatpak_remote_infos = _flatpak.process_full_flatpak_installation(cache)
+        if self.have_flatpak and (content in ("f", None) or self.status == self.STATUS_EMPTY):
+            cache, flatpak_remote_infos, flatpak_shards = self._generate_flatpak_cache(cache)
+
+        if content in ("a", None) or self.status == self.STATUS_EMPTY:
+            cache, sections = self._generate_apt_cache(cache)
+
+        return cache, sections, flatpak_remote_infos, flatpak_shards
+
+    def _generate_flatpak_cache(self, cache):
+        # Only rebuild the shards of remotes that changed, if we have any.
+        old_shards = None
+
+        if self.status == self.STATUS_OK and self._get_complete_search_index() is not None:
+            snapshot = self._snapshot
+            old_shards = snapshot.flatpak_shards
+            old_items = snapshot.items
+
+        cache, flatpak_remote_infos, shards, kept = _flatpak.process_flatpak_installation_changes(cache, old_shards)
+
+        for remote_name in kept:
+            cache.copy_from(old_items, [pkg_hash for pkg_hash in shards[remote_name]["pkg_hashes"] if pkg_hash in old_items])
+
+        return cache, flatpak_remote_infos, shards
 
-        if self.cache_content in ("a", None) or self.status == self.STATUS_EMPTY:
-            cache, sections = _apt.process_full_apt_cache(cache)
+    def _generate_apt_cache(self, cache):
+        # Only reprocess what changed since the current items were generated, if we know that.
+        old_pkg_hashes = None
+        old_state = None
 
-        return cache, sections, flatpak_remote_infos
+        if self.status == self.STATUS_OK and self._get_complete_search_index() is not None:
+            old_state = self._get_apt_state()
 
-    def _get_best_load_path(self):
+            if old_state is not None:
+                snapshot = self._snapshot
+                old_pkg_hashes = set(snapshot.indexes.by_type.get("a", []))
+                old_items = snapshot.items
+                old_sections = snapshot.sections
+
+        cache, sections, kept, self._apt_state = _apt.process_apt_cache_changes(cache, old_pkg_hashes, old_state)
+
+        if kept:
+            debug("Installer: Keeping %d unchanged apt packages" % len(kept))
+            cache.copy_from(old_items, kept)
+
+            for section, pkg_hashes in old_sections.items():
+                carried = [pkg_hash for pkg_hash in pkg_hashes if pkg_hash in kept]
+                if carried:
+                    sections.setdefault(section, []).extend(carried)
+
+        return cache, sections
+
+    def _get_sidecar_path(self, cache_path, kind):
+        return cache_path.with_name(cache_path.stem + "-" + kind + cache_path.suffix)
+
+    def _get_apt_state_path(self, cache_path):
+        return self._get_sidecar_path(cache_path, "apt-state")
+
+    def _get_apt_state(self):
+        if self._apt_state is None and self._loaded_path is not None:
+            try:
+                self._apt_state = cachefile.load(self._get_apt_state_path(self._loaded_path), APT_STATE_RECORDS_KEY)
+            except Exception as e:
+                debug("Installer: No usable apt state for pkgcache, apt packages will be fully processed (%s)" % str(e))
+
+        return self._apt_state
+
+    def _save_apt_state(self, cache_path):
+        state_path = self._get_apt_state_path(cache_path)
+        state = self._get_apt_state()
+
+        try:
+            if state is None:
+                state_path.unlink(missing_ok=True)
+                return
+
+            self._write_file(state_path, state, APT_STATE_RECORDS_KEY)
+        except Exception as e:
+            warn("Installer: Could not save apt state:", str(e))
+
+    def _load_search_index(self):
+        if self._loaded_path is None:
+            return None
+
+        try:
+            path = self._get_sidecar_path(self._loaded_path, "search")
+            return search.SearchIndex.from_json(cachefile.load(path, search.SEARCH_RECORDS_KEY))
+        except Exception as e:
+            debug("Installer: No usable search index for pkgcache (%s)" % str(e))
+
+        return None
+
+    def _get_search_index(self):
+        index = self._search_index
+
+        if index is None:
+            index = self._load_search_index()
+
+            if index is None:
+                index = search.SearchIndex.build(self._snapshot.items, {})
+                self._search_index_is_partial = True
+
+            self._search_index = index
+
+        return index
+
+    def _get_complete_search_index(self):
+        # Returns the search index if it has the descriptions of the current items, or None.
+        # Items that are carried over when regenerating aren't described again, so they
+        # can only be reused when there's one.
+        if self._search_index is None or self._search_index_is_partial:
+            index = self._load_search_index()
+            if index is None:
+                return None
+
+            # A migrated cache, or one that was saved without its index, may sit next
+            # to an index that was saved for other items.
+            documents = set(index.documents)
+            if not all(pkg_hash in documents for pkg_hash in self._snapshot.keys()):
+                debug("Installer: Saved search index doesn't cover the pkgcache items, not using it")
+                return None
+
+            self._search_index = index
+            self._search_index_is_partial = False
+
+        return self._search_index
+
+    def _update_search_index(self, cache, carried):
+        # Returns the new index, and whether it's complete. Items carried over from
+        # the current ones (carried) weren't described again, so an index that's
+        # built from scratch won't have their descriptions.
+        descriptions = cache.take_descriptions()
+        old_index = None
+
+        if self.status == self.STATUS_OK:
+            old_index = self._get_complete_search_index()
+
+        if old_index is None:
+            return search.SearchIndex.build(cache, descriptions), not carried
+
+        return search.SearchIndex.update(old_index, cache, descriptions), True
+
+    def _save_search_index(self, cache_path, index):
+        try:
+            self._write_file(self._get_sidecar_path(cache_path, "search"), index.to_json(), search.SEARCH_RECORDS_KEY)
+        except Exception as e:
+            warn("Installer: Could not save search index:", str(e))
+
+    def _discard_search_index(self, cache_path):
+        # Whatever index was saved there describes other items, it mustn't be loaded with these.
+        try:
+            self._get_sidecar_path(cache_path, "search").unlink(missing_ok=True)
+        except Exception as e:
+            warn("Installer: Could not remove search index:", str(e))
+
+    def _get_best_load_path(self, allow_stale=False):
         # If a custom path is set, always regenerate the cache.
         if self.custom_cache_path is not None:
             return None 
 
+        path = self._get_most_recent_path(SYS_CACHE_PATH, USER_CACHE_PATH, allow_stale)
+
+        if path is None and not JSON_CACHE:
+            # A cache from before the binary format can still be migrated.
+            path = self._get_most_recent_path(LEGACY_SYS_CACHE_PATH, LEGACY_USER_CACHE_PATH, allow_stale)
+
+        return path
+
+    def _get_most_recent_path(self, sys_path, user_path, allow_stale):
         try:
-            sys_mtime = os.path.getmtime(SYS_CACHE_PATH)
+            sys_mtime = os.path.getmtime(sys_path)
 
-            if ((time.time() - MAX_AGE) > sys_mtime) or not os.access(SYS_CACHE_PATH, os.R_OK):
-                debug("Installer: System pkgcache too old or not accessible, skipping")
+            if not os.access(sys_path, os.R_OK):
+                debug("Installer: System pkgcache not accessible, skipping")
+                sys_mtime = 0
+            elif ((time.time() - MAX_AGE) > sys_mtime) and not allow_stale:
+                debug("Installer: System pkgcache too old, skipping")
                 sys_mtime = 0
         except OSError:
             sys_mtime = 0
 
         try:
-            user_mtime = os.path.getmtime(USER_CACHE_PATH)
+            user_mtime = os.path.getmtime(user_path)
 
-            if (time.time() - MAX_AGE) > user_mtime:
+            if ((time.time() - MAX_AGE) > user_mtime) and not allow_stale:
                 debug("Installer: User pkgcache too old, skipping")
                 user_mtime = 0
         except OSError:
@@ -176,54 +835,57 @@ class PkgCache(object):
 
         # Select the most recent
         if sys_mtime > user_mtime:
-            most_recent = SYS_CACHE_PATH
+            most_recent = sys_path
             debug("Installer: System pkgcache is most recent, using it.")
         else:
-            most_recent = USER_CACHE_PATH
+            most_recent = user_path
             debug("Installer: User pkgcache is most recent, using it.")
 
         return Path(most_recent)
 
     @print_timing
-    def _load_cache(self):
+    def _load_cache(self, allow_stale=False):
         """
-        The cache pickle file can be in either a system or user location,
+        The cache file can be in either a system or user location,
         depending on how the cache was generated.  If it exists in both places, take the
-        most recent one.  If it's more than MAX_AGE, generate a new one anyhow.
+        most recent one.  If it's more than MAX_AGE, generate a new one anyhow, unless
+        allow_stale is True - then it's loaded and marked as stale.
         """
 
-        cache = None
-        sections = None
-        flatpak_remote_infos = None
+        json_obj = None
 
-        path = self._get_best_load_path()
+        path = self._get_best_load_path(allow_stale)
 
         if path is None:
             raise CacheLoadingError
         try:
-            with path.open(mode='r', encoding="utf8") as f:
-                json_obj = JsonObject.from_json(json.load(f))
-                cache = json_obj.pkginfo_cache
-                sections = json_obj.section_lists
-                flatpak_remote_infos = json_obj.flatpak_remote_infos
+            json_obj = JsonObject.from_json(cachefile.load(path, CACHE_RECORDS_KEY))
+            if json_obj is not None:
+                self._loaded_path = path
+                self.stale = (time.time() - MAX_AGE) > path.stat().st_mtime
+
+                if self.stale:
+                    debug("Installer: Using stale pkgcache until it's regenerated")
         except Exception as e:
             warn("Installer: Error loading pkginfo cache:", str(e))
-            cache = None
+            json_obj = None
 
-        if cache is None:
+        if json_obj is None:
             raise CacheLoadingError
 
-        return cache, sections, flatpak_remote_infos
+        return json_obj
 
     def _get_best_save_path(self) -> Optional[Path]:
         if self.custom_cache_path is not None:
             return self.custom_cache_path
 
-        # Prefer the system location, as all users can access it
+        # Prefer the system location, as all users can access it. Files are replaced
+        # rather than written to, so it's the directory that needs to be writable.
         try:
             path = Path(SYS_CACHE_PATH)
             path.parent.mkdir(parents=True, exist_ok=True)
-            path.touch(exist_ok=True)
+            if not os.access(path.parent, os.W_OK):
+                raise PermissionError
             return path
         except PermissionError:
             try:
@@ -240,59 +902,259 @@ class PkgCache(object):
         AptPkgInfo.__module__ = "installer.pkgInfo"
         FlatpakRemoteInfo.__module__ = "installer._flatpak"
 
+        payload = dict(to_be_json.to_json())
+        payload[CACHE_RECORDS_KEY] = payload[CACHE_RECORDS_KEY].to_json()
+
         try:
-            with path.open(mode='w', encoding="utf8") as f:
-                json.dump(to_be_json, f, default=lambda o: o.to_json(), indent=4)
+            self._write_file(path, payload, CACHE_RECORDS_KEY)
         except Exception as e:
             warn("Installer: Could not save cache:", str(e))
+            return None
+
+        return path
+
+    def _write_file(self, path, payload, records_key):
+        # Never write over a file in place - the current one may still be mapped,
+        # by us or by another process.
+        tmp_path = path.with_name(".%s.%d.tmp" % (path.name, os.getpid()))
+
+        try:
+            with tmp_path.open(mode='w' if JSON_CACHE else 'wb') as f:
+                cachefile.save(f, payload, records_key,
+                               default=lambda o: o.to_json(), binary=not JSON_CACHE)
+            os.replace(tmp_path, path)
+        except Exception:
+            tmp_path.unlink(missing_ok=True)
+            raise
+
+    def _open_lock_file(self):
+        if self.custom_cache_path is not None:
+            lock_paths = [self.custom_cache_path.with_name(LOCK_FILE_NAME)]
+        else:
+            lock_paths = [Path(SYS_CACHE_PATH).with_name(LOCK_FILE_NAME),
+                          Path(USER_CACHE_PATH).with_name(LOCK_FILE_NAME)]
+
+        for path in lock_paths:
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+            except OSError:
+                pass
+
+            # A read-only descriptor is enough for flock, so users can share the
+            # system lock file even if only root can create it.
+            for flags in (os.O_RDWR | os.O_CREAT, os.O_RDONLY):
+                try:
+                    return os.open(path, flags | os.O_CLOEXEC, 0o644)
+                except OSError:
+                    pass
+
+        warn("Installer: Could not open a pkgcache lock file, generating without it")
+        return None
+
+    @contextlib.contextmanager
+    def _generation_lock(self):
+        """
+        Only one process (or thread) at a time generates a cache, the rest wait
+        for it to finish.
+        """
+        fd = self._open_lock_file()
+
+        if fd is None:
+            yield
+            return
+
+        try:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                debug("Installer: pkgcache is being generated elsewhere, waiting for it")
+                fcntl.flock(fd, fcntl.LOCK_EX)
+
+            yield
+        finally:
+            os.close(fd)
+
+    def _load_fresh_cache(self, since):
+        # Returns a cache saved after 'since' (by another process while we were
+        # waiting for the lock), or None.
+        path = self._get_best_load_path()
+
+        try:
+            if path is None or path.stat().st_mtime < since:
+                return None
+
+            loaded = self._load_cache()
+        except (OSError, CacheLoadingError):
+            return None
+
+        debug("Installer: Using pkgcache that was just generated by another process")
+        self._apt_state = None
+        self._search_index = None
+        self._search_index_is_partial = False
+
+        return loaded
+
+    def _new_cache_common(self, pkg_type=None):
+        requested = time.time()
+
+        with self._generation_lock():
+            loaded = self._load_fresh_cache(requested)
+
+            if loaded is None:
+                self._generate_and_save_cache(pkg_type)
+                return
+
+        self._set_items(loaded)
+
+    def _generate_and_save_cache(self, pkg_type):
+        # pkg_type can restrict a refresh to one package type, regardless of the cache's content.
+        content = self.cache_content if pkg_type is None else pkg_type
+
+        # Refreshing one package type carries the other one's items over without their
+        # descriptions, which only the search index has. Without a complete one, both
+        # types are regenerated so the new index can describe everything.
+        if content is not None and self.status == self.STATUS_OK and self._get_complete_search_index() is None:
+            debug("Installer: No complete search index, regenerating all package types")
+            content = None
 
-    def _new_cache_common(self):
         debug("Installer: Generating new pkgcache")
-        cache, sections, flatpak_remote_infos = self._generate_cache()
+        cache, sections, flatpak_remote_infos, flatpak_shards = self._generate_cache(content)
 
         # If we're refreshing only a specific package type, don't destroy existing
         # items of the other type (otherwise if the cache is refreshed by mintupdate's
         # flatpak updater mintinstall will end up starting without any apt package info
         # and look broken).
-        with self._item_lock:
-            if self.cache_content == "f":
-                for key in [key for key in self._items.keys() if key.startswith("a")]:
-                    cache[key] = self._items[key]
-                sections = self.sections
-            elif self.cache_content == "a":
-                for key in [key for key in self._items.keys() if key.startswith("f")]:
-                    cache[key] = self._items[key]
+        snapshot = self._snapshot
+        carried = []
 
-        if len(cache) > 0:
-            self._save_cache(JsonObject(cache, sections, flatpak_remote_infos))
+        if content == "f":
+            carried = snapshot.indexes.by_type.get("a", [])
+            sections = snapshot.sections
+        elif content == "a":
+            carried = snapshot.indexes.by_type.get("f", [])
+            flatpak_remote_infos = snapshot.flatpak_remote_infos
+            flatpak_shards = snapshot.flatpak_shards
+
+        cache.copy_from(snapshot.items, carried)
+
+        search_index, search_index_complete = self._update_search_index(cache, carried)
+
+        if not search_index_complete:
+            debug("Installer: Search index is missing descriptions, it won't be saved")
 
-        with self._item_lock:
-            self._items = cache
-            self.sections = sections
-            self.flatpak_remote_infos = flatpak_remote_infos
+        # Generated PkgInfos aren't needed any more once the search index has their
+        # descriptions, keep their data in a catalog instead.
+        cache.compact()
 
-        if len(cache) == 0:
+        # Indexes are built here, so they're saved along with the items.
+        json_obj = JsonObject(cache, sections, flatpak_remote_infos, flatpak_shards)
+
+        if len(cache) > 0:
+            path = self._save_cache(json_obj)
+            if path is not None:
+                self._save_apt_state(path)
+
+                if search_index_complete:
+                    self._save_search_index(path, search_index)
+                else:
+                    self._discard_search_index(path)
+
+                self._loaded_path = path
+
+        # A partial index is still used for searching, but nothing is carried over
+        # with it, so the next generation is a full one.
+        self._search_index = search_index
+        self._search_index_is_partial = not search_index_complete
+        self.stale = False
+        self._set_items(json_obj)
+
+    def _set_items(self, json_obj):
+        with self._write_lock:
+            self._snapshot = CacheSnapshot(self._snapshot.generation + 1,
+                                           json_obj.pkginfo_cache,
+                                           json_obj.section_lists,
+                                           json_obj.flatpak_remote_infos,
+                                           json_obj.flatpak_shards,
+                                           json_obj.indexes)
+
+        if len(json_obj.pkginfo_cache) == 0:
             self.status = self.STATUS_EMPTY
         else:
             self.status = self.STATUS_OK
 
-    def _generate_cache_thread(self, callback=None):
-        self._new_cache_common()
+    def _generate_cache_thread(self, callback=None, pkg_type=None):
+        self._new_cache_common(pkg_type)
 
         if callback is not None:
             GObject.idle_add(callback)
 
+    def _revalidate_thread(self, callback, pkg_type):
+        old_snapshot = self._snapshot
+        self._new_cache_common(pkg_type)
+
+        changes = CacheChanges.between(old_snapshot, self._snapshot)
+        debug("Installer: pkgcache revalidated - %d added, %d removed, %d changed"
+                  % (len(changes.added), len(changes.removed), len(changes.changed)))
+
+        GObject.idle_add(callback, changes)
+
+    def revalidate_async(self, idle_callback, pkg_type=None):
+        """
+        Regenerates the cache in the background, while the current items stay in use.
+        idle_callback is called with the CacheChanges once the new items are in place.
+        """
+        thread = threading.Thread(target=self._revalidate_thread, args=(idle_callback, pkg_type))
+        thread.start()
+
     def get_subset_of_type(self, pkg_type):
-        with self._item_lock:
-            return {k: v for k, v in self._items.items() if k.startswith(pkg_type)}
+        """ Returns a read-only mapping of the items of pkg_type """
+        return self._snapshot.get_subset_of_type(pkg_type)
+
+    def search(self, query, limit=None):
+        """
+        Returns the PkgInfos matching query, best matches first. Every word of the query
+        has to be found in a package's name, summary, keywords or description.
+        """
+        snapshot = self._snapshot
+        results = []
+
+        for pkg_hash in self._get_search_index().search(query):
+            if pkg_hash in snapshot:
+                results.append(snapshot[pkg_hash])
+
+                if limit is not None and len(results) == limit:
+                    break
+
+        return results
+
+    def get_pkg_hashes_for_name(self, name, pkg_type=None):
+        """ Returns the pkg_hashes of the packages called name, of any remote """
+        pkg_hashes = []
+
+        if pkg_type in ("a", None):
+            apt_pkg_hash = _apt.add_prefix(name)
+            if apt_pkg_hash in self._snapshot:
+                pkg_hashes.append(apt_pkg_hash)
 
-    def force_new_cache_async(self, idle_callback=None):
+        if pkg_type in ("f", None):
+            pkg_hashes += self._snapshot.indexes.by_name.get(name, [])
+
+        return pkg_hashes
+
+    def get_pkg_hashes_for_refid(self, refid):
+        """ Returns the pkg_hashes of the flatpaks with the given refid (one per remote providing it) """
+        return list(self._snapshot.indexes.by_refid.get(refid, []))
+
+    def get_pkg_hashes_for_remote(self, remote_name):
+        return list(self._snapshot.indexes.by_remote.get(remote_name, []))
+
+    def force_new_cache_async(self, idle_callback=None, pkg_type=None):
         thread = threading.Thread(target=self._generate_cache_thread,
-                                  kwargs={"callback" : idle_callback})
+                                  kwargs={"callback" : idle_callback, "pkg_type": pkg_type})
         thread.start()
 
-    def force_new_cache(self):
-        self._new_cache_common()
+    def force_new_cache(self, pkg_type=None):
+        self._new_cache_common(pkg_type)
 
     def find_pkginfo(self, string, pkg_type=None, remote=None):
         if pkg_type == "a" and not string.startswith("apt:"):
@@ -309,33 +1171,79 @@ class PkgCache(object):
 
         return None
 
+    def _get_manual_state_path(self):
+        path = self._get_best_save_path()
+        return None if path is None else self._get_sidecar_path(path, "manual")
+
+    def _get_manual_state(self):
+        fingerprints = {path: _apt.get_file_fingerprint(path) for path in
+                            (_apt.INSTALLER_STATUS_LOG_PATH, _apt.DPKG_STATUS_PATH, _apt.APT_EXTENDED_STATES_PATH)}
+
+        if fingerprints[_apt.INSTALLER_STATUS_LOG_PATH] is None:
+            return None
+
+        state = self._manual_state
+        path = self._get_manual_state_path()
+
+        if state is None and path is not None:
+            try:
+                state = cachefile.load(path, MANUAL_STATE_RECORDS_KEY)
+            except Exception:
+                state = None
+
+        if state is not None and state["fingerprints"] == fingerprints:
+            self._manual_state = state
+            return state
+
+        old_fingerprints = {} if state is None else state["fingerprints"]
+
+        def unchanged(*paths):
+            return all(old_fingerprints.get(path) == fingerprints[path] for path in paths)
+
+        new_state = {"fingerprints": fingerprints}
+
+        # The installer's list never changes in practice, it only needs reading once.
+        if unchanged(_apt.INSTALLER_STATUS_LOG_PATH):
+            new_state["initial_status"] = state["initial_status"]
+        else:
+            new_state["initial_status"] = _apt.get_initial_status_packages()
+
+            if new_state["initial_status"] is None:
+                return None
+
+        if unchanged(_apt.DPKG_STATUS_PATH, _apt.APT_EXTENDED_STATES_PATH):
+            new_state[MANUAL_STATE_RECORDS_KEY] = state[MANUAL_STATE_RECORDS_KEY]
+        else:
+            try:
+                new_state[MANUAL_STATE_RECORDS_KEY] = _apt.get_manually_installed_names()
+            except Exception as e:
+                warn("Could not read the installed packages: %s" % str(e))
+                return None
+
+        if path is not None:
+            try:
+                self._write_file(path, new_state, MANUAL_STATE_RECORDS_KEY)
+            except Exception as e:
+                debug("Installer: Could not save manually installed packages: %s" % str(e))
+
+        self._manual_state = new_state
+        return new_state
+
     def _get_manually_installed_debs(self):
         """
         Generate list of manually installed Debian package.
         Requires a package list provided by the installer.
             Currently knows only Ubiquity's /var/log/installer/initial-status.gz
         """
-        installer_log = "/var/log/installer/initial-status.gz"
-        if not os.path.isfile(installer_log):
-            return None
-        import gzip
-        try:
-            installer_log = gzip.open(installer_log, "r").read().decode('utf-8').splitlines()
-        except Exception as e:
-            # There are a number of different exceptions here, but there's only one response
-            warn("Could not get initial installed packages list (check /var/log/installer/initial-status.gz): %s" % str(e))
-            return None
-        initial_status = [x[9:] for x in installer_log if x.startswith("Package: ")]
-        if not initial_status:
+        state = self._get_manual_state()
+        if state is None or not state["initial_status"]:
             return None
-        from . import _apt
-        pkgcache = [x[4:] for x in self.get_subset_of_type("a")]
-        current_status = ["apt:%s" % pkg for pkg in _apt.get_apt_cache() if
-            (pkg.installed and
-            not pkg.is_auto_installed and
-            pkg.shortname not in initial_status and
-            pkg.shortname in pkgcache)]
-        return current_status
+
+        initial_status = set(state["initial_status"])
+        snapshot = self._snapshot
+
+        return [_apt.add_prefix(name) for name, shortname in state[MANUAL_STATE_RECORDS_KEY].items()
+                    if shortname not in initial_status and _apt.add_prefix(shortname) in snapshot]
 
     def get_manually_installed_packages(self):
         """ Get list of all manually installed packages (apt and flatpak) """
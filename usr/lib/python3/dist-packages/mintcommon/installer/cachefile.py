@@ -0,0 +1,338 @@
+import json
+import mmap
+import struct
+import sys
+from array import array
+from collections.abc import Mapping
+
+# On-disk layout (all integers little-endian):
+#
+#   header      magic, format version, schema version, string count, record count
+#               and the offsets of each of the sections below.
+#   strings     (string count + 1) u32 end offsets, followed by the utf-8 string data.
+#               Every string (keys, values, dict keys) is stored once.
+#   index       one (u32 key string id, u32 record offset) pair per record.
+#   records     tagged values, see _encode_value(). array("I") values are stored
+#               packed, so large integer lists stay small and decode in one go.
+#   meta        a single tagged value holding everything that isn't a record.
+#
+# Records are only decoded when they're accessed, so opening a cache costs
+# little more than reading the index. The sections, string table and index are
+# checked when it's opened, a record that turns out to be corrupt raises
+# CacheFormatError when it's decoded.
+
+MAGIC = b"MINTPKGC"
+BINARY_FORMAT_VERSION = 1
+
+_HEADER = struct.Struct("<8sIIIIQQQQQ")
+_INDEX_ENTRY = struct.Struct("<II")
+_U32 = struct.Struct("<I")
+_I64 = struct.Struct("<q")
+_F64 = struct.Struct("<d")
+
+_TAG_NONE = ord("N")
+_TAG_TRUE = ord("T")
+_TAG_FALSE = ord("F")
+_TAG_INT = ord("i")
+_TAG_FLOAT = ord("d")
+_TAG_STRING = ord("s")
+_TAG_LIST = ord("l")
+_TAG_DICT = ord("m")
+_TAG_U32_ARRAY = ord("a")
+
+class CacheFormatError(Exception):
+    """Thrown when a cache file is truncated, corrupt or of an unknown format"""
+
+class _StringTable():
+    def __init__(self):
+        self.ids = {}
+        self.strings = []
+
+    def add(self, string):
+        try:
+            return self.ids[string]
+        except KeyError:
+            sid = len(self.strings)
+            self.ids[string] = sid
+            self.strings.append(string)
+            return sid
+
+def _encode_value(out, strings, value, default):
+    if value is None:
+        out.append(_TAG_NONE)
+    elif value is True:
+        out.append(_TAG_TRUE)
+    elif value is False:
+        out.append(_TAG_FALSE)
+    elif isinstance(value, int):
+        out.append(_TAG_INT)
+        out += _I64.pack(value)
+    elif isinstance(value, float):
+        out.append(_TAG_FLOAT)
+        out += _F64.pack(value)
+    elif isinstance(value, str):
+        out.append(_TAG_STRING)
+        out += _U32.pack(strings.add(value))
+    elif isinstance(value, array) and value.typecode == "I":
+        out.append(_TAG_U32_ARRAY)
+        out += _U32.pack(len(value))
+        if sys.byteorder != "little":
+            value = array("I", value)
+            value.byteswap()
+        out += value.tobytes()
+    elif isinstance(value, (list, tuple)):
+        out.append(_TAG_LIST)
+        out += _U32.pack(len(value))
+        for item in value:
+            _encode_value(out, strings, item, default)
+    elif isinstance(value, dict):
+        out.append(_TAG_DICT)
+        out += _U32.pack(len(value))
+        for key, item in value.items():
+            # Like json, dict keys are always strings.
+            out += _U32.pack(strings.add(str(key)))
+            _encode_value(out, strings, item, default)
+    elif default is not None:
+        _encode_value(out, strings, default(value), default)
+    else:
+        raise TypeError("Cannot encode %s in a cache file" % type(value))
+
+def dump(payload, f, records_key, default=None):
+    """
+    Writes payload to the binary file object f. payload[records_key] must be a
+    mapping - its entries become individually addressable records, everything
+    else in payload is stored as metadata. default is used like json's, to
+    convert objects that aren't plain values.
+    """
+    strings = _StringTable()
+    schema_version = payload.get("schema_version", 0)
+
+    index = bytearray()
+    record_data = bytearray()
+
+    records = payload[records_key]
+    for key in records.keys():
+        index += _INDEX_ENTRY.pack(strings.add(key), len(record_data))
+        _encode_value(record_data, strings, records[key], default)
+
+    meta = {k: v for k, v in payload.items() if k not in (records_key, "schema_version")}
+    meta_data = bytearray()
+    _encode_value(meta_data, strings, meta, default)
+
+    string_offsets = bytearray(_U32.pack(0))
+    string_data = bytearray()
+    for string in strings.strings:
+        string_data += string.encode("utf-8")
+        string_offsets += _U32.pack(len(string_data))
+
+    str_idx_off = _HEADER.size
+    str_data_off = str_idx_off + len(string_offsets)
+    rec_idx_off = str_data_off + len(string_data)
+    rec_data_off = rec_idx_off + len(index)
+    meta_off = rec_data_off + len(record_data)
+
+    f.write(_HEADER.pack(MAGIC, BINARY_FORMAT_VERSION, schema_version,
+                         len(strings.strings), len(records),
+                         str_idx_off, str_data_off, rec_idx_off, rec_data_off, meta_off))
+    f.write(string_offsets)
+    f.write(string_data)
+    f.write(index)
+    f.write(record_data)
+    f.write(meta_data)
+
+class CacheFile():
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            try:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise CacheFormatError("Cache file is empty")
+
+        if len(self._mm) < _HEADER.size:
+            raise CacheFormatError("Cache file is truncated")
+
+        (magic, format_version, self.schema_version,
+         self._string_count, self._record_count,
+         self._str_idx_off, self._str_data_off,
+         self._rec_idx_off, self._rec_data_off, self._meta_off) = _HEADER.unpack_from(self._mm, 0)
+
+        if magic != MAGIC:
+            raise CacheFormatError("Not a binary cache file")
+        if format_version != BINARY_FORMAT_VERSION:
+            raise CacheFormatError("Unsupported binary cache format version %d" % format_version)
+        if not (_HEADER.size <= self._str_idx_off <= self._str_data_off <= self._rec_idx_off
+                <= self._rec_data_off <= self._meta_off < len(self._mm)):
+            raise CacheFormatError("Cache file is truncated")
+        if self._str_idx_off + (self._string_count + 1) * 4 != self._str_data_off or \
+          self._rec_idx_off + self._record_count * _INDEX_ENTRY.size != self._rec_data_off:
+            raise CacheFormatError("Cache file sections don't match their counts")
+
+        # The string offsets are small and hit on every access, keep them in memory.
+        self._string_ends = self._read_u32_array(self._str_idx_off, self._string_count + 1)
+
+        if self._string_ends[0] != 0 or max(self._string_ends) != self._rec_idx_off - self._str_data_off:
+            raise CacheFormatError("Cache file has a corrupt string table")
+
+    def _read_u32_array(self, offset, count):
+        values = array("I")
+        values.frombytes(self._mm[offset:offset + count * 4])
+        if sys.byteorder != "little":
+            values.byteswap()
+        return values
+
+    def get_string(self, sid):
+        try:
+            start = self._str_data_off + self._string_ends[sid]
+            return self._mm[start:self._str_data_off + self._string_ends[sid + 1]].decode("utf-8")
+        except (IndexError, UnicodeDecodeError) as e:
+            raise CacheFormatError("Corrupt string %d: %s" % (sid, e))
+
+    def decode_value(self, pos):
+        try:
+            return self._decode_value(pos)[0]
+        except (struct.error, IndexError, ValueError, OverflowError, RecursionError) as e:
+            raise CacheFormatError("Corrupt value at offset %d: %s" % (pos, e))
+
+    def _decode_value(self, pos):
+        mm = self._mm
+        tag = mm[pos]
+        pos += 1
+
+        if tag == _TAG_STRING:
+            return self.get_string(_U32.unpack_from(mm, pos)[0]), pos + 4
+        if tag == _TAG_NONE:
+            return None, pos
+        if tag == _TAG_TRUE:
+            return True, pos
+        if tag == _TAG_FALSE:
+            return False, pos
+        if tag == _TAG_INT:
+            return _I64.unpack_from(mm, pos)[0], pos + 8
+        if tag == _TAG_FLOAT:
+            return _F64.unpack_from(mm, pos)[0], pos + 8
+        if tag == _TAG_U32_ARRAY:
+            count = _U32.unpack_from(mm, pos)[0]
+            pos += 4
+            if pos + count * 4 > len(mm):
+                raise CacheFormatError("Array at offset %d runs past the end of the file" % (pos - 5))
+            return self._read_u32_array(pos, count), pos + count * 4
+        if tag == _TAG_LIST:
+            count = _U32.unpack_from(mm, pos)[0]
+            pos += 4
+            # Every item takes at least its tag.
+            if pos + count > len(mm):
+                raise CacheFormatError("List at offset %d runs past the end of the file" % (pos - 5))
+            items = []
+            for i in range(count):
+                item, pos = self._decode_value(pos)
+                items.append(item)
+            return items, pos
+        if tag == _TAG_DICT:
+            count = _U32.unpack_from(mm, pos)[0]
+            pos += 4
+            # Every item takes at least its key and tag.
+            if pos + count * 5 > len(mm):
+                raise CacheFormatError("Dict at offset %d runs past the end of the file" % (pos - 5))
+            items = {}
+            for i in range(count):
+                key = self.get_string(_U32.unpack_from(mm, pos)[0])
+                items[key], pos = self._decode_value(pos + 4)
+            return items, pos
+
+        raise CacheFormatError("Unknown value tag %d at offset %d" % (tag, pos - 1))
+
+    def get_meta(self):
+        return self.decode_value(self._meta_off)
+
+    def get_records(self):
+        return CacheRecords(self)
+
+    def iter_index(self):
+        index = self._read_u32_array(self._rec_idx_off, self._record_count * 2)
+
+        if index and (max(index[0::2]) >= self._string_count or
+                      max(index[1::2]) >= self._meta_off - self._rec_data_off):
+            raise CacheFormatError("Cache file has a corrupt record index")
+
+        get_string = self.get_string
+        rec_data_off = self._rec_data_off
+
+        for i in range(0, len(index), 2):
+            yield get_string(index[i]), rec_data_off + index[i + 1]
+
+class CacheRecords(Mapping):
+    """
+    Read-only mapping of record key to record value, backed by a CacheFile.
+    Values are decoded from the mapped file every time they're accessed.
+    """
+    def __init__(self, cache_file):
+        self._file = cache_file
+        self._offsets = dict(cache_file.iter_index())
+
+    def __getitem__(self, key):
+        return self._file.decode_value(self._offsets[key])
+
+    def __contains__(self, key):
+        return key in self._offsets
+
+    def __iter__(self):
+        return iter(self._offsets)
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def keys(self):
+        return self._offsets.keys()
+
+def is_binary(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+def load(path, records_key):
+    """
+    Loads a cache payload, either binary or json. For binary files, the
+    records are returned as a lazily-decoded CacheRecords mapping. Raises
+    CacheFormatError if the file is truncated or corrupt, OSError if it
+    can't be read.
+    """
+    if not is_binary(path):
+        try:
+            with open(path, "r", encoding="utf8") as f:
+                payload = json.load(f)
+        except ValueError as e:
+            # Includes json and utf-8 decoding errors.
+            raise CacheFormatError("Not a valid json cache file: %s" % e)
+
+        if not isinstance(payload, dict):
+            raise CacheFormatError("Not a valid json cache file: not an object")
+
+        return payload
+
+    cache_file = CacheFile(path)
+
+    payload = cache_file.get_meta()
+    if not isinstance(payload, dict):
+        raise CacheFormatError("Cache file has corrupt metadata")
+
+    payload["schema_version"] = cache_file.schema_version
+    payload[records_key] = cache_file.get_records()
+
+    return payload
+
+def save(f, payload, records_key, default=None, binary=True):
+    """
+    Writes payload to the open file f, which must be opened in binary mode
+    when binary is True. The json format is kept for debugging.
+    """
+    if binary:
+        dump(payload, f, records_key, default)
+        return
+
+    def json_default(o):
+        if isinstance(o, array):
+            return o.tolist()
+        if default is not None:
+            return default(o)
+        raise TypeError("Cannot encode %s in a cache file" % type(o))
+
+    json.dump(payload, f, default=json_default, indent=4)
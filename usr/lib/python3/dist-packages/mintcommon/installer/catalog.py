@@ -0,0 +1,132 @@
+from array import array
+from collections.abc import Mapping
+
+# Values are referred to by u32 ids, the low 2 bits tell which pool they're in.
+_STRING = 0
+_SCALAR = 1
+_DICT = 2
+_LIST = 3
+
+# Column entry for rows that don't have the field.
+_ABSENT = 0xffffffff
+
+class PkgCatalog(Mapping):
+    """
+    Read-only pkg_hash -> record mapping, stored column-wise. Each field is an
+    array of value ids, one per row. Distinct values are stored once: strings
+    as utf-8 in a single buffer, dicts and lists as runs of ids, so a package
+    costs a few bytes per field plus the text that's unique to it. Records are
+    rebuilt as dicts when they're accessed.
+    """
+    def __init__(self):
+        self._rows = {}
+        self._columns = {}
+
+        self._string_data = bytearray()
+        self._string_ends = array("I", [0])
+        self._scalars = []
+        self._composites = array("I")
+
+        # Only needed while adding rows.
+        self._value_ids = {}
+
+    @classmethod
+    def from_records(cls, records):
+        """ Makes a catalog of the records in a pkg_hash -> record mapping """
+        inst = cls()
+
+        for pkg_hash in records.keys():
+            inst._append(pkg_hash, records[pkg_hash])
+
+        inst._value_ids = None
+        return inst
+
+    def _intern(self, value):
+        if isinstance(value, dict):
+            ids = []
+            for key, item in value.items():
+                ids += (self._intern(key), self._intern(item))
+            key = (dict, tuple(ids))
+        elif isinstance(value, (list, tuple)):
+            key = (list, tuple(self._intern(item) for item in value))
+        else:
+            # Keyed by type too, otherwise True, 1 and 1.0 would all be the same value.
+            key = (type(value), value)
+
+        try:
+            return self._value_ids[key]
+        except KeyError:
+            pass
+
+        kind = key[0]
+
+        if kind is str:
+            value_id = (len(self._string_ends) - 1) << 2 | _STRING
+            self._string_data += value.encode("utf-8")
+            self._string_ends.append(len(self._string_data))
+        elif kind is dict or kind is list:
+            value_id = len(self._composites) << 2 | (_DICT if kind is dict else _LIST)
+            self._composites.append(len(key[1]))
+            self._composites.extend(key[1])
+        else:
+            value_id = len(self._scalars) << 2 | _SCALAR
+            self._scalars.append(value)
+
+        self._value_ids[key] = value_id
+        return value_id
+
+    def _get_value(self, value_id):
+        pool = value_id & 3
+        index = value_id >> 2
+
+        if pool == _STRING:
+            return self._string_data[self._string_ends[index]:self._string_ends[index + 1]].decode("utf-8")
+        if pool == _SCALAR:
+            return self._scalars[index]
+
+        count = self._composites[index]
+        ids = self._composites[index + 1:index + 1 + count]
+
+        if pool == _DICT:
+            return {self._get_value(ids[i]): self._get_value(ids[i + 1]) for i in range(0, count, 2)}
+
+        return [self._get_value(item_id) for item_id in ids]
+
+    def _append(self, pkg_hash, record):
+        row = len(self._rows)
+        self._rows[pkg_hash] = row
+
+        for field, value in record.items():
+            try:
+                column = self._columns[field]
+            except KeyError:
+                column = self._columns[field] = array("I", [_ABSENT]) * row
+
+            column.append(self._intern(value))
+
+        for column in self._columns.values():
+            if len(column) == row:
+                column.append(_ABSENT)
+
+    def __getitem__(self, pkg_hash):
+        row = self._rows[pkg_hash]
+        record = {}
+
+        for field, column in self._columns.items():
+            value_id = column[row]
+            if value_id != _ABSENT:
+                record[field] = self._get_value(value_id)
+
+        return record
+
+    def __contains__(self, pkg_hash):
+        return pkg_hash in self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def keys(self):
+        return self._rows.keys()
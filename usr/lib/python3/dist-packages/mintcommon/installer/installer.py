@@ -199,6 +199,11 @@ class InstallerTask:
 class Installer(GObject.Object):
     __gsignals__ = {
         'appstream-changed': (GObject.SignalFlags.RUN_LAST, None, ()),
+        # Emitted with a cache.CacheChanges when a stale cache has been replaced (see init())
+        'cache-changed': (GObject.SignalFlags.RUN_LAST, None, (object,)),
+        # Emitted with the set of pkg_hashes that were installed or removed by an apt task,
+        # before the task's client_finished_cb is called.
+        'installed-changed': (GObject.SignalFlags.RUN_LAST, None, (object,)),
     }
     def __init__(self, pkg_type=PKG_TYPE_ALL, temp=False):
         GObject.Object.__init__(self)
@@ -214,6 +219,7 @@ class Installer(GObject.Object):
 
         self.remotes_changed = False
         self.inited = False
+        self.revalidating = False
 
         self.have_flatpak = False
         self.have_flatpak = self._get_flatpak_status()
@@ -263,25 +269,40 @@ class Installer(GObject.Object):
 
         return False
 
-    def init(self, ready_callback=None):
+    def init(self, ready_callback=None, allow_stale=False):
         """
         Loads the cache asynchronously.  If there is no cache (or it's too old,) it causes
         one to be generated and saved.  The ready_callback is called on idle once this is finished.
+
+        If allow_stale is True, a cache that's too old or that predates changes to the flatpak
+        remotes is used right away, and regenerated in the background. 'cache-changed' is
+        emitted once the new one is in place.
         """
         self.backend_table = {}
 
-        self.cache = cache.PkgCache(self.pkg_type, self.cache_path, self.have_flatpak)
+        self.cache = cache.PkgCache(self.pkg_type, self.cache_path, self.have_flatpak, allow_stale)
 
         self._init_cb = ready_callback
 
-        if self.cache.status == self.cache.STATUS_OK and not self.remotes_changed:
+        if self.cache.status == self.cache.STATUS_OK and not (self.cache.stale or self.remotes_changed):
             self.inited = True
 
             GObject.idle_add(self._idle_cache_load_done)
-        else:
-            if self.remotes_changed:
-                debug("Installer: Flatpak remotes have changed, forcing a new cache.")
+        elif self.cache.status == self.cache.STATUS_OK and allow_stale:
+            debug("Installer: Starting with the current pkgcache, refreshing it in the background.")
+            self.revalidating = True
+
+            # An up-to-date cache only needs its flatpak side refreshed.
+            self.cache.revalidate_async(self._idle_cache_revalidated,
+                                        None if self.cache.stale else PKG_TYPE_FLATPAK)
 
+            GObject.idle_add(self._idle_cache_load_done)
+        elif self.cache.status == self.cache.STATUS_OK:
+            # Only the flatpak shards of changed remotes need rebuilding, the apt side is still valid.
+            debug("Installer: Flatpak remotes have changed, refreshing flatpak packages.")
+
+            self.cache.force_new_cache_async(self._idle_cache_load_done, PKG_TYPE_FLATPAK)
+        else:
             self.cache.force_new_cache_async(self._idle_cache_load_done)
 
         return self
@@ -301,7 +322,8 @@ class Installer(GObject.Object):
     def _idle_cache_load_done(self):
         self.inited = True
 
-        if self.remotes_changed:
+        # When revalidating, remotes are stored once the cache reflects them.
+        if self.remotes_changed and not self.revalidating:
             self._store_remotes()
             self.remotes_changed = False
 
@@ -312,6 +334,21 @@ class Installer(GObject.Object):
         if self._init_cb:
             self._init_cb()
 
+    def _idle_cache_revalidated(self, changes):
+        self.revalidating = False
+
+        self.backend_table = {pkginfo: component for pkginfo, component in self.backend_table.items()
+                                  if pkginfo.pkg_hash not in changes}
+
+        if self.remotes_changed:
+            self._store_remotes()
+            self.remotes_changed = False
+
+            # The appstream pools need to pick up the new remotes as well.
+            self.initialize_appstream()
+
+        self.emit("cache-changed", changes)
+
     @print_timing
     def _fp_remotes_have_changed(self):
         """
@@ -477,7 +514,7 @@ class Installer(GObject.Object):
     def pkginfo_is_installed(self, pkginfo):
         """
         Returns whether or not a given package is currently installed.  This uses
-        the AptCache or the FlatpakInstallation to check.
+        the dpkg status or the FlatpakInstallation to check, see installed_states().
         """
         if self.inited:
             if pkginfo.pkg_hash.startswith("a"):
@@ -487,6 +524,35 @@ class Installer(GObject.Object):
 
         return False
 
+    def installed_states(self, pkginfos):
+        """
+        Returns whether each of pkginfos is currently installed, in the same order.
+        Each backend's installed packages are read at most once per call (and only
+        again when they've changed), so use this for checking many packages at once.
+        """
+        if not self.inited:
+            return [False] * len(pkginfos)
+
+        states = []
+        apt_installed = None
+        flatpak_installed = None
+
+        for pkginfo in pkginfos:
+            if pkginfo.pkg_hash.startswith("a"):
+                if apt_installed is None:
+                    apt_installed = _apt.get_installed_snapshot()
+
+                states.append(pkginfo.name in apt_installed)
+            elif self.have_flatpak and pkginfo.pkg_hash.startswith("f"):
+                if flatpak_installed is None:
+                    flatpak_installed = _flatpak.get_installed_snapshot()
+
+                states.append(_flatpak.get_installed_key(pkginfo) in flatpak_installed)
+            else:
+                states.append(False)
+
+        return states
+
     @print_timing
     def generate_uncached_pkginfos(self):
         """
@@ -568,6 +634,17 @@ class Installer(GObject.Object):
 
         return addons
 
+    def search(self, query, limit=None):
+        """
+        Returns a list of pkginfos matching query, best matches first, using the index
+        that's saved with the cache. Every word in the query has to match (the last one
+        can be incomplete) the name, summary, keywords or description of a package.
+        """
+        if not self.inited:
+            return []
+
+        return self.cache.search(query, limit)
+
     def get_description(self, pkginfo, for_search=False):
         """
         Returns the description of the package. If for_search is True,
@@ -575,7 +652,11 @@ class Installer(GObject.Object):
         """
         if for_search and pkginfo.pkg_hash.startswith("a"):
             try:
-                return _apt._apt_cache[pkginfo.name].candidate.description
+                # Reopened first if a task changed it.
+                apt_cache = _apt.get_apt_cache()
+
+                with _apt._apt_cache_lock:
+                    return apt_cache[pkginfo.name].candidate.description
             except Exception:
                 pass
 
@@ -679,6 +760,10 @@ class Installer(GObject.Object):
 
         self.tasks[key] = task
 
+        if key.startswith("a"):
+            # So the post-task update can tell what the task changed.
+            _apt.get_installed_snapshot()
+
         debug("Starting task for package %s, type '%s'" % (key, task.type))
 
         task.execute()
@@ -729,12 +814,18 @@ class Installer(GObject.Object):
             self._run_client_callback(task)
 
     def _apt_post_task_update_thread(self, task):
-        _apt.sync_cache_installed_states()
+        changed = _apt.sync_cache_installed_states()
 
-        # This needs to be called after reloading the apt cache, otherwise our installed
+        if changed:
+            GObject.idle_add(self._idle_installed_changed, changed, priority=GLib.PRIORITY_DEFAULT)
+
+        # This needs to be called after syncing the installed states, otherwise our installed
         # apps don't update correctly
         self._run_client_callback(task)
 
+    def _idle_installed_changed(self, changed):
+        self.emit("installed-changed", changed)
+
     def _run_client_callback(self, task):
         if task.client_finished_cb:
             GObject.idle_add(task.client_finished_cb, task, priority=GLib.PRIORITY_DEFAULT)
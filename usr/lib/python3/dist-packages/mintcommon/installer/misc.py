@@ -5,6 +5,10 @@ import time
 import inspect
 import threading
 import sys
+import hashlib
+import textwrap
+from collections import OrderedDict
+from html.parser import HTMLParser
 import html2text
 import html2text.config
 
@@ -23,6 +27,13 @@ html_converter.ul_item_mark = "•"
 html_converter.wrap_list_items = True
 html_converter.ignore_emphasis = True
 html_converter.pad_tables = True
+# The converter keeps its state between calls, so it can't be shared by threads.
+html_converter_lock = threading.Lock()
+
+# Converted descriptions, by digest of their markup.
+MARKUP_CACHE_SIZE = 512
+markup_cache = OrderedDict()
+markup_cache_lock = threading.Lock()
 
 # Used as a decorator to time functions
 def print_timing(func):
@@ -37,6 +48,15 @@ def print_timing(func):
             return res
         return wrapper
 
+def get_file_fingerprint(path):
+    # Changes whenever the file is replaced or modified.
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+
+    return "%d:%d" % (st.st_mtime_ns, st.st_size)
+
 def check_ml():
     if not DEBUG_MODE:
         return
@@ -68,11 +88,153 @@ def warn(*args):
     argstr = " ".join(sanitized)
     print("mint-common (WARN): %s" % argstr, file=sys.stderr, flush=True)
 
+class UnsupportedMarkupError(Exception):
+    """Thrown when a description uses markup beyond what appstream allows in one"""
+
+class AppstreamMarkupParser(HTMLParser):
+    """
+    Converts the markup allowed in appstream descriptions (p, ul, ol, li, em and code)
+    to text laid out like html_converter does it: blank lines between paragraphs and
+    lists, the same bullets and numbering, code in backticks and the same wrapping.
+    It doesn't add html2text's markdown escapes (like "1\\." at the start of a
+    paragraph) or keep the odd trailing space. This follows html2text 2024.2.26,
+    older versions laid lists out a little differently. Parsers aren't reusable,
+    use a new one for every description.
+    """
+    # html2text's default body_width
+    WRAP_WIDTH = 78
+
+    def __init__(self):
+        super(AppstreamMarkupParser, self).__init__(convert_charrefs=True)
+
+        # (list item prefix or None, text, follows the previous item in the same list)
+        self.blocks = []
+        self.text = []
+        # One entry per open list: None for an unordered one, the item count for an ordered one.
+        self.lists = []
+        self.item_prefix = None
+        # Set when a list ends, whatever comes next starts a new paragraph.
+        self.list_ended = True
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "p":
+            self.end_block()
+        elif tag in ("ul", "ol"):
+            self.end_block()
+            self.lists.append(None if tag == "ul" else 0)
+        elif tag == "li":
+            self.end_block()
+
+            # Two spaces per list, three for a bulleted one in a numbered one.
+            indent = "  "
+            for parent, child in zip(self.lists, self.lists[1:]):
+                indent += "   " if parent is not None and child is None else "  "
+
+            if self.lists and self.lists[-1] is not None:
+                self.lists[-1] += 1
+                self.item_prefix = "%s%d. " % (indent, self.lists[-1])
+            else:
+                self.item_prefix = indent + "• "
+        elif tag == "code":
+            self.text.append("`")
+        elif tag != "em":
+            raise UnsupportedMarkupError(tag)
+
+    def handle_endtag(self, tag):
+        if tag in ("p", "li"):
+            self.end_block()
+        elif tag in ("ul", "ol"):
+            self.end_block()
+            if self.lists:
+                self.lists.pop()
+            if not self.lists:
+                self.list_ended = True
+        elif tag == "code":
+            self.text.append("`")
+
+    def handle_data(self, data):
+        self.text.append(data)
+
+    def end_block(self):
+        text = " ".join("".join(self.text).split())
+        self.text = []
+
+        if text:
+            is_item = self.item_prefix is not None
+            follows_item = is_item and not self.list_ended and self.blocks and self.blocks[-1][0] is not None
+
+            self.blocks.append((self.item_prefix, text, follows_item))
+            self.list_ended = False
+
+        self.item_prefix = None
+
+    def wrap_block(self, item_prefix, text):
+        # Like html2text's optwrap(): of the list items only top level bullets are
+        # wrapped, as ordered and nested ones look like markdown lists or code to it,
+        # and lines that look like a table aren't, unless they start like a list.
+        if item_prefix is None:
+            line = text
+            indent = ""
+        else:
+            line = item_prefix + text
+
+            if not item_prefix.startswith("  •"):
+                return line
+
+            indent = "    "
+
+        if " | " in line and not (line.startswith("-") or (line.startswith("*") and not line.startswith("**"))):
+            return line
+
+        return "\n".join(textwrap.wrap(line, self.WRAP_WIDTH, break_long_words=False, subsequent_indent=indent))
+
+    def convert(self, markup):
+        self.feed(markup)
+        self.close()
+        self.end_block()
+
+        result = []
+
+        for item_prefix, text, follows_item in self.blocks:
+            if result:
+                result.append("\n" if follows_item else "\n\n")
+            result.append(self.wrap_block(item_prefix, text))
+
+        result.append("\n\n")
+
+        return "".join(result)
+
+def _convert_markup(markup):
+    try:
+        return AppstreamMarkupParser().convert(markup)
+    except UnsupportedMarkupError:
+        pass
+
+    with html_converter_lock:
+        return html_converter.handle(markup)
+
 def xml_markup_convert_to_text(markup):
     if markup is None:
         return ""
+
+    key = hashlib.blake2b(markup.encode("utf-8"), digest_size=16).digest()
+
+    with markup_cache_lock:
+        try:
+            markup_cache.move_to_end(key)
+            return markup_cache[key]
+        except KeyError:
+            pass
+
     try:
-        return html_converter.handle(markup)
+        text = _convert_markup(markup)
     except Exception as e:
         warn("Could not convert description to text: %s" % str(e))
         return markup
+
+    with markup_cache_lock:
+        markup_cache[key] = text
+        if len(markup_cache) > MARKUP_CACHE_SIZE:
+            markup_cache.popitem(last=False)
+
+    return text
@@ -2,22 +2,100 @@ import sys
 if sys.version_info.major < 3:
     raise "python3 required"
 import os
+import threading
 
 import gi
 gi.require_version("Gtk", "3.0")
 from gi.repository import Gtk
 
-from .misc import warn, xml_markup_convert_to_text
+from .misc import warn, debug, xml_markup_convert_to_text
 
 # this should hopefully be supplied by remote info someday.
 FLATHUB_MEDIA_BASE_URL = "https://dl.flathub.org/media/"
 
+APP_INSTALL_ICONS_DIR = "/usr/share/app-install/icons"
+PIXMAPS_DIR = "/usr/share/pixmaps"
+
 def capitalize(string):
     if string and len(string) > 1:
         return (string[0].upper() + string[1:])
     else:
         return (string)
 
+class AptIconIndex():
+    """
+    What AptPkgInfo.get_icon looks for - the icon theme's icon names and the files in
+    the app-install and pixmaps directories - listed once, so that resolving icons
+    for every package when generating the cache doesn't mean probing for each one.
+    """
+    _current = None
+    _lock = threading.Lock()
+
+    def __init__(self, stamp):
+        self.stamp = stamp
+        self.theme_icons = set(Gtk.IconTheme.get_default().list_icons(None))
+        self.app_install_icons = self._list_dir(APP_INSTALL_ICONS_DIR)
+        self.pixmaps = self._list_dir(PIXMAPS_DIR)
+
+    @classmethod
+    def get_current(cls):
+        """ Returns an up-to-date index, reusing the last one if nothing it lists has changed """
+        stamp = cls._get_stamp()
+
+        with cls._lock:
+            if cls._current is None or cls._current.stamp != stamp:
+                debug("Installer: Listing apt package icons")
+                cls._current = cls(stamp)
+
+            return cls._current
+
+    @staticmethod
+    def _get_stamp():
+        # Updating an icon theme's cache replaces a file in its directory, which changes the
+        # directory's mtime, so the theme directories' mtimes are enough to notice changes.
+        settings = Gtk.Settings.get_default()
+        theme_name = settings.get_property("gtk-icon-theme-name") if settings is not None else None
+
+        paths = [APP_INSTALL_ICONS_DIR, PIXMAPS_DIR]
+        for path in Gtk.IconTheme.get_default().get_search_path():
+            paths += [path, os.path.join(path, "hicolor")]
+            if theme_name:
+                paths.append(os.path.join(path, theme_name))
+
+        stamp = [theme_name]
+        for path in paths:
+            try:
+                stamp.append(os.stat(path).st_mtime_ns)
+            except OSError:
+                stamp.append(None)
+
+        return tuple(stamp)
+
+    @staticmethod
+    def _list_dir(path):
+        try:
+            return set(os.listdir(path))
+        except OSError:
+            return set()
+
+    def lookup(self, name):
+        # Same order of preference as probing in AptPkgInfo.get_icon.
+        for icon_name in [name, name.split(":")[0], name.split("-")[0], name.split(".")[-1].lower()]:
+            if icon_name in self.theme_icons:
+                return icon_name
+
+        for extension in ['svg', 'png', 'xpm']:
+            for suffix in ['', '-icon']:
+                filename = "%s%s.%s" % (name, suffix, extension)
+                if filename in self.app_install_icons:
+                    return os.path.join(APP_INSTALL_ICONS_DIR, filename)
+
+                filename = "%s.%s" % (name, extension)
+                if filename in self.pixmaps:
+                    return os.path.join(PIXMAPS_DIR, filename)
+
+        return None
+
 class PkgInfo:
     __slots__ = (
         "name",
@@ -78,7 +156,7 @@ class PkgInfo:
         self.categories = []
 
 class AptPkgInfo(PkgInfo):
-    def __init__(self, pkg_hash=None, apt_pkg=None):
+    def __init__(self, pkg_hash=None, apt_pkg=None, icon_index=None):
         super(AptPkgInfo, self).__init__(pkg_hash)
 
         # This is cheap.. but keeps from having an additional fp/apt check every time we check it.
@@ -88,8 +166,23 @@ class AptPkgInfo(PkgInfo):
             self.name = apt_pkg.name
             self.display_name = self.get_display_name(apt_pkg)
             self.summary = self.get_summary(apt_pkg)
-            self.get_icon(48, apt_pkg)
-            self.get_icon(64, apt_pkg)
+            # Picked up by the search index when the cache is generated.
+            self.raw_description = apt_pkg.candidate.description or ""
+            self.get_icon(48, apt_pkg, icon_index)
+            self.get_icon(64, apt_pkg, icon_index)
+
+    @classmethod
+    def from_candidate_record(cls, pkg_hash, name, summary, raw_description, icon_index=None):
+        # Same as passing an apt.Package, with values read from apt_pkg directly.
+        inst = cls(pkg_hash)
+        inst.name = name
+        inst.display_name = name.capitalize().replace(":i386", "")
+        inst.summary = capitalize(summary) if summary is not None else ""
+        inst.raw_description = raw_description
+        inst.get_icon(48, None, icon_index)
+        inst.get_icon(64, None, icon_index)
+
+        return inst
 
     @classmethod
     def from_json(cls, json_data:dict):
@@ -100,10 +193,8 @@ class AptPkgInfo(PkgInfo):
         inst.summary = json_data["summary"]
 
         try:
-            cached = json_data["icon"]
-
-            while True:
-                size, icon = cached.popitem()
+            # Don't consume the record, it may still be held by the cache.
+            for size, icon in json_data["icon"].items():
                 inst.icon[int(size)] = icon
         except Exception as e:
             pass
@@ -180,12 +271,18 @@ class AptPkgInfo(PkgInfo):
     def get_keywords(self):
         return ""
 
-    def get_icon(self, size=64, apt_pkg=None):
+    def get_icon(self, size=64, apt_pkg=None, icon_index=None):
         try:
             return self.icon[size]
         except:
             pass
 
+        if icon_index is not None:
+            icon = icon_index.lookup(self.name)
+            if icon is not None:
+                self.icon[size] = icon
+            return icon
+
         theme = Gtk.IconTheme.get_default()
 
         for name in [self.name, self.name.split(":")[0], self.name.split("-")[0], self.name.split(".")[-1].lower()]:
@@ -318,6 +415,7 @@ class FlatpakPkgInfo(PkgInfo):
                 summary = ""
 
             self.summary = summary
+            self.raw_description = as_pkg.get_description() or ""
             self.icon["48"] = as_pkg.get_icon(48)
             self.verified = as_pkg.get_verified()
 
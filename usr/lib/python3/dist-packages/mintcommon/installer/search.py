@@ -0,0 +1,202 @@
+import re
+import bisect
+from array import array
+
+from .misc import print_timing, debug
+
+SEARCH_INDEX_VERSION = 1
+
+SEARCH_RECORDS_KEY = "postings"
+
+# Record field (or "description") -> score added to a token found in it.
+FIELD_WEIGHTS = (
+    ("name", 10),
+    ("display_name", 8),
+    ("keywords", 4),
+    ("summary", 3),
+    ("description", 1)
+)
+
+# Postings are (document id << 8 | score), scores are capped to fit.
+MAX_SCORE = 0xff
+
+# Dropped documents are left in place until they make up this much of the index.
+MAX_TOMBSTONE_RATIO = 0.25
+
+STOP_WORDS = {
+    "an", "and", "are", "as", "at", "be", "by", "can", "for", "from", "has", "in",
+    "is", "it", "its", "of", "on", "or", "that", "the", "this", "to", "with", "you", "your"
+}
+
+_MARKUP_RE = re.compile(r"<[^>]+>")
+_TOKEN_RE = re.compile(r"\w+")
+
+def tokenize(text):
+    """ Returns the searchable words in text (markup is dropped) """
+    if "<" in text:
+        text = _MARKUP_RE.sub(" ", text)
+
+    return [token for token in _TOKEN_RE.findall(text.lower())
+                if len(token) > 1 and token not in STOP_WORDS]
+
+def _score_document(record, description):
+    scores = {}
+
+    for field, weight in FIELD_WEIGHTS:
+        value = description if field == "description" else record.get(field)
+        if not value:
+            continue
+
+        for token in set(tokenize(value)):
+            scores[token] = scores.get(token, 0) + weight
+
+    return scores
+
+class SearchIndex():
+    """
+    An inverted index of the cache's packages: token -> postings, each packing
+    a document id with the token's score for that document. Documents are
+    pkg_hashes, an empty one is a package that was dropped since it was indexed.
+    """
+    def __init__(self, documents, postings):
+        self.documents = documents
+        self.postings = postings
+        self._sorted_tokens = None
+
+    @classmethod
+    @print_timing
+    def build(cls, items, descriptions):
+        """
+        Indexes every item of a PkgInfoMap. descriptions holds the raw descriptions
+        to index, by pkg_hash, where they're known.
+        """
+        inst = cls([], {})
+        inst._add_documents(items, items.keys(), descriptions)
+        return inst
+
+    @classmethod
+    @print_timing
+    def update(cls, old_index, items, descriptions):
+        """
+        Returns an index of items, reusing old_index for the documents that are still
+        current - those that are still in items and weren't described again (having a
+        new description means the package was regenerated).
+        """
+        documents = list(old_index.documents)
+        live = {}
+
+        for doc_id, pkg_hash in enumerate(documents):
+            if not pkg_hash:
+                continue
+
+            if pkg_hash in items and pkg_hash not in descriptions:
+                live[pkg_hash] = doc_id
+            else:
+                documents[doc_id] = ""
+
+        if len(documents) - len(live) > len(documents) * MAX_TOMBSTONE_RATIO:
+            debug("Search index: too many dropped packages, rebuilding")
+            return cls.build(items, descriptions)
+
+        new_pkg_hashes = [pkg_hash for pkg_hash in items.keys() if pkg_hash not in live]
+
+        inst = cls(documents, dict(old_index.postings))
+        inst._add_documents(items, new_pkg_hashes, descriptions)
+
+        debug("Search index: reused %d packages, indexed %d" % (len(live), len(new_pkg_hashes)))
+        return inst
+
+    @classmethod
+    def from_json(cls, json_data):
+        if json_data.get("schema_version", 0) != SEARCH_INDEX_VERSION:
+            return None
+
+        return cls(json_data["documents"], json_data[SEARCH_RECORDS_KEY])
+
+    def to_json(self):
+        return {
+            "schema_version": SEARCH_INDEX_VERSION,
+            "documents": self.documents,
+            SEARCH_RECORDS_KEY: self.postings
+        }
+
+    def _add_documents(self, items, pkg_hashes, descriptions):
+        new_postings = {}
+
+        for pkg_hash in pkg_hashes:
+            doc_id = len(self.documents)
+            self.documents.append(pkg_hash)
+
+            scores = _score_document(items.get_record(pkg_hash), descriptions.get(pkg_hash))
+            for token, score in scores.items():
+                try:
+                    postings = new_postings[token]
+                except KeyError:
+                    postings = new_postings[token] = array("I")
+
+                postings.append(doc_id << 8 | min(score, MAX_SCORE))
+
+        for token, postings in new_postings.items():
+            try:
+                # Never append to a loaded list, it may belong to another index.
+                self.postings[token] = array("I", self.postings[token]) + postings
+            except KeyError:
+                self.postings[token] = postings
+
+    def _get_matching_tokens(self, term, prefix):
+        if not prefix:
+            return [term] if term in self.postings else []
+
+        if self._sorted_tokens is None:
+            self._sorted_tokens = sorted(self.postings.keys())
+
+        tokens = self._sorted_tokens
+        start = bisect.bisect_left(tokens, term)
+        end = bisect.bisect_left(tokens, term + "\uffff", start)
+
+        return tokens[start:end]
+
+    def _get_term_scores(self, term, prefix):
+        scores = {}
+
+        for token in self._get_matching_tokens(term, prefix):
+            # Completions of a word count for less than the word itself.
+            divisor = 1 if token == term else 2
+
+            for posting in self.postings[token]:
+                doc_id = posting >> 8
+                score = (posting & MAX_SCORE) / divisor
+
+                if scores.get(doc_id, 0) < score:
+                    scores[doc_id] = score
+
+        return scores
+
+    def search(self, query):
+        """
+        Returns the pkg_hashes of the documents matching every word of query, best
+        matches first. The last word also matches as a prefix, as it may still
+        be being typed.
+        """
+        terms = tokenize(query)
+        scores = None
+
+        for i, term in enumerate(terms):
+            term_scores = self._get_term_scores(term, i == len(terms) - 1)
+
+            if scores is None:
+                scores = term_scores
+            else:
+                scores = {doc_id: score + term_scores[doc_id]
+                            for doc_id, score in scores.items() if doc_id in term_scores}
+
+            if not scores:
+                return []
+
+        if scores is None:
+            return []
+
+        documents = self.documents
+        ranked = sorted(((-score, documents[doc_id]) for doc_id, score in scores.items() if documents[doc_id]))
+
+        return [pkg_hash for score, pkg_hash in ranked]